@@ -1,73 +1,293 @@
 """ Lib to manage an ATM (Automatic Teller Machine).
-Important classes: User, Persistence.
+Important classes: User, Persistence, PasswordHasher, AccountSnapshot.
+Money is always an int of cents (eg: $12,50 is 1250), use to_cents and format_cents
+to convert it from and to text.
 """
 
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import csv
 import hashlib
+import heapq
+import hmac
+import math
+import mmap
+import json
 import sqlite3
+import struct
+import sys
+import threading
+import time
 import os
+import weakref
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
+MAX_CENTS = 2 ** 63 - 1 # biggest amount a database INTEGER holds
+
+
+
+def to_cents(amount):
+    """ Convert an amount of money to cents.
+
+    Args:
+        amount (str, num): In $, eg: '12,5', '12.50' or 12.5.
+
+    Returns:
+        int: Amount in cents, eg: 1250.
+
+    Raises:
+        ValueError: If it isn't a finite number, has fractions of cents or doesn't fit in
+                    a database INTEGER (signed 64 bits).
+    """
+    try:
+        cents = Decimal(str(amount).strip().replace(',', '.')) * 100
+    except InvalidOperation:
+        raise ValueError('Invalid amount: {!r}'.format(amount))
+
+    if not cents.is_finite() or abs(cents) > MAX_CENTS:
+        raise ValueError('Amount out of range: {!r}'.format(amount))
+    if cents != cents.to_integral_value():
+        raise ValueError('Fractions of cents in amount: {!r}'.format(amount))
+
+    return int(cents)
+
+
+
+def format_cents(cents):
+    """ Convert cents to text in $, eg: 1250 to '12.50'. """
+    sign = '-' if cents < 0 else ''
+    return '{}{}.{:02d}'.format(sign, abs(cents) // 100, abs(cents) % 100)
+
+
+
+class PasswordHasher(object):
+    """ Salted and deliberately slow password hashing, with a cost that can be tuned.
+    Hashes are encoded as 'algorithm$parameters$salt$hash' (salt and hash in hex), so each
+    one is verified with the parameters it was made with, even after they're changed.
+    Legacy hashes (unsalted MD5 hex digests) are still verified, see verify_and_update.
+
+    Methods don't change the instance, and hashlib releases the GIL while hashing, so they
+    can run in a thread pool (eg: see server.py) and use many cores at once. """
+
+    ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+
+    __algorithm = 'pbkdf2_sha256'
+    __params = '260000' # iterations for pbkdf2_sha256, 'n,r,p' for scrypt
+    __salt_size = 16 # in bytes
+
+
+
+    def __init__(self, algorithm='pbkdf2_sha256', iterations=260000, n=2**14, r=8, p=1,
+                 salt_size=16):
+        """ Constructor.
+
+        Args:
+            algorithm  (str): One of ALGORITHMS, for new hashes.
+            iterations (int): Cost of pbkdf2_sha256.
+            n, r, p    (int): Cost of scrypt (CPU/memory, block size and parallelization).
+            salt_size  (int): Random bytes of salt for each new hash.
+
+        Raises:
+            ValueError: For an unknown algorithm, or scrypt if hashlib has no support of it.
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('Unknown password hashing algorithm: {!r}'.format(algorithm))
+        if algorithm == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+            raise ValueError('There is no scrypt in hashlib (OpenSSL 1.1+ is needed).')
+
+        self.__algorithm = algorithm
+        if algorithm == 'scrypt':
+            self.__params = '{},{},{}'.format(n, r, p)
+        else:
+            self.__params = str(iterations)
+        self.__salt_size = salt_size
+
+
+
+    @staticmethod
+    def __derive(algorithm, params, password_str, salt):
+        """ Returns: bytes: Key derived from a password, by an algorithm and its parameters. """
+        password = password_str.encode('utf-8')
+        if algorithm == 'scrypt':
+            n, r, p = (int(param) for param in params.split(','))
+            return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                                  maxmem=256 * n * r * p + 2**20)
+        return hashlib.pbkdf2_hmac('sha256', password, salt, int(params))
+
+
+
+    def hash(self, password_str):
+        """ Hash a password with current algorithm, parameters and a new random salt.
+
+        Args:
+            password_str (str): A password in natural language.
+
+        Returns:
+            str: Encoded hash, as 'algorithm$parameters$salt$hash'.
+        """
+        salt = os.urandom(self.__salt_size)
+        key = self.__derive(self.__algorithm, self.__params, password_str, salt)
+        return '$'.join((self.__algorithm, self.__params, salt.hex(), key.hex()))
+
+
+
+    def needs_update(self, encoded):
+        """ Check if a hash isn't made with current algorithm and parameters. """
+        return not encoded.startswith(self.__algorithm + '$' + self.__params + '$')
+
+
+
+    def verify(self, password_str, encoded):
+        """ Check a password against an encoded hash (or a legacy MD5 one).
+
+        Returns:
+            bool: True if it matches, False otherwise (even for a malformed hash).
+        """
+        if '$' not in encoded: # legacy
+            legacy = hashlib.md5(password_str.encode('utf-8')).hexdigest()
+            return hmac.compare_digest(legacy, encoded)
+
+        try:
+            algorithm, params, salt, key = encoded.split('$')
+            if algorithm not in self.ALGORITHMS:
+                return False
+            derived = self.__derive(algorithm, params, password_str, bytes.fromhex(salt))
+        except ValueError:
+            return False
+
+        return hmac.compare_digest(derived.hex(), key)
+
+
+
+    def verify_and_update(self, password_str, encoded):
+        """ Check a password, hashing it again if its hash is outdated (eg: legacy MD5).
+
+        Returns:
+            tuple: (True if it matches, new encoded hash to be saved or None).
+        """
+        if not self.verify(password_str, encoded):
+            return False, None
+        if self.needs_update(encoded):
+            return True, self.hash(password_str)
+        return True, None
+
+
+# ..............................................................
+
+
 class User(object):
     """ Bank user. Can log in and do some actions or just act as a passive object.
     Another class must be used to persist these instances in local storage. """
 
-    ACTIONS = { # for later registration in history attribute
+    ACTIONS = { # codes for history registers -> how they're displayed
         'TRANSFERING' : 'transfered', # money transfering between two users
         'WITHDRAWING' : 'withdrawed', # withdraw own money
         'RECEIVING' : 'received an amount of', # receiving money from anyone/anywhere
+        'INTEREST' : 'received interest of', # posted by end of day jobs, see eod.py
+        'FEE' : 'was charged a fee of', # posted by end of day jobs too
+        'REFUND' : 'was refunded', # of a cancelled two-phase commit, see Persistence.prepare
     }
 
-    __agency = ''
-    __account = ''
-    __password = '' # md5
-    __balance = 0
-    __history = []
+    CREDIT_ACTIONS = ('RECEIVING', 'INTEREST', 'REFUND') # increasing balance, others decrease it
+
+    MAX_WITHDRAW = 100000 # in cents, for each withdraw
 
-    __is_logged_in = False # must not be persisted
+    LIMITED_ACTIONS = ('WITHDRAWING', 'TRANSFERING') # asked to limits checker, see watch_limits
 
+    HASHER = PasswordHasher() # for passwords of every user, replace it to tune the cost
 
+    # no __dict__ per instance, since millions of them may be loaded (all set by constructor)
+    __slots__ = (
+        '__agency',
+        '__account',
+        '__password', # encoded hash, see PasswordHasher
+        '__balance', # in cents
+        '__saved_balance', # balance when it was loaded or saved
+        '__history', # list of registers in memory, None while there's none
+        '__id', # database row id, if it's a persisted user
+        '__is_logged_in', # must not be persisted
+        '__is_dirty', # changed since it was loaded or saved?
+        '__is_password_changed', # rehashed since it was loaded or saved?
+        '__unsaved_count', # unsaved registers, they're always at the end of history
+        '__on_change', # callback for the first change after being saved
+        '__limits_checker', # callback allowing (or not) limited actions
+        '__weakref__', # see Persistence cache_size
+    )
 
-    def __init__(self, agency, account, password, balance=None, history=None):
+
+
+    def __init__(self, agency, account, password, balance=None, history=None, user_id=None):
         """ Constructor. Limited actions while it's not logged in.
 
         Args:
             agency   (str): Agency identification code.
             account  (str): Account identification code.
-            password (str): Password MD5 hash, put None if it's unknown.
-            balance  (num): Balance in $, put None if it's unknown.
+            password (str): Password hash (see PasswordHasher), put None if it's unknown.
+            balance  (int): Balance in cents, put None if it's unknown.
             history (list): A list of tuples representing balance transaction records,
                             put None if it's unknown or empty.
-                            List format: [(register string, True if it's a saved register), ...]
+                            List format: [(register, True if it's a saved register), ...]
+                            where register is (created_at, action, amount, counterparty id),
+                            see register_operation.
+            user_id  (int): Database row id, put None if it's not persisted.
         """
         self.__agency = agency
         self.__account = account
         self.__password = password
-
-        if balance is not None:
-            self.__balance = balance
-
-        if history is not None:
-            self.__history = history
+        self.__id = user_id
+        self.__balance = balance if balance is not None else 0
+        self.__saved_balance = self.__balance
+        self.__history = history or None # a list per user only once it has registers
+
+        self.__unsaved_count = 0
+        for register in history or ():
+            if not register[1]:
+                self.__unsaved_count += 1
+        self.__is_dirty = self.__unsaved_count > 0
+        self.__is_logged_in = False
+        self.__is_password_changed = False
+        self.__on_change = None
+        self.__limits_checker = None
 
 
 
-    def log_in(self, password_str):
+    def log_in(self, password_str, verified=None):
         """ Access this existent bank account, authenticating by this password string.
+        An outdated password hash (eg: legacy MD5) is replaced, and saved along with
+        other changes of this user.
 
         Args:
             password_str (str): A password in natural language.
+            verified   (tuple): Result of HASHER.verify_and_update for this password and
+                                get_password(), if it's been already computed (eg: in a
+                                thread pool), None to compute it here.
 
         Returns:
             bool: True if it was successfully authenticated, False otherwise.
 
         """
-        self.__is_logged_in = self.__password == self.str_to_hash(password_str)
+        if verified is None:
+            verified = self.HASHER.verify_and_update(password_str, self.__password)
+        self.__is_logged_in, new_password = verified
+
+        if self.__is_logged_in and new_password is not None:
+            self.__password = new_password
+            self.__is_password_changed = True
+            self.__changed()
+
         return self.__is_logged_in
 
 
 
+    def authorize(self):
+        """ Grant the rights of a logged in user without any password. Only for trusted
+        back office jobs (eg: batch files of operations), never for terminal input. """
+        self.__is_logged_in = True
+
+
+
     def log_out(self):
         """ Exit this bank account, ie, removes active rights to do some action. """
         self.__is_logged_in = False
@@ -79,33 +299,38 @@ class User(object):
         If something goes wrong, a fatal error will be triggered.
 
         Args:
-            amount        (num): amount of cash in $ to deposit.
+            amount        (int): amount of cash in cents to deposit.
             another_user (User): if it's depositing in another user account then
                                  put its instance here, otherwise leave it as None.
 
         Returns:
-            bool: True if operations has been a success ('unreturned' error otherwise).
+            bool: True if operations has been a success, False if amount isn't positive
+                  or the receiving balance can't hold it (see can_receive).
 
         """
         if another_user:
-            another_user.deposit(amount)
-            self.register_operation(self.ACTIONS['RECEIVING'], amount)
-            self.register_operation(self.ACTIONS['TRANSFERING'], amount, another_user)
+            if not another_user.deposit(amount):
+                return False
+            self.register_operation('RECEIVING', amount)
+            self.register_operation('TRANSFERING', amount, another_user)
+        elif not self.can_receive(amount):
+            return False
         else:
-            self.__balance = float(Decimal(str(self.__balance + amount)))
-            self.register_operation(self.ACTIONS['RECEIVING'], amount)
+            self.__balance += amount
+            self.__changed()
+            self.register_operation('RECEIVING', amount)
 
-        return True # False is never reached
+        return True
 
 
 
     def transfer_to(self, amount, another_user):
         """ Transfer an amount of cash from this user to another one.
-        This instance must have enough balance to do so.
+        This instance must have enough balance to do so, and amount must be positive.
         This is a private method, that requires previous authentication.
 
         Args:
-            amount       (num): Cash in $ to discount from this instance user
+            amount       (int): Cash in cents to discount from this instance user
                                 and increase in another user account.
             another_use (User): Another use to receive this transfering amount of cash.
 
@@ -113,129 +338,147 @@ class User(object):
             bool: True if cash has been transfered from this instance to another, False otherwise.
 
         """
-        if self.__balance >= amount and self.__is_logged_in:
-            self.__balance = float(Decimal(str(self.__balance - amount)))
+        if 0 < amount <= self.__balance and self.__is_logged_in and \
+                another_user.can_receive(amount) and \
+                self.__is_allowed('TRANSFERING', amount, True):
+            self.__balance -= amount
+            self.__changed()
             another_user.deposit(amount)
-            self.register_operation(self.ACTIONS['TRANSFERING'], amount, another_user)
+            self.register_operation('TRANSFERING', amount, another_user)
             return True
 
         return False
 
 
 
-    def withdraw_cash(self, qtt_100s, qtt_50s, qtt_20s):
+    def can_receive(self, amount):
+        """ Returns: bool: True if amount is a positive int of cents, and balance stays
+        within MAX_CENTS (a database INTEGER) after receiving it. """
+        return isinstance(amount, int) and not isinstance(amount, bool) and \
+            0 < amount <= MAX_CENTS - self.__balance
+
+
+
+    def withdraw_cash(self, *quantities, **kwargs):
         """ Withdraw cash. Those args should be obtained throught options_to_withdraw function.
-        Also, there are two limits: $1000,00 or the balance (the lower one).
+        Also, there are two limits: $1000,00 or the balance (the lower one), besides
+        daily and rolling ones of the limits checker, if any (see watch_limits).
         This is a private method, that requires previous authentication.
 
         Args:
-            qtt_100s (int): quantity of 100-dollar bills
-            qtt_50s  (int): quantity of 50-dollar bills
-            qtt_20s  (int): quantity of 20-dollar bills
+            *quantities      (int): quantity of each bill, in the same order of counter
+                                    denominations (default: 100s, 50s and 20-dollar bills).
+            counter (PaperMoneyCounter): keyword only, bills available in the machine,
+                                    None for the default ones.
 
         Returns:
             bool: True if the cash has been withdrawn, False otherwise.
 
         """
-        amount = PaperMoneyCounter().cash(qtt_100s, qtt_50s, qtt_20s)
-        if (self.__is_logged_in) and (amount <= self.__balance) and (amount <= 1000):
-            self.__balance = float(Decimal(str(self.__balance - amount)))
-            self.register_operation(self.ACTIONS['WITHDRAWING'], amount)
+        counter = kwargs.get('counter') or PaperMoneyCounter()
+        if not counter.is_valid(quantities):
+            return False
+
+        amount = counter.cash(*quantities)
+        if (self.__is_logged_in) and (amount <= self.__balance) and \
+                (amount <= self.MAX_WITHDRAW) and self.__is_allowed('WITHDRAWING', amount, True):
+            self.__balance -= amount
+            self.__changed()
+            self.register_operation('WITHDRAWING', amount)
             return True
 
         return False
 
 
 
-    def options_to_withdraw(self, amount):
-        """ Check options to withdraw an amount of cash. Can't be more than $1000,00 and
-        should be 'printed' in 20, 50 and/or 100-dollar bills.
+    def options_to_withdraw(self, amount, counter=None, max_options=3):
+        """ Check options to withdraw an amount of cash. Can't be more than $1000,00 (nor
+        than limits still allow, see watch_limits) and should be 'printed' in available
+        bills (by default, 20, 50 and/or 100-dollar bills).
 
         Args:
-            amount (num): Desired amount of cash to withdraw.
+            amount             (int): Desired amount of cash to withdraw, in cents.
+            counter (PaperMoneyCounter): Bills available in the machine, None for default ones.
+            max_options        (int): Maximum quantity of options.
 
         Returns:
             None: If the requirements to withdraw weren't accomplished.
             list: If the requeriments to withdraw were accomplished, a list in format
                   [[a, b, c], ...], where each sublist is an option to withdraw cash,
                   and reading as a: quantity of 100s, b: quantity of 50s,
-                  c: quantity of 20-dollar bills available and a,b,c are int.
+                  c: quantity of 20-dollar bills available and a,b,c are int
+                  (or a quantity for each one of counter denominations, in its order).
+                  Options with less bills come first.
 
         """
-        counter = PaperMoneyCounter() # aux class
-        options = [] # options to withdraw
-        remaining_cash = 0 # aux var
-
-        if (amount % 20 == 0 or amount % 50 == 0) and (amount <= 1000): # is it allowed to withdraw?
-            # prioritizing 100-dollar bills
-            qtt_100s = counter.how_many_100s(amount)
-            remaining_cash = counter.remaining_cash_without_100s(amount)
-
-            qtt_50s = counter.how_many_50s(remaining_cash)
-            remaining_cash = counter.remaining_cash_without_50s(remaining_cash)
-
-            qtt_20s = counter.how_many_20s(remaining_cash)
-            remaining_cash = counter.remaining_cash_without_20s(remaining_cash)
-
-            if counter.cash(qtt_100s, qtt_50s, qtt_20s) == amount:
-                options.append([int(qtt_100s), int(qtt_50s), int(qtt_20s)])
+        if amount <= 0 or amount > self.MAX_WITHDRAW: # is it allowed to withdraw?
+            return None
+        if not self.__is_allowed('WITHDRAWING', amount, False): # daily or rolling limits
+            return None
 
-            # prioritizing 50-dollar bills
-            qtt_100s = 0
+        counter = counter or PaperMoneyCounter() # aux class
+        options = counter.plans(amount, max_options)
 
-            qtt_50s = counter.how_many_50s(amount)
-            remaining_cash = counter.remaining_cash_without_50s(amount)
+        return options or None # if there's no way to 'print' it, it isn't allowed
 
-            qtt_20s = counter.how_many_20s(remaining_cash)
-            remaining_cash = counter.remaining_cash_without_20s(remaining_cash)
 
-            if counter.cash(qtt_100s, qtt_50s, qtt_20s) == amount:
-                if not(options[0] == [qtt_100s, qtt_50s, qtt_20s]):
-                    options.append([int(qtt_100s), int(qtt_50s), int(qtt_20s)])
 
-            # prioritizing 20-dollar bills
-            qtt_100s = 0
+    def register_operation(self, action, amount, user_to=None):
+        """ Register an operation, that this user is executing, in its own history list.
 
-            qtt_50s = 0
+        Args:
+            action   (str): An adequate key from ACTIONS dictionary attribute.
+            amount   (int): Amount of money being moved in this operation, in cents.
+            user_to (User): Another user as a target, eg: transfering money from this
+                            user to the argumented user.
 
-            qtt_20s = counter.how_many_20s(amount)
+        Returns:
+            str: Built operation string added to this user history, see format_register.
 
-            if counter.cash(qtt_100s, qtt_50s, qtt_20s) == amount:
-                if not(options[0] == [qtt_100s, qtt_50s, qtt_20s]):
-                    if not(options[1] == [qtt_100s, qtt_50s, qtt_20s]):
-                        options.append([int(qtt_100s), int(qtt_50s), int(qtt_20s)])
+        """
+        created_at = int(time.time())
+        user_to_id = user_to.get_id() if user_to else None
 
-            return options
+        if self.__history is None:
+            self.__history = []
+        self.__history.append(((created_at, action, amount, user_to_id), False))
+        self.__unsaved_count += 1
+        self.__changed()
 
-        return None # if it wasn't allowed to withdraw
+        if user_to:
+            return self.format_register(created_at, self.__account, self.__agency, action,
+                                        amount, user_to.get_account(), user_to.get_agency())
+        return self.format_register(created_at, self.__account, self.__agency, action, amount)
 
 
 
-    def register_operation(self, action, amount, user_to=None):
-        """ Register an operation, that this user is executing, in its own history list.
+    @classmethod
+    def format_register(cls, created_at, account, agency, action, amount,
+                        to_account=None, to_agency=None):
+        """ Build the displayed text of a history register.
 
         Args:
-            action   (str): An adequate value from ACTIONS dictionary attribute.
-            amount   (num): Amount of money being moved in this operation.
-            user_to (User): Another user as a target, eg: transfering money from this
-                            user to the argumented user.
+            created_at (int): Unix timestamp of the operation.
+            account    (str): Account of register owner.
+            agency     (str): Agency of register owner.
+            action     (str): A key from ACTIONS dictionary attribute.
+            amount     (int): Amount in cents.
+            to_account (str): Account of target user, if any.
+            to_agency  (str): Agency of target user, if any.
 
         Returns:
-            str: Built operation string added to this user history,
-                 in format 'd/m/y - [account]/[agency] [action] $[amount]'
+            str: In format 'd/m/y - [account]/[agency] [action] $[amount]'
                  or 'd/m/y - [account1]/[agency1] [action] $[amount] to [account2]/[agency2]'.
-
         """
-        now = datetime.now()
+        date = datetime.fromtimestamp(created_at)
 
-        register = str(now.day) + "/" + str(now.month) + "/" + str(now.year) + ' - '
-        register += self.__account + '/' + self.__agency
-        register += ' ' + action + ' $' + str(amount)
+        register = str(date.day) + "/" + str(date.month) + "/" + str(date.year) + ' - '
+        register += account + '/' + agency
+        register += ' ' + cls.ACTIONS.get(action, action) + ' $' + format_cents(amount)
 
-        if user_to:
-            register += ' to ' + user_to.get_account() + '/' + user_to.get_agency()
+        if to_account is not None:
+            register += ' to ' + to_account + '/' + to_agency
 
-        self.__history.append((register, False))
         return register
 
 
@@ -251,9 +494,11 @@ class User(object):
             bool: True if has been appended, False otherwise.
 
         """
-        register_str, is_saved = register # pylint: disable=I0011,W0612
+        register_data, is_saved = register # pylint: disable=I0011,W0612
 
         if is_saved:
+            if self.__history is None:
+                self.__history = []
             self.__history.append(register)
             return True
 
@@ -261,8 +506,119 @@ class User(object):
 
 
 
+    def watch(self, callback):
+        """ Set a function to be called when this user changes for the first time
+        after being loaded or saved (ie, when it becomes dirty).
+
+        Args:
+            callback (function): Receives this user as its only argument, None to unset.
+
+        """
+        self.__on_change = callback
+
+
+
+    def watch_limits(self, callback):
+        """ Set a function to be asked before each withdraw or transfer (see
+        LIMITED_ACTIONS), eg: by Persistence, to enforce daily and rolling limits.
+
+        Args:
+            callback (function): Receives this user, the action code, the amount in cents
+                                 and True if the operation is made right away when it's
+                                 allowed (False if it's just asked, eg: by
+                                 options_to_withdraw). Returns True to allow it.
+                                 None to unset.
+
+        """
+        self.__limits_checker = callback
+
+
+
+    def __is_allowed(self, action, amount, is_made):
+        """ Returns: bool: True if the limits checker (if any) allows this operation. """
+        return self.__limits_checker is None or \
+            self.__limits_checker(self, action, amount, is_made)
+
+
+
+    def __changed(self):
+        """ Flag this user as dirty, notifying the watcher if it was clean. """
+        if not self.__is_dirty:
+            self.__is_dirty = True
+            if self.__on_change is not None:
+                self.__on_change(self)
+
+
+
+    def is_dirty(self):
+        """ Check if there's something to save about this user.
+
+        Returns:
+            bool: True if balance or history changed since it was loaded or saved.
+        """
+        return self.__is_dirty
+
+
+
+    def get_unsaved_history(self):
+        """ Get registers that weren't saved yet.
+
+        Returns:
+            list: Registers as (created_at, action, amount, counterparty id) tuples,
+                  in the same order they've been made.
+        """
+        if self.__unsaved_count == 0:
+            return []
+
+        return [register[0] for register in self.__history[-self.__unsaved_count:]]
+
+
+
+    def is_password_changed(self):
+        """ Returns: bool: True if password hash changed since it was loaded or saved. """
+        return self.__is_password_changed
+
+
+
+    def get_balance_delta(self):
+        """ Get how much balance changed since it was loaded or saved.
+
+        Returns:
+            int: Difference in cents, negative if it has been decreased.
+        """
+        return self.__balance - self.__saved_balance
+
+
+
+    def mark_saved(self, balance=None):
+        """ Flag this user as clean, ie, balance and all registers are already saved.
+        Saved registers are released from memory, read them back through
+        Persistence.get_history when they're needed.
+
+        Args:
+            balance (int): Balance currently in database (it may have been changed by
+                           someone else), None to keep the one in memory.
+        """
+        if balance is not None:
+            self.__balance = balance
+        self.__saved_balance = self.__balance
+
+        self.__history = None
+        self.__unsaved_count = 0
+        self.__is_dirty = False
+        self.__is_password_changed = False
+
+
+
+    def get_password(self):
+        """ Returns: str: Password hash, see PasswordHasher. """
+        return self.__password
+
+
+
     def str_to_hash(self, param):
-        """ Generate a hash of a string param using md5 algorithm
+        """ Generate a hash of a string param using md5 algorithm (legacy password hashes,
+        use HASHER.hash for new ones)
 
         Args:
             param (str): The string content for hashing.
@@ -280,7 +636,7 @@ class User(object):
     def hash_password(self):
         """ Hashes the password of this instance
         (but... it's supposed to be already hashed!). """
-        self.__password = self.str_to_hash(self.__password)
+        self.__password = self.HASHER.hash(self.__password)
 
 
 
@@ -295,10 +651,10 @@ class User(object):
 
 
     def get_balance(self):
-        """ Consult balance in $.
+        """ Consult balance in cents.
 
         Returns:
-            num: This user balance, None for unauthorized operation.
+            int: This user balance, None for unauthorized operation.
         """
         if self.is_logged_in:
             return self.__balance
@@ -317,6 +673,16 @@ class User(object):
 
 
 
+    def get_id(self):
+        """ Get database row id.
+
+        Returns:
+            int: User's id, None if it's not persisted.
+        """
+        return self.__id
+
+
+
     def get_account(self):
         """ Get account id.
 
@@ -328,221 +694,2421 @@ class User(object):
 
 
     def get_history(self):
-        """ Get history of user's transactions.
+        """ Get history of user's transactions that are still in memory, ie, those made
+        since last saving (and those given to constructor). For saved registers,
+        use Persistence.get_history instead.
 
         Returns:
             list: Just a copy of User's history in constructed format.
         """
-        return self.__history[:]
+        return self.__history[:] if self.__history is not None else []
 
 # ..............................................................
 
 
 class PaperMoneyCounter(object):
-    """ Can do some counts about paper money. Aux class. """
+    """ Can do some counts about paper money, in cents. Aux class.
+    Its core is a planner of withdraws: which bills quantities sum up an amount.
+    Plans are found by dynamic programming, memoized by (amount, denomination) and shared
+    by every counter of the same denominations, so repeated amounts cost a dict lookup.
+    A cold plan costs more with more denominations (tens of ms with 6 of them), so a
+    machine should call warm_up when it starts. """
 
-    def cash(self, qtt_100s, qtt_50s, qtt_20s):
-        """ Return how much money there is by assembling 100s, 50s and 20-dollar bills quantities.
-        """
-        return (qtt_100s * 100) + (qtt_50s * 50) + (qtt_20s * 20)
+    DENOMINATIONS = (10000, 5000, 2000) # default bills: 100, 50 and 20-dollar ones
 
+    __plans_caches = OrderedDict() # (denominations, max options) -> {(amount, index): plans}
+    __PLANS_CACHES = 16 # denominations sets memoized, least recently used ones are forgotten
+    __PLANS_CACHED = 100000 # plans memoized by set, it starts over beyond that
 
+    __denominations = DENOMINATIONS
+    __step = 1000 # greatest common divisor of denominations, any plan sums a multiple of it
+    __stock_cache = None # (stock, max options, plans cache) of last limited stock asked
 
-    def how_many_100s(self, amount):
-        """ Return how many 100-dollar bill can be printed from this amount of cash.
-        """
-        return amount // 100
 
 
+    def __init__(self, denominations=None):
+        """ Constructor.
 
-    def remaining_cash_without_100s(self, amount):
-        """ Return how much cash remains after using the maximum quantity of 100-dollar bills.
+        Args:
+            denominations (seq): Values of available bills in cents (any order), None for
+                                 DENOMINATIONS. Quantities are always in decreasing
+                                 order of values.
         """
-        return amount % 100
+        if denominations is not None:
+            self.__denominations = tuple(sorted(set(denominations), reverse=True))
+
+        self.__step = 0
+        for value in self.__denominations:
+            self.__step = math.gcd(self.__step, value)
 
 
 
-    def how_many_50s(self, amount):
-        """ Return how many 50-dollar bill can be printed from this amount of cash.
+    def get_denominations(self):
+        """ Returns: tuple: Values of available bills in cents, in decreasing order. """
+        return self.__denominations
+
+
+
+    def get_step(self):
+        """ Returns: int: Greatest common divisor of denominations, in cents. """
+        return self.__step
+
+
+
+    def cash(self, *quantities):
+        """ Return how much money there is by assembling bills quantities
+        (by default, 100s, 50s and 20-dollar bills quantities).
         """
-        return amount // 50
+        total = 0
+        for quantity, value in zip(quantities, self.__denominations):
+            total += quantity * value
+        return total
 
 
 
-    def remaining_cash_without_50s(self, amount):
-        """ Return how much cash remains after using the maximum quantity of 50-dollar bills.
+    def is_valid(self, quantities):
+        """ Return True if quantities are a non-negative int for each denomination.
         """
-        return amount % 50
+        if len(quantities) != len(self.__denominations):
+            return False
+
+        for quantity in quantities:
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+                return False
+
+        return True
 
 
 
-    def how_many_20s(self, amount):
-        """ Return how many 20-dollar bill can be printed from this amount of cash.
+    def plans(self, amount, max_options=3, stock=None):
+        """ Find best ways to assemble an amount of cash in bills.
+
+        Args:
+            amount      (int): Cash in cents.
+            max_options (int): Maximum quantity of plans.
+            stock     (tuple): Maximum quantity of each bill, None for unlimited bills.
+                               Plans for a limited stock are memoized only while the
+                               same stock is asked again.
+
+        Returns:
+            list: Up to max_options lists of quantities (one for each denomination),
+                  ranked by less bills first and then by bigger bills first.
+                  Empty if this amount can't be assembled.
         """
-        return amount // 20
+        if amount % self.__step != 0:
+            return []
+
+        if stock is None:
+            key = (self.__denominations, max_options)
+            cache = self.__plans_caches.pop(key, None)
+            if cache is None or len(cache) > self.__PLANS_CACHED:
+                cache = {}
+            self.__plans_caches[key] = cache # as the most recently used one
+            if len(self.__plans_caches) > self.__PLANS_CACHES:
+                self.__plans_caches.popitem(last=False)
+        else:
+            stock = tuple(stock)
+            if self.__stock_cache is None or self.__stock_cache[:2] != (stock, max_options):
+                self.__stock_cache = (stock, max_options, {})
+            cache = self.__stock_cache[2]
+
+        plans = self.__best(amount, 0, max_options, cache, stock)
+        return [[-quantity for quantity in plan[1]] for plan in plans]
+
+
 
+    def warm_up(self, max_amount, max_options=3):
+        """ Fill plans cache for every amount up to max_amount, so no plan is computed
+        while an user is waiting (eg: when machine starts). """
+        for amount in range(self.__step, max_amount + 1, self.__step):
+            self.plans(amount, max_options)
 
 
-    def remaining_cash_without_20s(self, amount):
-        """ Return how much cash remains after using the maximum quantity of 20-dollar bills.
+
+    def __best(self, amount, index, max_options, cache, stock):
+        """ Best plans for an amount using denominations from index on, memoized.
+
+        Returns:
+            list: Up to max_options tuples (bills count, negated quantities tuple), sorted,
+                  so less bills and then bigger bills come first by natural tuple order.
         """
-        return amount % 20
+        key = (amount, index)
+        best = cache.get(key)
+        if best is not None:
+            return best
+
+        if index == len(self.__denominations):
+            best = [(0, ())] if amount == 0 else []
+        else:
+            value = self.__denominations[index]
+            most = amount // value if stock is None else min(amount // value, stock[index])
+            candidates = []
+            for quantity in range(most, -1, -1):
+                for count, rest in self.__best(amount - quantity * value, index + 1,
+                                               max_options, cache, stock):
+                    candidates.append((count + quantity, (-quantity,) + rest))
+            best = heapq.nsmallest(max_options, candidates)
+
+        cache[key] = best
+        return best
 
 
 # ..............................................................
 
 
-class Persistence(object):
-    """ Data manager for ATM bank accounts. """
+class CassetteInventory(object):
+    """ Bills inside the cassettes of an ATM. Can be used wherever a PaperMoneyCounter is
+    expected (eg: User.options_to_withdraw), but only offers what the machine can pay out.
+    Amounts that can be dispensed with current stock are kept in a bitset (bit n set means
+    n * step cents can be dispensed), so impossible amounts are rejected in O(1). """
 
-    __DB = 'users.db'
+    __atm_id = ''
+    __counter = None # denominations of cassettes
+    __stock = () # quantity of each bill, in decreasing order of denominations
+    __limit = 0 # biggest amount to dispense at once, in cents
+    __caps = () # stock, but only up to what's useful for an amount up to limit
+    __reachable = 1 # bitset of amounts that can be dispensed
+    __on_take = None # callback for taken bills
 
-    __users = {}
 
 
-    def __init__(self):
-        """ Create an instance of Persistence, and also try to execute
-        an initial script for db installation. """
-        if not self.is_installed():
-            self.install()
-        else:
-            self.load_users()
+    def __init__(self, atm_id, stock, limit=None):
+        """ Constructor.
 
+        Args:
+            atm_id (str): Identification of the machine.
+            stock (dict): Denomination in cents -> quantity of bills.
+            limit  (int): Biggest amount to dispense at once, None for User.MAX_WITHDRAW.
+        """
+        self.__atm_id = atm_id
+        self.__counter = PaperMoneyCounter(stock.keys())
+        self.__limit = limit if limit is not None else User.MAX_WITHDRAW
+        self.set_stock(stock)
 
 
-    def install(self):
-        """ Initialize database, create tables and add few rows. """
-        conn = sqlite3.connect(self.__DB)
-        cursor = conn.cursor()
 
-        # creating tables...
+    def set_stock(self, stock):
+        """ Replace quantities of bills (eg: after refilling), recomputing reachable amounts.
 
-        cursor.execute('''
-        CREATE TABLE users (
-            id       INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-            agency   TEXT NOT NULL,
-            account  TEXT NOT NULL,
-            password TEXT NOT NULL,
-            balance  REAL NOT NULL
-        );
-        ''')
+        Args:
+            stock (dict): Denomination in cents -> quantity of bills.
+        """
+        self.__stock = tuple(stock.get(value, 0) for value in self.get_denominations())
+        self.__update_reachable()
 
-        cursor.execute('''
-        CREATE TABLE history (
-            id       INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-            register TEXT NOT NULL,
-            owner    INTEGER NOT NULL
-        );
-        ''')
 
-        # inserting a few users by default (there isn't 'sign up' requirement for this app)...
 
-        hasher = User('', '', '')
-        users_data = [
-            ('A1', '00000-0', hasher.str_to_hash('pass0'), 1500),
-            ('A1', '11111-1', hasher.str_to_hash('pass1'), 400),
-            ('A2', '22222-2', hasher.str_to_hash('pass2'), 260),
-            ('A3', '33333-3', hasher.str_to_hash('pass3'), 380),
-            ('A2', '44444-4', hasher.str_to_hash('pass4'), 240),
-        ]
+    def __update_reachable(self):
+        """ Recompute reachable amounts, but only if stock got below what's needed for
+        amounts up to limit (while cassettes are full enough, it doesn't change at all). """
+        caps = tuple(min(quantity, self.__limit // value)
+                     for quantity, value in zip(self.__stock, self.get_denominations()))
+        if caps == self.__caps:
+            return
+        self.__caps = caps
 
-        cursor.executemany('''
-        INSERT INTO users (agency, account, password, balance)
-        VALUES (?, ?, ?, ?);
-        ''', users_data)
+        step = self.__counter.get_step()
+        mask = (1 << (self.__limit // step + 1)) - 1
+        reachable = 1 # only zero
+        for quantity, value in zip(caps, self.get_denominations()):
+            # bounded knapsack, splitting quantity in powers of 2: 1, 2, 4, ..., rest
+            units = value // step
+            chunk = 1
+            while quantity > 0:
+                taken = min(chunk, quantity)
+                reachable = (reachable | (reachable << (taken * units))) & mask
+                quantity -= taken
+                chunk *= 2
+        self.__reachable = reachable
 
-        conn.commit()
-        conn.close()
 
-        self.load_users()
 
+    def watch(self, callback):
+        """ Set a function to be called when bills are taken, receiving this inventory and
+        the taken quantities, None to unset. """
+        self.__on_take = callback
 
 
-    def is_installed(self):
-        """ Returns: True if database file already exists, False otherwise.
-        Doesn't guarantee that this file really is a database, ie, a valid file. """
-        return os.path.isfile(self.__DB)
 
+    def get_atm_id(self):
+        """ Returns: str: Identification of the machine. """
+        return self.__atm_id
 
 
-    def update_users(self):
-        """ Update all current users balance and history in database using list attribute.
-        There's basically no security against SQL injection, due to there's no espected
-        input string (the existents here are auto built by this script using numeric inputs) """
-        conn = sqlite3.connect(self.__DB)
-        cursor = conn.cursor()
 
-        users_data = []
-        unsaved_histories_data = []
-        for key, user in self.__users.items(): # here, key it's actually users id
-            users_data.append((user.get_balance(), key))
-            for register in user.get_history():
-                register_str, is_saved = register
-                if not is_saved:
-                    unsaved_histories_data.append((register_str, key))
+    def get_denominations(self):
+        """ Returns: tuple: Values of bills in cents, in decreasing order. """
+        return self.__counter.get_denominations()
 
-        cursor.executemany('''
-        UPDATE users
-        SET balance=?
-        WHERE id=?;
-        ''', users_data)
 
-        cursor.executemany('''
-        INSERT INTO history (register, owner)
-        VALUES (?, ?);
-        ''', unsaved_histories_data)
 
-        conn.commit()
-        conn.close()
+    def get_stock(self):
+        """ Returns: dict: Denomination in cents -> quantity of bills. """
+        return dict(zip(self.get_denominations(), self.__stock))
 
-        self.load_users() # RELOADING!!! Pew, pew, pew, pew, pew...
 
 
+    def can_dispense(self, amount):
+        """ Check in O(1) if an amount in cents can be paid out with current stock. """
+        step = self.__counter.get_step()
+        if amount < 0 or amount > self.__limit or amount % step != 0:
+            return False
+        return (self.__reachable >> (amount // step)) & 1 == 1
 
-    def load_users(self):
-        """ Load all database rows and put their data in list attribute. """
-        self.__users = {}
 
-        conn = sqlite3.connect(self.__DB)
-        cursor = conn.cursor()
 
-        cursor.execute('''
-        SELECT * FROM users;
-        ''')
+    def plans(self, amount, max_options=3):
+        """ Same as PaperMoneyCounter.plans, limited to current stock. """
+        if not self.can_dispense(amount):
+            return []
+        return self.__counter.plans(amount, max_options, self.__caps)
 
-        for row in cursor.fetchall():
-            self.__users[row[0]] = User(row[1], row[2], row[3], row[4])
 
-        cursor.execute('''
-        SELECT * FROM history;
-        ''')
 
-        for row in cursor.fetchall():
-            self.__users[row[2]].append_register((row[1], True))
+    def cash(self, *quantities):
+        """ Same as PaperMoneyCounter.cash. """
+        return self.__counter.cash(*quantities)
 
-        conn.close()
 
 
+    def is_valid(self, quantities):
+        """ Same as PaperMoneyCounter.is_valid, but also there must be enough bills. """
+        if not self.__counter.is_valid(quantities):
+            return False
+
+        for quantity, available in zip(quantities, self.__stock):
+            if quantity > available:
+                return False
+
+        return True
 
-    def find_user(self, agency=None, account=None):
-        """ Search for a registered user with these BOTH matching agency and account attributes.
-        Don't worry about SQL injection, this searching is executed with already loaded users,
-        so there's no use of SQL here.
+
+
+    def take(self, quantities):
+        """ Take bills out of cassettes (eg: after a withdraw).
 
         Args:
-            agency (str): Agency name of wanted user (recommended: use upper case only).
-            account (str): Account name of wanted user (recommended: use upper case only).
+            quantities (seq): Quantity of each bill, in decreasing order of denominations.
 
         Returns:
-            User: Found user, or None if there's no matching user.
+            bool: True if taken, False if there aren't enough bills.
+        """
+        if not self.is_valid(tuple(quantities)):
+            return False
+
+        self.__stock = tuple(available - quantity
+                             for available, quantity in zip(self.__stock, quantities))
+        self.__update_reachable()
+
+        if self.__on_take is not None:
+            self.__on_take(self, quantities)
+        return True
 
+
+# ..............................................................
+
+
+class ConcurrencyError(Exception):
+    """ Raised when changes couldn't be saved because someone else changed the same
+    users in the meantime, and applying both would leave a negative balance.
+    None of the changes are saved, they're discarded as a whole. """
+
+    def __init__(self, users):
+        """ Constructor.
+
+        Args:
+            users (list): Users whose changes have been discarded.
         """
-        if agency is None or account is None:
+        super(ConcurrencyError, self).__init__(
+            'Conflicting changes for {} user(s).'.format(len(users)))
+        self.users = users
+
+
+# ..............................................................
+
+
+class AccountSnapshot(object):
+    """ Binary file of every account (agency, account, id, balance and password hash), to
+    load users in milliseconds instead of scanning the database (see Persistence
+    snapshot_path). Records are fixed-width and sorted by (agency, account), so the file
+    is memory-mapped and searched in place, and a balance can be rewritten in place.
+    Its header has the database generation it was taken at (see Persistence.get_generation),
+    so a stale snapshot is never used. """
+
+    MAGIC = b'ATMSNAP1'
+    HEADER = struct.Struct('<8sIqq') # magic, record size, records count, generation
+    HEADER_SIZE = 64
+    RECORD = struct.Struct('<16s24sqq128s') # agency, account, id, balance, password
+    KEY_SIZE = 40 # agency and account, padded with zeros
+    BALANCE_OFFSET = 48
+    PASSWORD_OFFSET = 56
+    GENERATION_OFFSET = 20
+
+    __path = None
+    __file = None
+    __map = None # mapped file, while it's open
+    __count = 0
+
+
+
+    def __init__(self, path):
+        """ Constructor, it doesn't open the file (see open).
+
+        Args:
+            path (str): Snapshot file path.
+        """
+        self.__path = path
+
+
+
+    @classmethod
+    def key(cls, agency, account):
+        """ Returns: bytes: Searching key of an account, or None if it's too long. """
+        agency, account = agency.encode('utf-8'), account.encode('utf-8')
+        if len(agency) > 16 or len(account) > 24:
             return None
+        return agency.ljust(16, b'\0') + account.ljust(24, b'\0')
 
-        for i in self.__users:
-            user = self.__users[i]
-            if user.get_agency() == agency and user.get_account() == account:
-                return self.__users[i]
 
+
+    def open(self, generation):
+        """ Map the file, if it's valid and taken at this generation.
+
+        Returns:
+            bool: True if it's open now, False if it's missing, broken or stale.
+        """
+        self.close()
+        try:
+            snapshot_file = open(self.__path, 'r+b')
+        except OSError:
+            return False
+
+        try:
+            header = snapshot_file.read(self.HEADER_SIZE)
+            if len(header) < self.HEADER_SIZE:
+                raise ValueError('Truncated header.')
+            magic, record_size, count, taken_at = self.HEADER.unpack_from(header)
+            size = self.HEADER_SIZE + count * self.RECORD.size
+            if magic != self.MAGIC or record_size != self.RECORD.size or \
+                    taken_at != generation or os.fstat(snapshot_file.fileno()).st_size != size:
+                raise ValueError('Another format, broken or stale.')
+            self.__map = mmap.mmap(snapshot_file.fileno(), size)
+        except (ValueError, OSError):
+            snapshot_file.close()
+            return False
+
+        self.__file = snapshot_file
+        self.__count = count
+        return True
+
+
+
+    def close(self):
+        """ Unmap the file, if it's open. """
+        if self.__map is not None:
+            self.__map.close()
+            self.__file.close()
+            self.__map = None
+            self.__file = None
+
+
+
+    def is_open(self):
+        """ Returns: bool: True if it's mapped, see open. """
+        return self.__map is not None
+
+
+
+    def get_generation(self):
+        """ Returns: int: Database generation of an open snapshot. """
+        return self.HEADER.unpack_from(self.__map)[3]
+
+
+
+    def __offset(self, key):
+        """ Binary search of a key. Returns: int: Offset of its record, or None. """
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.HEADER_SIZE + middle * self.RECORD.size
+            if self.__map[offset:offset + self.KEY_SIZE] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        offset = self.HEADER_SIZE + low * self.RECORD.size
+        if low < self.__count and self.__map[offset:offset + self.KEY_SIZE] == key:
+            return offset
+        return None
+
+
+
+    def find(self, agency, account):
+        """ Search an account in an open snapshot.
+
+        Returns:
+            tuple: (id, balance, password hash), or None if it isn't there.
+        """
+        key = self.key(agency, account)
+        offset = self.__offset(key) if key is not None else None
+        if offset is None:
+            return None
+
+        _, _, user_id, balance, password = self.RECORD.unpack_from(self.__map, offset)
+        return user_id, balance, password.rstrip(b'\0').decode('utf-8')
+
+
+
+    def patch(self, users, generation_before, generation_after):
+        """ Rewrite balances and passwords of saved users in place, and take the snapshot
+        as of the new generation. Records are written before the header, so a crash in the
+        middle leaves a stale (but never a wrong) snapshot.
+
+        Args:
+            users           (list): Saved users.
+            generation_before (int): Database generation before saving them.
+            generation_after  (int): Database generation after saving them.
+
+        Returns:
+            bool: True if it's been patched, False if it's stale now (eg: someone else
+                  changed database, or there's a new user), so it must be written again.
+        """
+        if self.get_generation() != generation_before:
+            return False
+
+        for user in users:
+            key = self.key(user.get_agency(), user.get_account())
+            offset = self.__offset(key) if key is not None else None
+            password = user.get_password().encode('utf-8')
+            if offset is None or len(password) > 128:
+                return False
+            struct.pack_into('<q', self.__map, offset + self.BALANCE_OFFSET, user.get_balance())
+            struct.pack_into('128s', self.__map, offset + self.PASSWORD_OFFSET, password)
+
+        struct.pack_into('<q', self.__map, self.GENERATION_OFFSET, generation_after)
+        return True
+
+
+
+    def write(self, rows, generation):
+        """ Write a new snapshot, replacing the file atomically (it's closed first).
+
+        Args:
+            rows   (iterable): (id, agency, account, password, balance) of every user,
+                               ordered by agency and account.
+            generation  (int): Database generation they've been read at.
+
+        Returns:
+            bool: True if it's been written, False if any user doesn't fit in a record
+                  (agency up to 16 bytes, account up to 24 and password hash up to 128).
+        """
+        self.close()
+        temp_path = self.__path + '.tmp'
+        count = 0
+        with open(temp_path, 'wb') as out_file:
+            out_file.write(bytes(self.HEADER_SIZE)) # the real one at the end, once complete
+            for user_id, agency, account, password, balance in rows:
+                key = self.key(agency, account)
+                password = password.encode('utf-8')
+                if key is None or len(password) > 128:
+                    break
+                out_file.write(self.RECORD.pack(key[:16], key[16:], user_id, balance, password))
+                count += 1
+            else:
+                out_file.seek(0)
+                out_file.write(self.HEADER.pack(self.MAGIC, self.RECORD.size, count, generation))
+                out_file.flush()
+                os.fsync(out_file.fileno())
+                os.replace(temp_path, self.__path)
+                return True
+
+        os.remove(temp_path)
+        return False
+
+
+# ..............................................................
+
+
+class Persistence(object):
+    """ Data manager for ATM bank accounts.
+    It keeps a long-lived connection to the database, so it should be closed when it's
+    not needed anymore (or used in a 'with' statement). """
+
+    __DB = 'users.db'
+    __SCHEMA_VERSION = 11 # PRAGMA user_version, see upgrade method
+
+    __PRAGMAS = ( # executed for every new connection
+        'PRAGMA journal_mode=WAL;', # readers don't block writer, and less fsyncs per commit
+        'PRAGMA synchronous=NORMAL;', # durable enough in WAL mode, fsync only at checkpoints
+        'PRAGMA cache_size=-16000;', # in KiB, ie, 16MB of page cache
+        'PRAGMA temp_store=MEMORY;',
+        'PRAGMA busy_timeout=5000;', # in ms, waiting for another process writing
+    )
+
+    __CACHED_STATEMENTS = 256 # parameterized statements kept compiled by the connection
+
+    __HISTORY_QUERY = '''
+        SELECT history.id, history.created_at, history.action, history.amount,
+               counterparty.account, counterparty.agency, history.counterparty
+        FROM history
+        LEFT JOIN users AS counterparty ON counterparty.id=history.counterparty
+        WHERE history.owner=?''' # rows of an user's history, see __with_foreign_user
+
+    CURSOR_FACTORY = sqlite3.Cursor # class of every cursor, replaced to trace them, see metrics.py
+
+    STATEMENT_FIELDS = ('id', 'date', 'action', 'amount', 'to_account', 'to_agency', 'register')
+
+    ANY = '*' # agency or account of limits applying to any of them, see set_limit
+    DAY = 0 # window of limits over the calendar day (local time), see set_limit
+
+    __USAGE_BUCKET_S = 900 # usage is added up by quarters of hour (local midnights start one)
+    __USAGE_CACHED = 10000 # usage aggregates kept in memory, least recently used ones are forgotten
+
+    __users = {} # users id -> user, least recently used first if cache_size is set
+    __index = {} # (agency, account) -> users id, for constant time searching
+    __dirty = {} # users id -> user, only those changed since last saving
+    __cache_size = None # most users kept in memory, None to load every user at once
+    __referenced = None # users id -> user still referenced anywhere, even if evicted
+    __snapshot = None # AccountSnapshot, if snapshot_path is set
+    __inventories = {} # ATM id -> CassetteInventory, those loaded by load_inventory
+    __taken_bills = {} # (ATM id, denomination) -> quantity, taken since last saving
+    __prepared = None # id of the two-phase commit whose changes are prepared, see prepare
+    __foreign_users = None # function finding users of other databases, see set_foreign_users
+    __limits = {} # (agency, account, action) -> {window: max amount}, see set_limit
+    __usage = {} # (agency, account, action) -> {bucket: amount}, saved usage of recent buckets
+    __usage_kept_s = 86400 # usage older than this isn't needed by any limit
+    __unsaved_usage = {} # (agency, account, action, bucket) -> amount allowed since saving
+    __unsaved_totals = {} # (agency, account, action) -> amount allowed since saving
+    __watchers = None # callbacks given to every loaded user, see __watch
+
+    __db_path = __DB
+    __concurrent = False # sharing database with other processes? see update_users
+    __durable = False # fsync every commit?
+    __conn = None # long-lived connection, opened on demand
+    __lock = None # the connection is shared by any thread using this instance
+
+
+    def __init__(self, db_path=None, concurrent=False, durable=False, preload=True,
+                 cache_size=None, snapshot_path=None):
+        """ Create an instance of Persistence, and also try to execute
+        an initial script for db installation.
+
+        Args:
+            db_path     (str): Database file path, None for default 'users.db'.
+            concurrent (bool): True if other processes may change the same database,
+                               so balances are saved as atomic conditional increments
+                               instead of being overwritten.
+            durable    (bool): True to fsync every commit (PRAGMA synchronous=FULL), so
+                               saved changes survive even a power loss. Each commit costs
+                               more, so it pays off with many changes per commit (eg: see
+                               GroupCommit in server.py).
+            preload    (bool): False to not load users, eg: for back office jobs working
+                               straight on database (find_user finds nobody then).
+            cache_size  (int): Load users on demand instead, by find_user, keeping at most
+                               this quantity of clean ones in memory (least recently used
+                               ones are evicted), so opening costs the same whatever the
+                               quantity of users. None to load every user at once.
+            snapshot_path (str): File of an AccountSnapshot, to load every user from it
+                               when it's up to date (users are built on demand, from the
+                               mapped file), instead of scanning database. It's kept up to
+                               date by update_users, or written again by close.
+
+        Raises:
+            ValueError: If cache_size isn't positive, or it's set along with snapshot_path.
+        """
+        if cache_size is not None and cache_size < 1:
+            raise ValueError('Cache size must be positive, not {}.'.format(cache_size))
+        if cache_size is not None and snapshot_path is not None:
+            raise ValueError('A snapshot is for loading every user, not a cache of them.')
+
+        if db_path is not None:
+            self.__db_path = db_path
+        self.__concurrent = concurrent
+        self.__durable = durable
+        self.__cache_size = cache_size
+
+        self.__lock = threading.RLock()
+        self.__users = OrderedDict() if cache_size is not None else {}
+        self.__index = {}
+        self.__dirty = {}
+        self.__referenced = weakref.WeakValueDictionary()
+        self.__inventories = {}
+        self.__taken_bills = {}
+        self.__limits = {}
+        self.__usage = OrderedDict()
+        self.__unsaved_usage = {}
+        self.__unsaved_totals = {}
+        self.__watchers = (self.__user_changed, self.__within_limits) # bound once, not per user
+        if snapshot_path is not None:
+            self.__snapshot = AccountSnapshot(snapshot_path)
+
+        if not self.is_installed():
+            self.install()
+        else:
+            self.upgrade()
+            if preload and cache_size is None:
+                self.load_users()
+        self.__load_limits()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+    def __connection(self):
+        """ Get the long-lived connection, opening and tuning it on first use.
+        It's in autocommit mode, transactions are explicitly made by transaction method. """
+        if self.__conn is None:
+            self.__conn = self.__open_connection()
+
+        return self.__conn
+
+
+
+    def __open_connection(self):
+        """ Returns: Connection: A new tuned connection, in autocommit mode. """
+        conn = sqlite3.connect(self.__db_path,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=self.__CACHED_STATEMENTS)
+        for pragma in self.__PRAGMAS:
+            conn.execute(pragma)
+        if self.__durable:
+            conn.execute('PRAGMA synchronous=FULL;')
+        return conn
+
+
+
+    def close(self):
+        """ Close database connection. It's reopened if this instance is used again.
+        A stale snapshot (see snapshot_path) is written again first. """
+        with self.__lock:
+            if self.__snapshot is not None:
+                if not self.__snapshot.is_open() or \
+                        self.__snapshot.get_generation() != self.get_generation():
+                    self.write_snapshot()
+                self.__snapshot.close()
+
+            if self.__conn is not None:
+                self.__conn.close()
+                self.__conn = None
+
+
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """ Run a block of statements in a single transaction, committed at the end of block
+        or rolled back if anything is raised from it. Other threads using this instance wait.
+
+        Args:
+            immediate (bool): True to take database write lock right at the beginning,
+                              instead of at the first write statement.
+
+        Yields:
+            Cursor: Where to execute statements.
+        """
+        with self.__lock:
+            cursor = self.__connection().cursor(self.CURSOR_FACTORY)
+            cursor.execute('BEGIN IMMEDIATE;' if immediate else 'BEGIN;')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK;')
+                raise
+            cursor.execute('COMMIT;')
+
+
+
+    def query(self, sql, params=()):
+        """ Execute a single reading statement, out of any explicit transaction.
+
+        Args:
+            sql    (str): Parameterized statement, keep it constant so it's compiled once.
+            params (seq): Its parameters.
+
+        Returns:
+            list: All resulting rows.
+        """
+        with self.__lock:
+            cursor = self.__connection().cursor(self.CURSOR_FACTORY)
+            return cursor.execute(sql, params).fetchall()
+
+
+
+    def install(self):
+        """ Initialize database, create tables and add few rows. """
+        with self.transaction() as cursor:
+            self.create_schema(cursor)
+
+            # inserting a few users by default (there isn't 'sign up' requirement for this app)...
+
+            hasher = User.HASHER
+            users_data = [
+                ('A1', '00000-0', hasher.hash('pass0'), 150000),
+                ('A1', '11111-1', hasher.hash('pass1'), 40000),
+                ('A2', '22222-2', hasher.hash('pass2'), 26000),
+                ('A3', '33333-3', hasher.hash('pass3'), 38000),
+                ('A2', '44444-4', hasher.hash('pass4'), 24000),
+            ]
+
+            cursor.executemany('''
+            INSERT INTO users (agency, account, password, balance)
+            VALUES (?, ?, ?, ?);
+            ''', users_data)
+
+            self.create_checkpoints(cursor)
+
+        self.load_users()
+
+
+
+    @classmethod
+    def create_schema(cls, cursor, indexes=True):
+        """ Create tables of current schema version, in an empty database.
+
+        Args:
+            cursor (Cursor): A cursor inside an open transaction.
+            indexes  (bool): False to create them later, see create_indexes (eg: after
+                             a bulk load, it's faster to build them at once).
+        """
+        cursor.execute('''
+        CREATE TABLE users (
+            id       INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            agency   TEXT NOT NULL,
+            account  TEXT NOT NULL,
+            password TEXT NOT NULL,
+            balance  INTEGER NOT NULL,
+            version  INTEGER NOT NULL DEFAULT 0
+        );
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE history (
+            id           INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            owner        INTEGER NOT NULL,
+            created_at   INTEGER NOT NULL,
+            action       TEXT NOT NULL,
+            amount       INTEGER NOT NULL,
+            counterparty INTEGER
+        );
+        ''')
+
+        cls.__create_cassettes(cursor)
+        cls.__create_checkpoints(cursor)
+        cls.__create_eod_runs(cursor)
+        cls.__create_eod_posted(cursor)
+        cls.__create_prepared(cursor)
+        cls.__create_generations(cursor)
+        cls.__create_limits(cursor)
+
+        if indexes:
+            cls.create_indexes(cursor)
+        cursor.execute('PRAGMA user_version = {};'.format(cls.__SCHEMA_VERSION))
+
+
+
+    def upgrade(self):
+        """ Migrate an older database, step by step, until it reaches current schema version.
+        Version 0: original schema, without indexes.
+        Version 1: history rows have a created_at timestamp (legacy ones get it from their
+                   register date), indexes by (agency, account) and by history (owner, id).
+        Version 2: users rows have a version, increased every time they're updated.
+        Version 3: users balance is an INTEGER of cents, instead of a REAL in $.
+        Version 4: history has typed columns (action code, amount in cents, counterparty id)
+                   instead of preformatted register strings, indexed by (owner, created_at).
+        Version 5: cassettes table, with the quantity of bills inside each ATM.
+        Version 6: checkpoints and reconciliations tables, see reconcile (current balances
+                   are taken as the first checkpoints).
+        Version 7: reconciliations may be of a single agency, eod_runs table.
+        Version 8: prepared table, of changes waiting for a two-phase commit decision.
+        Version 9: generations table, counting changes of users by triggers.
+        Version 10: limits and usage tables, see set_limit.
+        Version 11: eod_posted table, of the last day posted to each account by each end of
+                    day job (taken from eod_runs of older runs).
+        """
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute('PRAGMA user_version;')
+            version = cursor.fetchone()[0]
+
+            if version < 1:
+                cursor.execute('''
+                ALTER TABLE history ADD COLUMN created_at INTEGER;
+                ''')
+
+                dates_data = []
+                for row in cursor.execute('SELECT id, register FROM history;').fetchall():
+                    dates_data.append((self.__register_timestamp(row[1]), row[0]))
+
+                cursor.executemany('''
+                UPDATE history
+                SET created_at=?
+                WHERE id=?;
+                ''', dates_data)
+
+            if version < 2:
+                cursor.execute('''
+                ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+                ''')
+
+            if version < 3: # column affinity can't be changed, so the table is rebuilt
+                cursor.execute('''
+                CREATE TABLE users_in_cents (
+                    id       INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                    agency   TEXT NOT NULL,
+                    account  TEXT NOT NULL,
+                    password TEXT NOT NULL,
+                    balance  INTEGER NOT NULL,
+                    version  INTEGER NOT NULL DEFAULT 0
+                );
+                ''')
+
+                cursor.execute('''
+                INSERT INTO users_in_cents (id, agency, account, password, balance, version)
+                SELECT id, agency, account, password, CAST(ROUND(balance * 100) AS INTEGER), version
+                FROM users;
+                ''')
+
+                cursor.execute('DROP TABLE users;')
+                cursor.execute('ALTER TABLE users_in_cents RENAME TO users;')
+
+            if version < 4:
+                self.__structure_history(cursor)
+
+            if version < 5:
+                self.__create_cassettes(cursor)
+
+            if version < 6:
+                self.__create_checkpoints(cursor) # already with version 7 columns
+                self.create_checkpoints(cursor)
+            elif version < 7:
+                cursor.execute('''
+                ALTER TABLE reconciliations ADD COLUMN agency TEXT;
+                ''')
+
+            if version < 7:
+                self.__create_eod_runs(cursor)
+
+            if version < 8:
+                self.__create_prepared(cursor)
+
+            if version < 9:
+                self.__create_generations(cursor)
+
+            if version < 10:
+                self.__create_limits(cursor)
+
+            if version < 11:
+                self.__create_eod_posted(cursor)
+                self.__posted_from_runs(cursor)
+
+            self.create_indexes(cursor)
+            cursor.execute('PRAGMA user_version = {};'.format(self.__SCHEMA_VERSION))
+
+
+
+    @staticmethod
+    def __create_cassettes(cursor):
+        """ Create the table of bills inside each ATM. """
+        cursor.execute('''
+        CREATE TABLE cassettes (
+            atm_id       TEXT NOT NULL,
+            denomination INTEGER NOT NULL,
+            quantity     INTEGER NOT NULL,
+            PRIMARY KEY (atm_id, denomination)
+        );
+        ''')
+
+
+
+    @staticmethod
+    def __create_checkpoints(cursor):
+        """ Create the tables of balance checkpoints and of reconciliations. """
+        cursor.execute('''
+        CREATE TABLE checkpoints (
+            owner      INTEGER NOT NULL PRIMARY KEY,
+            history_id INTEGER NOT NULL,
+            balance    INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            mismatch   INTEGER NOT NULL DEFAULT 0
+        );
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE reconciliations (
+            id           INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            history_id   INTEGER NOT NULL,
+            created_at   INTEGER NOT NULL,
+            accounts     INTEGER NOT NULL,
+            history_rows INTEGER NOT NULL,
+            mismatches   INTEGER NOT NULL,
+            agency       TEXT -- NULL for all agencies
+        );
+        ''')
+
+
+
+    @staticmethod
+    def __create_eod_runs(cursor):
+        """ Create the table of end of day jobs run, by day and shard (see eod_posted). """
+        cursor.execute('''
+        CREATE TABLE eod_runs (
+            day        TEXT NOT NULL, -- business day, YYYY-MM-DD
+            job        TEXT NOT NULL,
+            shard      TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (day, job, shard)
+        );
+        ''')
+
+
+
+    @staticmethod
+    def __create_eod_posted(cursor):
+        """ Create the table of the last day posted to each account by each end of day
+        job (see eod.py), so an account never gets a day twice, whatever the sharding. """
+        cursor.execute('''
+        CREATE TABLE eod_posted (
+            owner INTEGER NOT NULL,
+            job   TEXT NOT NULL,
+            day   TEXT NOT NULL, -- business day, YYYY-MM-DD
+            PRIMARY KEY (owner, job)
+        ) WITHOUT ROWID;
+        ''')
+
+
+
+    @staticmethod
+    def __posted_from_runs(cursor):
+        """ Fill eod_posted from older eod_runs, whose shards are 'agency:AGENCY' or
+        'ids:FIRST-LAST' (see eod.py), oldest days first so the last one is kept. """
+        runs = cursor.execute('''
+        SELECT day, job, shard FROM eod_runs ORDER BY day;
+        ''').fetchall()
+        for day, job, shard in runs:
+            kind, _, value = shard.partition(':')
+            if kind == 'agency':
+                condition, params = 'agency=?', (value,)
+            elif kind == 'ids':
+                first, last = value.split('-')
+                condition, params = 'id BETWEEN ? AND ?', (int(first), int(last))
+            else:
+                continue
+            cursor.execute('''
+            INSERT OR REPLACE INTO eod_posted (owner, job, day)
+            SELECT id, ?, ? FROM users WHERE {};
+            '''.format(condition), (job, day) + params)
+
+
+
+    @staticmethod
+    def __create_prepared(cursor):
+        """ Create the table of changes prepared for a two-phase commit, see prepare. """
+        cursor.execute('''
+        CREATE TABLE prepared (
+            txn        INTEGER NOT NULL PRIMARY KEY, -- id given by the coordinator
+            changes    TEXT NOT NULL, -- JSON, what to apply or to refund, see prepare
+            created_at INTEGER NOT NULL
+        );
+        ''')
+
+
+
+    @staticmethod
+    def __create_generations(cursor):
+        """ Create the table of generations, see get_generation (triggers increasing them
+        are made by create_indexes, so bulk loads don't fire them). """
+        cursor.execute('''
+        CREATE TABLE generations (
+            name  TEXT NOT NULL PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        ''')
+        cursor.execute("INSERT INTO generations (name, value) VALUES ('users', 0);")
+
+
+
+    @staticmethod
+    def __create_limits(cursor):
+        """ Create the tables of limits of withdraws and transfers, and of their usage. """
+        cursor.execute('''
+        CREATE TABLE limits (
+            agency     TEXT NOT NULL, -- '*' for any agency
+            account    TEXT NOT NULL, -- '*' for any account, '' for the agency as a whole
+            action     TEXT NOT NULL, -- WITHDRAWING or TRANSFERING
+            window_s   INTEGER NOT NULL, -- 0 for the calendar day
+            max_amount INTEGER NOT NULL, -- in cents
+            PRIMARY KEY (agency, account, action, window_s)
+        );
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE usage (
+            agency  TEXT NOT NULL,
+            account TEXT NOT NULL, -- '' for the agency as a whole
+            action  TEXT NOT NULL,
+            bucket  INTEGER NOT NULL, -- created_at of operations divided by bucket size
+            amount  INTEGER NOT NULL, -- in cents
+            PRIMARY KEY (agency, account, action, bucket)
+        ) WITHOUT ROWID;
+        ''')
+
+
+
+    @staticmethod
+    def create_checkpoints(cursor):
+        """ Take current balances as trusted checkpoints of every account, and as a
+        reconciliation up to the last history row (eg: after installing or bulk loading).
+
+        Args:
+            cursor (Cursor): A cursor inside an open transaction.
+        """
+        now = int(time.time())
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM history;')
+        history_id = cursor.fetchone()[0]
+
+        cursor.execute('''
+        INSERT OR REPLACE INTO checkpoints (owner, history_id, balance, created_at)
+        SELECT id, ?, balance, ? FROM users;
+        ''', (history_id, now))
+
+        cursor.execute('''
+        INSERT INTO reconciliations (history_id, created_at, accounts, history_rows, mismatches)
+        SELECT ?, ?, COUNT(*), 0, 0 FROM users;
+        ''', (history_id, now))
+
+
+
+    def __structure_history(self, cursor):
+        """ Migrate history registers strings to typed columns (rebuilding the table). """
+        cursor.execute('''
+        CREATE TABLE history_structured (
+            id           INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            owner        INTEGER NOT NULL,
+            created_at   INTEGER NOT NULL,
+            action       TEXT NOT NULL,
+            amount       INTEGER NOT NULL,
+            counterparty INTEGER
+        );
+        ''')
+
+        users_ids = {}
+        for row in cursor.execute('SELECT id, agency, account FROM users;').fetchall():
+            users_ids[(row[1], row[2])] = row[0]
+        actions = dict((text, code) for code, text in User.ACTIONS.items())
+
+        reader = self.__connection().cursor(self.CURSOR_FACTORY)
+        reader.execute('SELECT id, owner, created_at, register FROM history;')
+        rows = reader.fetchmany(10000)
+        while rows:
+            history_data = []
+            for row in rows:
+                action, amount, counterparty = self.__parse_register(row[3], actions, users_ids)
+                history_data.append((row[0], row[1], row[2] or 0, action, amount, counterparty))
+
+            cursor.executemany('''
+            INSERT INTO history_structured (id, owner, created_at, action, amount, counterparty)
+            VALUES (?, ?, ?, ?, ?, ?);
+            ''', history_data)
+            rows = reader.fetchmany(10000)
+
+        cursor.execute('DROP TABLE history;')
+        cursor.execute('ALTER TABLE history_structured RENAME TO history;')
+
+
+
+    @staticmethod
+    def __parse_register(register_str, actions, users_ids):
+        """ Parse a legacy register string,
+        'd/m/y - [account]/[agency] [action] $[amount]( to [account2]/[agency2])'.
+
+        Args:
+            register_str (str): The legacy register.
+            actions     (dict): ACTIONS texts -> codes.
+            users_ids   (dict): (agency, account) -> users id.
+
+        Returns:
+            tuple: (action code, amount in cents, counterparty id or None),
+                   or ('UNKNOWN', 0, None) if it can't be parsed.
+        """
+        try:
+            operation = register_str.split(' - ', 1)[1].split(' ', 1)[1]
+            action_text, amount_text = operation.rsplit(' $', 1)
+            counterparty = None
+            if ' to ' in amount_text:
+                amount_text, user_to = amount_text.split(' to ', 1)
+                to_account, to_agency = user_to.rsplit('/', 1)
+                counterparty = users_ids.get((to_agency, to_account))
+            return actions[action_text], to_cents(amount_text), counterparty
+        except (IndexError, KeyError, ValueError):
+            return 'UNKNOWN', 0, None
+
+
+
+    @staticmethod
+    def __register_timestamp(register_str):
+        """ Get unix timestamp of a legacy register string, in 'd/m/y - ...' format,
+        or None if it can't be parsed. """
+        try:
+            day, month, year = register_str.split(' - ', 1)[0].split('/')
+            return int(time.mktime((int(year), int(month), int(day), 0, 0, 0, 0, 0, -1)))
+        except (ValueError, OverflowError):
+            return None
+
+
+
+    @staticmethod
+    def create_indexes(cursor):
+        """ Create database indexes, if they don't exist yet (so older databases get them too),
+        and triggers counting changes of users, see get_generation.
+
+        Args:
+            cursor (Cursor): A cursor inside an open transaction.
+
+        """
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS users_agency_account
+        ON users (agency, account);
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS history_owner_created_at
+        ON history (owner, created_at);
+        ''')
+
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_{}_generation AFTER {} ON users
+            BEGIN
+                UPDATE generations SET value=value+1 WHERE name='users';
+            END;
+            '''.format(event.lower(), event))
+
+
+
+    def add_user(self, agency, account, password, balance=0):
+        """ Register a new user in database and also in the loaded ones.
+
+        Args:
+            agency   (str): Agency identification code.
+            account  (str): Account identification code.
+            password (str): Password hash, see PasswordHasher.hash.
+            balance  (int): Initial balance in cents.
+
+        Returns:
+            User: The new user, or None if this agency and account are already taken.
+
+        """
+        if (agency, account) in self.__index:
+            return None
+
+        try:
+            with self.transaction() as cursor:
+                cursor.execute('''
+                INSERT INTO users (agency, account, password, balance)
+                VALUES (?, ?, ?, ?);
+                ''', (agency, account, password, balance))
+                user_id = cursor.lastrowid
+
+                cursor.execute('''
+                INSERT INTO checkpoints (owner, history_id, balance, created_at)
+                SELECT ?, COALESCE(MAX(id), 0), ?, ? FROM history;
+                ''', (user_id, balance, int(time.time())))
+        except sqlite3.IntegrityError: # taken by someone else, since last loading
+            return None
+
+        user = User(agency, account, password, balance, [], user_id)
+        self.__watch(user)
+        self.__keep(user)
+        return user
+
+
+
+    def is_installed(self):
+        """ Returns: True if database file already exists, False otherwise.
+        Doesn't guarantee that this file really is a database, ie, a valid file. """
+        return os.path.isfile(self.__db_path)
+
+
+
+    def update_users(self):
+        """ Update changed users balance, password and unsaved history in database, in a
+        single transaction. Only dirty users are visited, so it costs as much as the changes do.
+        There's basically no security against SQL injection, due to there's no espected
+        input string (the existents here are auto built by this script using numeric inputs)
+
+        In concurrent mode, balances are increased by their changes (instead of overwritten),
+        with the condition they don't become negative, so changes made by other processes
+        aren't lost and a transfer is saved as a whole or not at all.
+        Bills taken from cassettes are always saved this way, in this same transaction,
+        and so is the usage of limits (see set_limit).
+
+        Raises:
+            ConcurrencyError: If any balance (in concurrent mode) or cassette would become
+                              negative, or (in concurrent mode) any limit would be exceeded
+                              along with other processes' operations. Nothing is saved and
+                              every unsaved change is discarded (balances and cassettes are
+                              reloaded from database).
+        """
+        if not self.__dirty and not self.__taken_bills:
+            return
+
+        unsaved_histories_data = []
+        for key, user in self.__dirty.items(): # here, key it's actually users id
+            for register in user.get_unsaved_history():
+                unsaved_histories_data.append((key,) + register)
+
+        snapshot = self.__snapshot if self.__snapshot is not None and \
+            self.__snapshot.is_open() else None
+        try:
+            with self.transaction(immediate=True) as cursor:
+                if snapshot is not None:
+                    generations = [self.__read_generation(cursor)]
+
+                if self.__concurrent:
+                    self.__save_increments(cursor)
+                else:
+                    cursor.executemany('''
+                    UPDATE users
+                    SET balance=?, version=version+1
+                    WHERE id=?;
+                    ''', [(user.get_balance(), key) for key, user in self.__dirty.items()])
+
+                cursor.executemany('''
+                INSERT INTO history (owner, created_at, action, amount, counterparty)
+                VALUES (?, ?, ?, ?, ?);
+                ''', unsaved_histories_data)
+
+                cursor.executemany('''
+                UPDATE users
+                SET password=?
+                WHERE id=?;
+                ''', [(user.get_password(), key) for key, user in self.__dirty.items()
+                      if user.is_password_changed()])
+
+                self.__save_taken_bills(cursor)
+                usage = self.__save_usage(cursor)
+
+                saved_balances = {}
+                if self.__concurrent: # with others' changes
+                    saved_balances = self.__read_balances(self.__dirty.keys())
+
+                if snapshot is not None:
+                    generations.append(self.__read_generation(cursor))
+        except ConcurrencyError:
+            # already rolled back, discarding every change (eg: both sides of a transfer)
+            self.discard_changes()
+            raise
+
+        for key, user in self.__dirty.items(): # no reloading, memory already is up to date
+            user.mark_saved(saved_balances.get(key))
+
+        if snapshot is not None and not snapshot.patch(self.__dirty.values(), *generations):
+            snapshot.close() # stale, it's written again when closing
+
+        self.__usage_saved(usage)
+        self.__dirty = {}
+        self.__taken_bills = {}
+
+
+
+    def has_changes(self):
+        """ Returns: bool: True if there's anything to save, see update_users. """
+        return bool(self.__dirty or self.__taken_bills)
+
+
+
+    def discard_changes(self):
+        """ Forget every unsaved change: balances and cassettes are reloaded from database,
+        unsaved history is dropped (and usage of limits is read again on demand). """
+        balances = self.__read_balances(self.__dirty.keys())
+        for key, user in self.__dirty.items():
+            user.mark_saved(balances[key])
+        self.__dirty = {}
+        self.__taken_bills = {}
+        self.__usage = OrderedDict()
+        self.__unsaved_usage = {}
+        self.__unsaved_totals = {}
+        for inventory in self.__inventories.values():
+            self.__reload_inventory(inventory)
+
+
+
+    def prepare(self, txn_id):
+        """ Save unsaved changes as the first phase of a two-phase commit, along with other
+        databases (see sharding.py). Money leaving this database is held right now: debits
+        (users whose balance decreases, with their history, and bills taken from cassettes)
+        are saved as conditional decrements, along with usage of limits. Credits are kept
+        in prepared table, until the coordinator decides: commit_prepared applies them,
+        abort_prepared refunds debits (and gives usage back).
+        Unsaved changes are kept in memory until then. Both phases are fsynced, whatever
+        durable is, since a lost prepared debit couldn't be refunded.
+
+        Args:
+            txn_id (int): Identification of the transaction, given by the coordinator.
+
+        Raises:
+            ConcurrencyError: If any balance or cassette would become negative. Nothing is
+                              prepared and every unsaved change is discarded, the
+                              transaction must be aborted in the other databases.
+        """
+        debits, credits = {}, {}
+        for key, user in self.__dirty.items():
+            if user.get_balance_delta() < 0:
+                debits[key] = user
+            else:
+                credits[key] = user
+
+        changes = {
+            'credits': [[key, user.get_balance_delta()] for key, user in credits.items()],
+            'history': [[key] + list(register) for key, user in credits.items()
+                        for register in user.get_unsaved_history()],
+            'refunds': [[key, -user.get_balance_delta()] for key, user in debits.items()],
+            'bills': [[atm_id, denomination, quantity]
+                      for (atm_id, denomination), quantity in self.__taken_bills.items()],
+        }
+
+        try:
+            with self.__fsyncing(), self.transaction(immediate=True) as cursor:
+                for key, user in debits.items():
+                    cursor.execute('''
+                    UPDATE users
+                    SET balance=balance+?, version=version+1
+                    WHERE id=? AND balance+?>=0;
+                    ''', (user.get_balance_delta(), key, user.get_balance_delta()))
+                    if cursor.rowcount == 0:
+                        raise ConcurrencyError(list(self.__dirty.values()))
+
+                cursor.executemany('''
+                INSERT INTO history (owner, created_at, action, amount, counterparty)
+                VALUES (?, ?, ?, ?, ?);
+                ''', [(key,) + register for key, user in debits.items()
+                      for register in user.get_unsaved_history()])
+
+                cursor.executemany('''
+                UPDATE users
+                SET password=?
+                WHERE id=?;
+                ''', [(user.get_password(), key) for key, user in self.__dirty.items()
+                      if user.is_password_changed()])
+
+                self.__save_taken_bills(cursor)
+                usage = self.__save_usage(cursor) # given back by abort_prepared, if aborted
+                changes['usage'] = [list(key) + [amount] for key, amount in usage.items()]
+
+                cursor.execute('''
+                INSERT INTO prepared (txn, changes, created_at) VALUES (?, ?, ?);
+                ''', (txn_id, json.dumps(changes), int(time.time())))
+        except ConcurrencyError:
+            self.discard_changes()
+            raise
+
+        self.__usage_saved(usage)
+        self.__prepared = txn_id
+
+
+
+    def commit_prepared(self, txn_id):
+        """ Second phase of a committed two-phase commit: apply its prepared credits.
+        It's idempotent, so it can be retried (eg: recovering after a crash).
+
+        Args:
+            txn_id (int): Identification of the transaction, see prepare.
+
+        Returns:
+            bool: True if it's been applied now, False if it wasn't prepared here.
+        """
+        with self.__fsyncing(), self.transaction(immediate=True) as cursor:
+            changes = self.__pop_prepared(cursor, txn_id)
+            if changes is not None:
+                cursor.executemany('''
+                UPDATE users
+                SET balance=balance+?, version=version+1
+                WHERE id=?;
+                ''', [(delta, key) for key, delta in changes['credits']])
+
+                cursor.executemany('''
+                INSERT INTO history (owner, created_at, action, amount, counterparty)
+                VALUES (?, ?, ?, ?, ?);
+                ''', changes['history'])
+
+        if self.__prepared == txn_id: # memory already is up to date, but for others' changes
+            saved_balances = self.__read_balances(self.__dirty.keys())
+            for key, user in self.__dirty.items():
+                user.mark_saved(saved_balances[key])
+            self.__dirty = {}
+            self.__taken_bills = {}
+            self.__prepared = None
+
+        return changes is not None
+
+
+
+    def abort_prepared(self, txn_id):
+        """ Second phase of an aborted two-phase commit: refund its held debits (as REFUND
+        history registers, so history still explains balances) and bills, and give usage of
+        limits back. Unsaved changes prepared by this instance are discarded. It's
+        idempotent, like commit_prepared.
+
+        Args:
+            txn_id (int): Identification of the transaction, see prepare.
+
+        Returns:
+            bool: True if it's been refunded now, False if it wasn't prepared here.
+        """
+        with self.__fsyncing(), self.transaction(immediate=True) as cursor:
+            changes = self.__pop_prepared(cursor, txn_id)
+            if changes is not None:
+                cursor.executemany('''
+                UPDATE users
+                SET balance=balance+?, version=version+1
+                WHERE id=?;
+                ''', [(amount, key) for key, amount in changes['refunds']])
+
+                now = int(time.time())
+                cursor.executemany('''
+                INSERT INTO history (owner, created_at, action, amount)
+                VALUES (?, ?, 'REFUND', ?);
+                ''', [(key, now, amount) for key, amount in changes['refunds']])
+
+                cursor.executemany('''
+                UPDATE cassettes
+                SET quantity=quantity+?
+                WHERE atm_id=? AND denomination=?;
+                ''', [(quantity, atm_id, denomination)
+                      for atm_id, denomination, quantity in changes['bills']])
+
+                usage = changes.get('usage', []) # prepared by an older version without it
+                cursor.executemany('''
+                UPDATE usage SET amount=MAX(amount-?, 0)
+                WHERE agency=? AND account=? AND action=? AND bucket=?;
+                ''', [(row[4],) + tuple(row[:4]) for row in usage])
+                for row in usage: # read again on demand
+                    self.__usage.pop(tuple(row[:3]), None)
+
+        if self.__prepared == txn_id:
+            self.__prepared = None
+            self.discard_changes()
+
+        return changes is not None
+
+
+
+    def list_prepared(self):
+        """ Returns: list: Ids of transactions prepared here and not decided yet (eg: left
+        by a crash), oldest first, to be recovered by commit_prepared or abort_prepared. """
+        return [row[0] for row in self.query('SELECT txn FROM prepared ORDER BY txn;')]
+
+
+
+    @staticmethod
+    def __pop_prepared(cursor, txn_id):
+        """ Returns: dict: Prepared changes of a transaction, deleting them, or None. """
+        cursor.execute('SELECT changes FROM prepared WHERE txn=?;', (txn_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        cursor.execute('DELETE FROM prepared WHERE txn=?;', (txn_id,))
+        return json.loads(row[0])
+
+
+
+    @contextmanager
+    def __fsyncing(self):
+        """ Make every commit in this block durable (see durable), even if others aren't. """
+        with self.__lock:
+            if self.__durable:
+                yield
+                return
+
+            conn = self.__connection()
+            conn.execute('PRAGMA synchronous=FULL;')
+            try:
+                yield
+            finally:
+                conn.execute('PRAGMA synchronous=NORMAL;')
+
+
+
+    def __save_increments(self, cursor):
+        """ Save dirty users changes as conditional increments, for concurrent mode. """
+        for key, user in self.__dirty.items():
+            delta = user.get_balance_delta()
+            cursor.execute('''
+            UPDATE users
+            SET balance=balance+?, version=version+1
+            WHERE id=? AND balance+?>=0;
+            ''', (delta, key, delta))
+            if cursor.rowcount == 0:
+                raise ConcurrencyError(list(self.__dirty.values()))
+
+
+
+    def __save_taken_bills(self, cursor):
+        """ Save bills taken from cassettes as conditional decrements. """
+        for key, quantity in self.__taken_bills.items():
+            atm_id, denomination = key
+            cursor.execute('''
+            UPDATE cassettes
+            SET quantity=quantity-?
+            WHERE atm_id=? AND denomination=? AND quantity>=?;
+            ''', (quantity, atm_id, denomination, quantity))
+            if cursor.rowcount == 0:
+                raise ConcurrencyError(list(self.__dirty.values()))
+
+
+
+    def load_inventory(self, atm_id, limit=None):
+        """ Load bills inside an ATM, once (so every session of that ATM shares them).
+        Bills taken from it (see CassetteInventory.take) are saved by update_users,
+        along with the withdraws that took them.
+
+        Args:
+            atm_id (str): Identification of the machine.
+            limit  (int): Biggest amount to dispense at once, None for User.MAX_WITHDRAW.
+
+        Returns:
+            CassetteInventory: Its bills, or None if it has no cassettes (see set_cassette).
+        """
+        if atm_id in self.__inventories:
+            return self.__inventories[atm_id]
+
+        rows = self.query('''
+        SELECT denomination, quantity FROM cassettes WHERE atm_id=?;
+        ''', (atm_id,))
+        if not rows:
+            return None
+
+        inventory = CassetteInventory(atm_id, dict(rows), limit)
+        inventory.watch(self.__bills_taken)
+        self.__inventories[atm_id] = inventory
+        return inventory
+
+
+
+    def set_cassette(self, atm_id, denomination, quantity):
+        """ Set the quantity of bills of a cassette (eg: when it's refilled), adding it if
+        it doesn't exist yet. A loaded inventory of that ATM is reloaded. """
+        with self.transaction() as cursor:
+            cursor.execute('''
+            INSERT OR REPLACE INTO cassettes (atm_id, denomination, quantity)
+            VALUES (?, ?, ?);
+            ''', (atm_id, denomination, quantity))
+
+        if atm_id in self.__inventories:
+            self.__taken_bills.pop((atm_id, denomination), None)
+            self.__reload_inventory(self.__inventories[atm_id])
+
+
+
+    def __reload_inventory(self, inventory):
+        """ Replace stock of a loaded inventory by the one in database (minus unsaved bills
+        taken from it), in case it's been changed. """
+        rows = self.query('''
+        SELECT denomination, quantity FROM cassettes WHERE atm_id=?;
+        ''', (inventory.get_atm_id(),))
+
+        stock = {}
+        for denomination, quantity in rows:
+            taken = self.__taken_bills.get((inventory.get_atm_id(), denomination), 0)
+            stock[denomination] = quantity - taken
+        inventory.set_stock(stock)
+
+
+
+    def __bills_taken(self, inventory, quantities):
+        """ Watcher of loaded inventories, to know which cassettes must be saved. """
+        for value, quantity in zip(inventory.get_denominations(), quantities):
+            if quantity > 0:
+                key = (inventory.get_atm_id(), value)
+                self.__taken_bills[key] = self.__taken_bills.get(key, 0) + quantity
+
+
+
+    def set_limit(self, agency, account, action, window, max_amount):
+        """ Set (or remove) a limit of withdraws or transfers. Limits of an account are
+        the most specific ones found among those of (agency, account), (agency, ANY) and
+        (ANY, ANY); limits of an agency as a whole, among (agency, '') and (ANY, ''). Both
+        must allow an operation. Usage is added up only while some limit applies to it.
+
+        Args:
+            agency     (str): Agency identification code, or ANY.
+            account    (str): Account identification code, ANY, or '' for the agency as a
+                              whole (its accounts altogether).
+            action     (str): One of User.LIMITED_ACTIONS.
+            window     (int): Seconds of a rolling window, or DAY for the calendar day.
+            max_amount (int): Most cents moved within the window, None to remove it.
+
+        Raises:
+            ValueError: If action isn't a limited one, window is negative or max_amount
+                        is negative.
+        """
+        if action not in User.LIMITED_ACTIONS:
+            raise ValueError('Unknown limited action {}.'.format(action))
+        if window < 0 or (max_amount is not None and max_amount < 0):
+            raise ValueError('Window and max amount can\'t be negative.')
+
+        with self.transaction() as cursor:
+            if max_amount is None:
+                cursor.execute('''
+                DELETE FROM limits WHERE agency=? AND account=? AND action=? AND window_s=?;
+                ''', (agency, account, action, window))
+            else:
+                cursor.execute('''
+                INSERT OR REPLACE INTO limits (agency, account, action, window_s, max_amount)
+                VALUES (?, ?, ?, ?, ?);
+                ''', (agency, account, action, window, max_amount))
+        self.__load_limits()
+
+
+
+    def get_limits(self):
+        """ Returns: list: Every limit, as (agency, account, action, window, max amount)
+        tuples, see set_limit. """
+        return [tuple(row) for row in self.query('''
+        SELECT agency, account, action, window_s, max_amount FROM limits
+        ORDER BY agency, account, action, window_s;
+        ''')]
+
+
+
+    def __load_limits(self):
+        """ Read every limit (they're a few), and forget usage read for older ones. """
+        self.__limits = {}
+        self.__usage_kept_s = 86400 # a calendar day, at least
+        for agency, account, action, window, max_amount in self.get_limits():
+            self.__limits.setdefault((agency, account, action), {})[window] = max_amount
+            self.__usage_kept_s = max(self.__usage_kept_s, window)
+        self.__usage = OrderedDict()
+
+
+
+    def __limits_of(self, agency, account, action):
+        """ Returns: dict: Window -> max amount of an account ('' for the agency as a
+        whole), the most specific ones, or None if it has no limits. """
+        if account:
+            candidates = ((agency, account), (agency, self.ANY), (self.ANY, self.ANY))
+        else:
+            candidates = ((agency, ''), (self.ANY, ''))
+
+        for candidate in candidates:
+            windows = self.__limits.get(candidate + (action,))
+            if windows:
+                return windows
         return None
+
+
+
+    def get_remaining_limit(self, user, action):
+        """ Get how much an user may still withdraw or transfer, by limits of its account
+        and of its agency (see set_limit). It costs the same whatever the history is: saved
+        usage is kept as aggregates by bucket (read once, then updated by each saving),
+        plus a running total of operations allowed since last saving (all of them count,
+        whatever the window). A rolling window takes whole buckets, so it may count
+        operations up to a bucket older than it.
+
+        Args:
+            user (User): A loaded user.
+            action (str): One of User.LIMITED_ACTIONS.
+
+        Returns:
+            int: Cents still allowed, None if there's no limit.
+        """
+        if not self.__limits: # the usual case, checked on every withdraw and transfer
+            return None
+
+        now = int(time.time())
+        midnight = int(time.mktime(datetime.fromtimestamp(now).date().timetuple()))
+        agency = user.get_agency()
+        remaining = None
+
+        for account in (user.get_account(), ''):
+            windows = self.__limits_of(agency, account, action)
+            if windows is None:
+                continue
+
+            buckets = self.__usage_buckets((agency, account, action), now)
+            unsaved = self.__unsaved_totals.get((agency, account, action), 0)
+
+            for window, max_amount in windows.items():
+                since = midnight if window == self.DAY else now - window
+                first_bucket = since // self.__USAGE_BUCKET_S
+                used = unsaved + sum(amount for bucket, amount in buckets.items()
+                                     if bucket >= first_bucket)
+                if remaining is None or max_amount - used < remaining:
+                    remaining = max(max_amount - used, 0)
+
+        return remaining
+
+
+
+    def __within_limits(self, user, action, amount, is_made):
+        """ Limits checker of loaded users, see User.watch_limits. Allowed operations
+        that are made are added to unsaved usage (saved by update_users). """
+        remaining = self.get_remaining_limit(user, action)
+        if remaining is None:
+            return True
+        if amount > remaining:
+            return False
+
+        if is_made:
+            bucket = int(time.time()) // self.__USAGE_BUCKET_S
+            for account in (user.get_account(), ''):
+                if self.__limits_of(user.get_agency(), account, action) is not None:
+                    key = (user.get_agency(), account, action)
+                    self.__unsaved_totals[key] = self.__unsaved_totals.get(key, 0) + amount
+                    self.__unsaved_usage[key + (bucket,)] = \
+                        self.__unsaved_usage.get(key + (bucket,), 0) + amount
+        return True
+
+
+
+    def __usage_buckets(self, key, now):
+        """ Get saved usage of an (agency, account, action), reading it the first time.
+
+        Returns:
+            dict: Bucket -> amount, of buckets still needed by some limit.
+        """
+        buckets = self.__usage.get(key)
+        if buckets is not None:
+            self.__usage.move_to_end(key)
+            return buckets
+
+        buckets = dict(self.query('''
+        SELECT bucket, amount FROM usage WHERE agency=? AND account=? AND action=? AND bucket>=?;
+        ''', key + ((now - self.__usage_kept_s) // self.__USAGE_BUCKET_S,)))
+        self.__usage[key] = buckets
+        if len(self.__usage) > self.__USAGE_CACHED:
+            self.__usage.popitem(last=False)
+        return buckets
+
+
+
+    def __save_usage(self, cursor):
+        """ Add unsaved usage (operations allowed by limits since last saving) to usage
+        aggregates, forgetting those no limit needs anymore. In concurrent mode, limits are
+        checked again against saved usage, since other processes may have used them too.
+
+        Returns:
+            dict: (agency, account, action, bucket) -> amount added.
+
+        Raises:
+            ConcurrencyError: If any limit would be exceeded (in concurrent mode).
+        """
+        increments = self.__unsaved_usage
+        if not increments:
+            return increments
+
+        for key, amount in increments.items():
+            cursor.execute('''
+            INSERT OR IGNORE INTO usage (agency, account, action, bucket, amount)
+            VALUES (?, ?, ?, ?, 0);
+            ''', key)
+            cursor.execute('''
+            UPDATE usage SET amount=amount+?
+            WHERE agency=? AND account=? AND action=? AND bucket=?;
+            ''', (amount,) + key)
+
+        now = int(time.time())
+        midnight = int(time.mktime(datetime.fromtimestamp(now).date().timetuple()))
+        for key in set(key[:3] for key in increments):
+            cursor.execute('''
+            DELETE FROM usage WHERE agency=? AND account=? AND action=? AND bucket<?;
+            ''', key + ((now - self.__usage_kept_s) // self.__USAGE_BUCKET_S,))
+            if not self.__concurrent:
+                continue
+
+            for window, max_amount in self.__limits_of(*key).items():
+                since = midnight if window == self.DAY else now - window
+                cursor.execute('''
+                SELECT COALESCE(SUM(amount), 0) FROM usage
+                WHERE agency=? AND account=? AND action=? AND bucket>=?;
+                ''', key + (since // self.__USAGE_BUCKET_S,))
+                if cursor.fetchone()[0] > max_amount:
+                    raise ConcurrencyError(list(self.__dirty.values()))
+
+        return increments
+
+
+
+    def __usage_saved(self, increments):
+        """ Update usage aggregates in memory with saved increments (see __save_usage).
+        In concurrent mode they're read again instead, with other processes' usage. """
+        self.__unsaved_usage = {}
+        self.__unsaved_totals = {}
+        oldest = (int(time.time()) - self.__usage_kept_s) // self.__USAGE_BUCKET_S
+        for key, amount in increments.items():
+            buckets = self.__usage.get(key[:3])
+            if buckets is None:
+                continue
+            if self.__concurrent:
+                del self.__usage[key[:3]]
+                continue
+
+            buckets[key[3]] = buckets.get(key[3], 0) + amount
+            for bucket in [bucket for bucket in buckets if bucket < oldest]:
+                del buckets[bucket]
+
+
+
+    def __read_balances(self, keys):
+        """ Returns: dict of users id -> balance, as they are in database. """
+        balances = {}
+        for key in keys:
+            balances[key] = self.query('''
+            SELECT balance FROM users WHERE id=?;
+            ''', (key,))[0][0]
+        return balances
+
+
+
+    def refresh(self, user):
+        """ Reload balance of an user from database, if it has no unsaved changes.
+        Useful in concurrent mode, where other processes may change it.
+
+        Args:
+            user (User): A persisted user.
+
+        Returns:
+            bool: True if it has been reloaded, False if it's dirty (so it's untouched).
+        """
+        if user.is_dirty():
+            return False
+
+        user.mark_saved(self.__read_balances([user.get_id()])[user.get_id()])
+        return True
+
+
+
+    def get_generation(self):
+        """ Get the generation of users table: it's increased by every inserted, updated
+        or deleted row, by anyone (triggers do it), eg: to know if a snapshot is stale.
+
+        Returns:
+            int: Current generation.
+        """
+        with self.transaction() as cursor:
+            return self.__read_generation(cursor)
+
+
+
+    @staticmethod
+    def __read_generation(cursor):
+        """ Returns: int: Current generation, see get_generation. """
+        cursor.execute("SELECT value FROM generations WHERE name='users';")
+        return cursor.fetchone()[0]
+
+
+
+    def write_snapshot(self):
+        """ Write the snapshot file again (see snapshot_path) from database, as it's now,
+        and map it.
+
+        Returns:
+            bool: True if it's been written, False if some user doesn't fit in it (see
+                  AccountSnapshot.write), or there's no snapshot_path.
+        """
+        if self.__snapshot is None:
+            return False
+
+        with self.transaction() as cursor: # a consistent read of rows and their generation
+            generation = self.__read_generation(cursor)
+            cursor.execute('''
+            SELECT id, agency, account, password, balance FROM users ORDER BY agency, account;
+            ''')
+            written = self.__snapshot.write(cursor, generation)
+
+        return written and self.__snapshot.open(generation)
+
+
+
+    def __watch(self, user):
+        """ Watch a loaded user: its changes (see update_users) and its limits. """
+        user.watch(self.__watchers[0])
+        user.watch_limits(self.__watchers[1])
+
+
+
+    def __user_changed(self, user):
+        """ Watcher of loaded users, to know which ones must be saved. """
+        self.__dirty[user.get_id()] = user
+
+
+
+    def load_users(self):
+        """ Load all users rows and put their data in list attribute.
+        History isn't loaded, it's read on demand by get_history method.
+        With cache_size, it only forgets cached users, they're loaded again on demand.
+        With an up to date snapshot (see snapshot_path), it only maps it. """
+        self.__users = OrderedDict() if self.__cache_size is not None else {}
+        self.__index = {}
+        self.__dirty = {}
+        self.__referenced = weakref.WeakValueDictionary()
+        if self.__cache_size is not None:
+            return
+        if self.__snapshot is not None and self.__snapshot.open(self.get_generation()):
+            return
+
+        rows = self.query('''
+        SELECT id, agency, account, password, balance FROM users;
+        ''')
+
+        for row in rows:
+            agency = sys.intern(row[1]) # a few agencies, shared by millions of users
+            user = User(agency, row[2], row[3], row[4], None, row[0])
+            self.__watch(user)
+            self.__users[row[0]] = user
+            self.__index[(agency, row[2])] = row[0]
+
+
+
+    def get_history(self, user, limit=20, before=None, since=None, until=None):
+        """ Read a page of saved history of an user, newest registers first.
+        It's a keyset pagination over the (owner, created_at) index: a page is a range
+        seek in it, so any page costs the same, no matter how long the history is.
+
+        Args:
+            user    (User): Owner of wanted history, must be a persisted user.
+            limit    (int): Maximum quantity of registers in this page.
+            before  (list): Cursor returned with previous page, or None for the first page.
+            since (datetime): Only registers made since this moment, None for no bound.
+            until (datetime): Only registers made before this moment, None for no bound.
+
+        Returns:
+            tuple: (registers, cursor) where registers is a list of register strings
+                   and cursor is what to pass as 'before' to get next page,
+                   or None if there's no more pages.
+
+        Raises:
+            ValueError: If limit isn't a positive int, or before isn't a cursor
+                        ([created_at, id] ints).
+        """
+        if not self.is_count(limit):
+            raise ValueError('Limit must be a positive int, not {!r}.'.format(limit))
+        if before is not None and not self.is_cursor(before):
+            raise ValueError('Invalid history cursor {!r}.'.format(before))
+
+        query = self.__HISTORY_QUERY
+        params = [user.get_id()]
+
+        if before is not None: # bounded by created_at first, so the index range is used
+            query += ' AND history.created_at<=? AND (history.created_at<? OR history.id<?)'
+            params.extend([before[0], before[0], before[1]])
+
+        if since is not None:
+            query += ' AND history.created_at>=?'
+            params.append(int(time.mktime(since.timetuple())))
+
+        if until is not None:
+            query += ' AND history.created_at<?'
+            params.append(int(time.mktime(until.timetuple())))
+
+        query += ' ORDER BY history.created_at DESC, history.id DESC LIMIT ?;'
+        params.append(limit + 1) # one more, just to know if there's a next page
+
+        rows = self.query(query, params)
+
+        cursor = None
+        if rows and len(rows) > limit:
+            rows = rows[:limit]
+            cursor = [rows[-1][1], rows[-1][0]]
+
+        registers = []
+        for row in rows:
+            row = self.__with_foreign_user(row)
+            registers.append(User.format_register(row[1], user.get_account(), user.get_agency(),
+                                                  row[2], row[3], row[4], row[5]))
+        return registers, cursor
+
+
+
+    @staticmethod
+    def is_count(limit):
+        """ Returns: bool: True if limit is a positive int (a quantity of registers). """
+        return isinstance(limit, int) and not isinstance(limit, bool) and limit > 0
+
+
+
+    @staticmethod
+    def is_cursor(before):
+        """ Returns: bool: True if before is a cursor of get_history, [created_at, id]. """
+        return isinstance(before, (list, tuple)) and len(before) == 2 and \
+            all(isinstance(value, int) and not isinstance(value, bool) for value in before)
+
+
+
+    def set_foreign_users(self, lookup):
+        """ Set how to find counterparties that aren't in this database (eg: transfers
+        between shards, see sharding.py), for history and statements.
+
+        Args:
+            lookup (function): Receives an users id, returns its (account, agency), or None
+                               if it's unknown too.
+        """
+        self.__foreign_users = lookup
+
+
+
+    def __with_foreign_user(self, row):
+        """ Returns: tuple: A history row, with account and agency of its counterparty
+        filled by set_foreign_users lookup, if they weren't found in this database. """
+        if row[4] is not None or row[6] is None or self.__foreign_users is None:
+            return row
+
+        keys = self.__foreign_users(row[6])
+        if keys is None:
+            return row
+        return tuple(row[:4]) + tuple(keys) + (row[6],)
+
+
+
+    def get_daily_totals(self, user, since=None, until=None):
+        """ Sum amounts of saved history of an user, by day and action,
+        without reading each register (it's an aggregation over (owner, created_at) index).
+
+        Args:
+            user    (User): Owner of wanted history, must be a persisted user.
+            since (datetime): Only registers made since this moment, None for no bound.
+            until (datetime): Only registers made before this moment, None for no bound.
+
+        Returns:
+            list: Tuples (day as 'yyyy-mm-dd' in local time, action code, total in cents),
+                  ordered by day.
+
+        """
+        query = '''
+        SELECT date(created_at, 'unixepoch', 'localtime') AS day, action, SUM(amount)
+        FROM history
+        WHERE owner=?'''
+        params = [user.get_id()]
+
+        if since is not None:
+            query += ' AND created_at>=?'
+            params.append(int(time.mktime(since.timetuple())))
+
+        if until is not None:
+            query += ' AND created_at<?'
+            params.append(int(time.mktime(until.timetuple())))
+
+        query += ' GROUP BY day, action ORDER BY day;'
+
+        return [tuple(row) for row in self.query(query, params)]
+
+
+
+    def open_reader(self):
+        """ Open a connection for reading, apart from the long-lived one, eg: to stream
+        many statements through it (see iter_statement). It should be closed when done.
+
+        Returns:
+            Connection: A new tuned connection, in autocommit mode.
+        """
+        return self.__open_connection()
+
+
+
+    def iter_statement(self, user, since=None, until=None, chunk_size=1000, conn=None):
+        """ Stream saved history of an user, oldest registers first.
+        It reads through a connection of its own, in chunks, so memory is constant
+        and it sees a consistent snapshot, whatever happens meanwhile.
+
+        Args:
+            user        (User): Owner of wanted history, must be a persisted user.
+            since   (datetime): Only registers made since this moment, None for no bound.
+            until   (datetime): Only registers made before this moment, None for no bound.
+            chunk_size   (int): Rows fetched from database at once.
+            conn  (Connection): Connection to read through, from open_reader (so many
+                                statements don't open one each), None to open one.
+
+        Yields:
+            dict: A register, with STATEMENT_FIELDS as keys (amount in cents).
+        """
+        query = self.__HISTORY_QUERY + '''
+        AND history.created_at>=? AND history.created_at<?
+        ORDER BY history.created_at, history.id;
+        '''
+        params = (user.get_id(),
+                  int(time.mktime(since.timetuple())) if since is not None else -2**63,
+                  int(time.mktime(until.timetuple())) if until is not None else 2**63 - 1)
+
+        reader = conn if conn is not None else self.__open_connection()
+        try:
+            cursor = reader.cursor(self.CURSOR_FACTORY)
+            cursor.execute('BEGIN;') # a single read transaction, for a consistent snapshot
+            cursor.execute(query, params)
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                for row in rows:
+                    row = self.__with_foreign_user(row)
+                    yield {
+                        'id': row[0],
+                        'date': datetime.fromtimestamp(row[1]).isoformat(),
+                        'action': row[2],
+                        'amount': row[3],
+                        'to_account': row[4],
+                        'to_agency': row[5],
+                        'register': User.format_register(row[1], user.get_account(),
+                                                         user.get_agency(), row[2], row[3],
+                                                         row[4], row[5]),
+                    }
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            if conn is None:
+                reader.close()
+            elif reader.in_transaction:
+                reader.execute('ROLLBACK;') # only read
+
+
+
+    def export_statement(self, user, out_file, file_format='csv', since=None, until=None,
+                         conn=None):
+        """ Write saved history of an user in a file, streaming it (see iter_statement).
+
+        Args:
+            user         (User): Owner of wanted history, must be a persisted user.
+            out_file     (file): Opened text file where to write.
+            file_format   (str): 'csv' (with header) or 'jsonl' (a JSON object per line).
+            since    (datetime): Only registers made since this moment, None for no bound.
+            until    (datetime): Only registers made before this moment, None for no bound.
+            conn   (Connection): See iter_statement.
+
+        Returns:
+            int: Quantity of written registers.
+        """
+        if file_format == 'csv':
+            writer = csv.DictWriter(out_file, fieldnames=self.STATEMENT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        elif file_format == 'jsonl':
+            write = lambda register: out_file.write(json.dumps(register) + '\n')
+        else:
+            raise ValueError('Unknown statement format: {!r}'.format(file_format))
+
+        count = 0
+        for register in self.iter_statement(user, since, until, conn=conn):
+            write(register)
+            count += 1
+        return count
+
+
+
+    def reconcile(self, agency=None):
+        """ Check that balances agree with history, incrementally: an account's balance
+        must be its last checkpoint plus its history since then (User.CREDIT_ACTIONS add,
+        any other action subtracts). Only history added since last reconciliation is read,
+        while balances of every account are compared in a single scan of users table.
+
+        Accounts that agree (or have no checkpoint yet) get a new checkpoint. Those that
+        don't keep their old one, flagged as mismatch, so they're checked (and reported)
+        again, from that checkpoint on, until they agree.
+
+        Args:
+            agency (str): Only accounts of this agency (eg: to reconcile agencies in
+                          parallel), None for all of them.
+
+        Returns:
+            dict: 'history_id' (last history row reconciled), 'accounts' (quantity checked),
+                  'history_rows' (quantity read), 'new_checkpoints' and 'mismatches' (list
+                  of dicts: id, agency, account, expected and balance, both in cents).
+
+        Raises:
+            RuntimeError: If another reconciliation of the same accounts finishes meanwhile
+                          (nothing is saved).
+        """
+        if agency is None:
+            scope, scope_params = '', ()
+        else:
+            scope, scope_params = 'AND users.agency=?', (agency,)
+        signed_amount = 'CASE WHEN history.action IN ({}) THEN amount ELSE -amount END'.format(
+            ', '.join("'{}'".format(action) for action in User.CREDIT_ACTIONS))
+
+        with self.transaction() as cursor: # a single snapshot for history and balances
+            since = self.__reconciled_until(cursor, agency)
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM history;')
+            until = cursor.fetchone()[0]
+
+            cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS reconcile_deltas (
+                owner INTEGER NOT NULL PRIMARY KEY,
+                delta INTEGER NOT NULL,
+                rows  INTEGER NOT NULL
+            );
+            ''')
+            cursor.execute('DELETE FROM temp.reconcile_deltas;')
+
+            cursor.execute('''
+            INSERT INTO temp.reconcile_deltas (owner, delta, rows)
+            SELECT history.owner, SUM({signed_amount}), COUNT(*)
+            FROM history
+            JOIN checkpoints ON checkpoints.owner=history.owner
+            JOIN users ON users.id=history.owner
+            WHERE history.id>? AND history.id<=? AND history.id>checkpoints.history_id
+                  AND checkpoints.mismatch=0 {scope}
+            GROUP BY history.owner
+            UNION ALL
+            SELECT history.owner, SUM({signed_amount}), COUNT(*)
+            FROM checkpoints
+            JOIN history ON history.owner=checkpoints.owner
+            JOIN users ON users.id=checkpoints.owner
+            WHERE checkpoints.mismatch=1 AND history.id>checkpoints.history_id
+                  AND history.id<=? {scope}
+            GROUP BY history.owner;
+            '''.format(signed_amount=signed_amount, scope=scope),
+                           (since, until) + scope_params + (until,) + scope_params)
+
+            cursor.execute('SELECT COALESCE(SUM(rows), 0) FROM temp.reconcile_deltas;')
+            history_rows = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM users WHERE 1 {};'.format(scope), scope_params)
+            accounts = cursor.fetchone()[0]
+
+            cursor.execute('''
+            SELECT users.id, users.agency, users.account, users.balance,
+                   checkpoints.balance + COALESCE(reconcile_deltas.delta, 0),
+                   checkpoints.owner IS NULL
+            FROM users
+            LEFT JOIN checkpoints ON checkpoints.owner=users.id
+            LEFT JOIN temp.reconcile_deltas ON reconcile_deltas.owner=users.id
+            WHERE (checkpoints.owner IS NULL OR reconcile_deltas.owner IS NOT NULL
+                   OR checkpoints.mismatch=1 OR users.balance!=checkpoints.balance) {};
+            '''.format(scope), scope_params)
+            rows = cursor.fetchall()
+
+        now = int(time.time())
+        checkpoints_data = []
+        mismatches = []
+        new_checkpoints = 0
+        for user_id, user_agency, account, balance, expected, is_new in rows:
+            if is_new or balance == expected:
+                checkpoints_data.append((user_id, until, balance, now))
+                new_checkpoints += is_new
+            else:
+                mismatches.append({'id': user_id, 'agency': user_agency, 'account': account,
+                                   'expected': expected, 'balance': balance})
+
+        with self.transaction(immediate=True) as cursor:
+            if self.__reconciled_until(cursor, agency) != since:
+                raise RuntimeError('Another reconciliation finished meanwhile.')
+
+            cursor.executemany('''
+            INSERT OR REPLACE INTO checkpoints (owner, history_id, balance, created_at, mismatch)
+            VALUES (?, ?, ?, ?, 0);
+            ''', checkpoints_data)
+
+            cursor.executemany('''
+            UPDATE checkpoints SET mismatch=1 WHERE owner=?;
+            ''', [(mismatch['id'],) for mismatch in mismatches])
+
+            cursor.execute('''
+            INSERT INTO reconciliations (history_id, created_at, accounts, history_rows,
+                                         mismatches, agency)
+            VALUES (?, ?, ?, ?, ?, ?);
+            ''', (until, now, accounts, history_rows, len(mismatches), agency))
+
+        return {'history_id': until, 'accounts': accounts, 'history_rows': history_rows,
+                'new_checkpoints': new_checkpoints, 'mismatches': mismatches}
+
+
+
+    @staticmethod
+    def __reconciled_until(cursor, agency):
+        """ Get last history row reconciled for every account of an agency (by a
+        reconciliation of it, or of all agencies), or for every account if it's None. """
+        if agency is None:
+            cursor.execute('''
+            SELECT COALESCE(MAX(history_id), 0) FROM reconciliations WHERE agency IS NULL;
+            ''')
+        else:
+            cursor.execute('''
+            SELECT COALESCE(MAX(history_id), 0) FROM reconciliations
+            WHERE agency IS NULL OR agency=?;
+            ''', (agency,))
+        return cursor.fetchone()[0]
+
+
+
+    def find_user(self, agency=None, account=None):
+        """ Search for a registered user with these BOTH matching agency and account attributes.
+        Don't worry about SQL injection, this searching is executed with already loaded users,
+        so there's no use of SQL here. It's just a lookup in an (agency, account) index.
+        With cache_size, an user that isn't in memory is read by a parameterized query
+        over the same index of database, and kept as the most recently used one.
+        With a snapshot, it's read from the snapshot only while it's up to date (same
+        generation as database), otherwise the snapshot is closed and it's read by query.
+
+        Args:
+            agency (str): Agency name of wanted user (recommended: use upper case only).
+            account (str): Account name of wanted user (recommended: use upper case only).
+
+        Returns:
+            User: Found user, or None if there's no matching user.
+
+        """
+        if agency is None or account is None:
+            return None
+
+        user_id = self.__index.get((agency, account))
+        if user_id is not None:
+            if self.__cache_size is not None:
+                self.__users.move_to_end(user_id)
+            return self.__users[user_id]
+
+        if self.__snapshot is not None and self.__snapshot.is_open():
+            if self.__snapshot.get_generation() == self.get_generation():
+                found = self.__snapshot.find(agency, account)
+                if found is None:
+                    return None
+                user = User(sys.intern(agency), account, found[2], found[1], None, found[0])
+                self.__watch(user)
+                self.__keep(user)
+                return user
+            self.__snapshot.close() # changed by someone else, it's written again when closing
+        if self.__cache_size is None and self.__snapshot is None:
+            return None
+
+        rows = self.query('''
+        SELECT id, agency, account, password, balance FROM users WHERE agency=? AND account=?;
+        ''', (agency, account))
+        if not rows:
+            return None
+
+        user_id, agency, account, password, balance = rows[0]
+        user = self.__referenced.get(user_id) # evicted, but someone holds it (eg: a session)
+        if user is None:
+            user = User(sys.intern(agency), account, password, balance, None, user_id)
+            self.__watch(user)
+        self.__keep(user)
+        return user
+
+
+
+    def __keep(self, user):
+        """ Add an user to the loaded ones. With cache_size, least recently used clean users
+        are evicted to make room. Dirty ones are kept until they're saved (by whoever saves,
+        eg: a GroupCommit), so the cache may overflow meanwhile. """
+        self.__users[user.get_id()] = user
+        self.__index[(user.get_agency(), user.get_account())] = user.get_id()
+        if self.__cache_size is None:
+            return
+
+        self.__referenced[user.get_id()] = user
+        excess = len(self.__users) - self.__cache_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for cached in self.__users.values(): # least recently used first
+            if len(evicted) == excess:
+                break
+            if not cached.is_dirty():
+                evicted.append(cached)
+
+        for cached in evicted:
+            del self.__users[cached.get_id()]
+            del self.__index[(cached.get_agency(), cached.get_account())]
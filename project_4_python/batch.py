@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to apply a file of operations (deposits, withdrawals and transfers).
+
+The file is streamed through a pipeline of generators, so memory doesn't grow with its size:
+read lines -> parse operations -> apply them in chunks, one transaction per chunk.
+
+Accepted formats (by file extension):
+    .csv   with header: operation,agency,account,amount,to_agency,to_account
+    .jsonl one object per line, with these same keys.
+Operations: 'deposit', 'withdraw' and 'transfer' (the only one that needs 'to_' fields),
+amounts in $ (eg: 12.50).
+
+Usage: python3 batch.py operations.csv [--db users.db] [--chunk-size 1000]
+Failures are reported as 'line N: reason' in stderr.
+"""
+
+import argparse
+import csv
+import json
+import sys
+
+from atm import ConcurrencyError, Persistence, to_cents
+
+OPERATIONS = ('deposit', 'withdraw', 'transfer')
+
+
+
+def read_records(path):
+    """ Stream raw records of an operations file.
+
+    Args:
+        path (str): A .csv or .jsonl file path.
+
+    Yields:
+        tuple: (line number, dict of record fields, or None if the line isn't readable).
+    """
+    with open(path, newline='') as ops_file:
+        if path.endswith('.jsonl'):
+            for line_no, line in enumerate(ops_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_no, json.loads(line)
+                except ValueError:
+                    yield line_no, None
+        else:
+            reader = csv.DictReader(ops_file)
+            for record in reader:
+                yield reader.line_num, record
+
+
+
+def parse_operations(records):
+    """ Turn raw records into operations, checking their format.
+
+    Args:
+        records (iterable): As yielded by read_records.
+
+    Yields:
+        tuple: (line number, operation dict, error string or None if it's well formed).
+    """
+    for line_no, record in records:
+        if not isinstance(record, dict):
+            yield line_no, None, 'unreadable line'
+            continue
+
+        operation = {
+            'operation': str(record.get('operation') or '').strip().lower(),
+            'agency': str(record.get('agency') or '').strip(),
+            'account': str(record.get('account') or '').strip(),
+            'to_agency': str(record.get('to_agency') or '').strip(),
+            'to_account': str(record.get('to_account') or '').strip(),
+        }
+
+        if operation['operation'] not in OPERATIONS:
+            yield line_no, operation, 'unknown operation'
+            continue
+
+        try:
+            operation['amount'] = to_cents(record.get('amount'))
+        except ValueError:
+            yield line_no, operation, 'invalid amount'
+            continue
+
+        if not operation['amount'] > 0:
+            yield line_no, operation, 'amount must be positive'
+            continue
+
+        yield line_no, operation, None
+
+
+
+def apply_operation(d_manager, operation):
+    """ Apply a single operation through User methods, so their rules are the same.
+
+    Args:
+        d_manager (Persistence): Where users are.
+        operation (dict): A well formed operation, as yielded by parse_operations.
+
+    Returns:
+        str: Error string, or None if it has been applied.
+    """
+    user = d_manager.find_user(operation['agency'], operation['account'])
+    if user is None:
+        return 'user not found'
+
+    amount = operation['amount']
+    user.authorize()
+    try:
+        if operation['operation'] == 'deposit':
+            if not user.deposit(amount):
+                return 'balance can\'t hold this amount'
+
+        elif operation['operation'] == 'withdraw':
+            options = user.options_to_withdraw(amount)
+            if not options:
+                return 'amount not available in bills'
+            if not user.withdraw_cash(*options[0]):
+                return 'insufficient balance or over limit'
+
+        else: # transfer
+            another_user = d_manager.find_user(operation['to_agency'], operation['to_account'])
+            if another_user is None:
+                return 'target user not found'
+            if not user.transfer_to(amount, another_user):
+                return 'insufficient balance'
+    finally:
+        user.log_out()
+
+    return None
+
+
+
+def apply_operations(d_manager, operations, chunk_size=1000):
+    """ Apply operations, saving them every chunk_size lines in a single transaction.
+    If a chunk conflicts with changes of other processes (see Persistence concurrent),
+    its operations are applied again one by one, so only conflicting ones fail.
+
+    Args:
+        d_manager (Persistence): Where users are, in concurrent mode.
+        operations  (iterable): As yielded by parse_operations.
+        chunk_size       (int): Quantity of operations per transaction.
+
+    Yields:
+        tuple: (line number, error string) for each operation that couldn't be applied.
+    """
+    pending = [] # (line number, operation) applied since last saving
+    for line_no, operation, error in operations:
+        if error is None:
+            error = apply_operation(d_manager, operation)
+
+        if error is None:
+            pending.append((line_no, operation))
+            if len(pending) >= chunk_size:
+                yield from save_chunk(d_manager, pending)
+                pending = []
+        else:
+            yield line_no, error
+
+    yield from save_chunk(d_manager, pending)
+
+
+
+def save_chunk(d_manager, pending):
+    """ Save applied operations in a single transaction, or one by one if it conflicts.
+
+    Yields:
+        tuple: (line number, error string) for each operation that couldn't be saved.
+    """
+    try:
+        d_manager.update_users()
+        return
+    except ConcurrencyError: # every change has been discarded
+        pass
+
+    for line_no, operation in pending:
+        error = apply_operation(d_manager, operation)
+        if error is None:
+            try:
+                d_manager.update_users()
+            except ConcurrencyError:
+                error = 'conflicting concurrent change'
+        if error is not None:
+            yield line_no, error
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if every operation has been applied, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Apply a file of ATM operations.')
+    parser.add_argument('path', help='.csv or .jsonl file of operations')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='operations per transaction (default: 1000)')
+    args = parser.parse_args(argv)
+
+    failures = 0
+    with Persistence(args.db, concurrent=True) as d_manager: # terminals may share it
+        operations = parse_operations(read_records(args.path))
+        for line_no, error in apply_operations(d_manager, operations, args.chunk_size):
+            failures += 1
+            print('line {}: {}'.format(line_no, error), file=sys.stderr)
+
+    print('Done, {} failure(s).'.format(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Benchmarks of Persistence and User hot paths, against synthetic databases of growing size.
+
+Each size gets a temporary database (removed at the end) of that many users spread over
+agencies, with some history rows per user (see generate.py). Then each hot path is run
+many times, and the report (JSON) has, for each size and benchmark: latency percentiles
+(ms), throughput (operations per second) and peak memory allocated by Python while running
+it (bytes). A percentile is only reported with enough runs to tell it from the maximum
+(p90 from 10 runs, p99 from 100); opening benchmarks are run --open-repeat times.
+
+Usage: python3 bench.py [--sizes 1000,100000,1000000] [--history-per-user 3]
+                        [--repeat 1000] [--open-repeat 10] [--seed 0] [--output FILE]
+Compare runs by saving reports (eg: before and after a change) and diffing them.
+"""
+
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from atm import Persistence, User
+from generate import generate
+
+
+
+def percentile(sorted_values, fraction):
+    """ Returns: Value at a fraction (0 to 1) of sorted values, nearest rank. """
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+
+def measure(operation, repeat):
+    """ Run an operation many times, timing each run and tracing memory of a few of them.
+
+    Args:
+        operation (function): Receives the run index, only its own time is measured (it
+                              may return a function to run untimed afterwards, eg: cleaning).
+        repeat         (int): Quantity of timed runs.
+
+    Returns:
+        dict: Report of the benchmark.
+    """
+    latencies = []
+    for index in range(repeat):
+        started = time.perf_counter()
+        after = operation(index)
+        latencies.append(time.perf_counter() - started)
+        if after is not None:
+            after()
+
+    tracemalloc.start() # apart, since tracing slows everything down
+    for index in range(repeat, repeat + min(repeat, 10)):
+        after = operation(index)
+        if after is not None:
+            after()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    latency_ms = {'min': latencies[0] * 1000, 'p50': percentile(latencies, 0.50) * 1000,
+                  'max': latencies[-1] * 1000}
+    for name, fraction in (('p90', 0.90), ('p99', 0.99)):
+        if repeat * (1 - fraction) >= 1: # else it's just the maximum
+            latency_ms[name] = percentile(latencies, fraction) * 1000
+    return {
+        'runs': repeat,
+        'total_s': total,
+        'throughput_ops': repeat / total if total else None,
+        'latency_ms': latency_ms,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+
+def run_size(path, repeat, seed, open_repeat=10):
+    """ Run every benchmark against a database of a given size, opening ones open_repeat
+    times (they're slow with many users) and the others repeat times.
+
+    Returns:
+        dict: Benchmark name -> its report.
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    with Persistence(path) as d_manager:
+        keys = d_manager.query('SELECT agency, account FROM users;')
+
+    def load_users(index):
+        """ Opening a Persistence, which loads every user (closing it isn't timed). """
+        return Persistence(path).close
+    results['load_users'] = measure(load_users, open_repeat)
+
+    def open_lazy(index):
+        """ Opening a Persistence that loads users on demand (see cache_size). """
+        return Persistence(path, cache_size=1000).close
+    results['open_lazy'] = measure(open_lazy, open_repeat)
+
+    Persistence(path, snapshot_path=path + '.snap').close() # writing it
+    def open_snapshot(index):
+        """ Opening a Persistence that maps an up to date snapshot (see AccountSnapshot). """
+        return Persistence(path, snapshot_path=path + '.snap').close
+    results['open_snapshot'] = measure(open_snapshot, open_repeat)
+
+    with Persistence(path, cache_size=1000) as d_manager:
+        def find_user_lazy(index):
+            """ Finding an existent user on demand, most of them aren't cached. """
+            d_manager.find_user(*rng.choice(keys))
+        results['find_user_lazy'] = measure(find_user_lazy, repeat)
+
+    with Persistence(path) as d_manager:
+        def find_user(index):
+            """ Finding an existent user. """
+            d_manager.find_user(*rng.choice(keys))
+        results['find_user'] = measure(find_user, repeat)
+
+        def deposit_some():
+            """ Deposits in 10 random users, to be saved by next run (they aren't timed). """
+            for _ in range(10):
+                d_manager.find_user(*rng.choice(keys)).deposit(1000)
+        def update_users(index):
+            """ Saving 10 deposits (each one changes a balance and adds a history row). """
+            d_manager.update_users()
+            return deposit_some
+        deposit_some()
+        results['update_users'] = measure(update_users, repeat)
+
+    user = User('A1', '0000001-1', None, 0)
+    def register_operation(index):
+        """ Registering in memory, saved registers are released every 1000 ones. """
+        user.register_operation('RECEIVING', 1000)
+        if index % 1000 == 999:
+            return user.mark_saved
+    results['register_operation'] = measure(register_operation, repeat)
+
+    amounts = [rng.randrange(1, User.MAX_WITHDRAW // 1000 + 1) * 1000 for _ in range(repeat * 2)]
+    def options_to_withdraw(index):
+        """ Planning a random amount (the planner memoizes, so it's mostly warm). """
+        user.options_to_withdraw(amounts[index % len(amounts)])
+    results['options_to_withdraw'] = measure(options_to_withdraw, repeat)
+
+    return results
+
+
+
+def main(argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description='Benchmark ATM hot paths.')
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated quantities of users (default: 1000,100000,1000000)')
+    parser.add_argument('--history-per-user', type=int, default=3,
+                        help='average history rows per user (default: 3)')
+    parser.add_argument('--repeat', type=int, default=1000,
+                        help='timed runs of each benchmark (default: 1000)')
+    parser.add_argument('--open-repeat', type=int, default=10,
+                        help='timed runs of opening benchmarks (default: 10)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file path (default: stdout)')
+    args = parser.parse_args(argv)
+
+    report = {
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'history_per_user': args.history_per_user,
+        'repeat': args.repeat,
+        'open_repeat': args.open_repeat,
+        'seed': args.seed,
+        'sizes': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='atm-bench-') as directory:
+        for users in (int(size) for size in args.sizes.split(',')):
+            path = os.path.join(directory, 'users-{}.db'.format(users))
+            print('Building {} users...'.format(users), file=sys.stderr)
+            started = time.perf_counter()
+            generate(path, users, history_per_user=args.history_per_user, seed=args.seed)
+            build_s = time.perf_counter() - started
+
+            print('Running benchmarks...', file=sys.stderr)
+            results = run_size(path, args.repeat, args.seed, args.open_repeat)
+            results['build_s'] = build_s
+            report['sizes'][str(users)] = results
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+    else:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
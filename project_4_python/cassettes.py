@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to check or refill the cassettes of an ATM (see main.py --atm-id).
+
+Usage: python3 cassettes.py ATM_ID [DENOMINATION=QUANTITY ...] [--db users.db]
+Denominations are in $ (eg: 100=50 for fifty $100 bills). Without them, it only shows
+the quantity of bills in each cassette.
+"""
+
+import argparse
+import sys
+
+from atm import Persistence, to_cents, format_cents
+
+
+
+def parse_cassette(text):
+    """ Returns: tuple: (denomination in cents, quantity) from 'DENOMINATION=QUANTITY'. """
+    try:
+        denomination, quantity = text.split('=')
+        denomination, quantity = to_cents(denomination), int(quantity)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected DENOMINATION=QUANTITY, got ' + text)
+
+    if denomination <= 0 or quantity < 0:
+        raise argparse.ArgumentTypeError('invalid cassette ' + text)
+    return denomination, quantity
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if done, 1 if ATM has no cassettes.
+    """
+    parser = argparse.ArgumentParser(description='Check or refill cassettes of an ATM.')
+    parser.add_argument('atm_id')
+    parser.add_argument('cassettes', nargs='*', type=parse_cassette,
+                        metavar='DENOMINATION=QUANTITY')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    args = parser.parse_args(argv)
+
+    with Persistence(args.db, preload=False) as d_manager: # cassettes only, no users
+        for denomination, quantity in args.cassettes:
+            d_manager.set_cassette(args.atm_id, denomination, quantity)
+
+        inventory = d_manager.load_inventory(args.atm_id)
+        if inventory is None:
+            print('ATM has no cassettes.', file=sys.stderr)
+            return 1
+
+        stock = inventory.get_stock()
+        for denomination in inventory.get_denominations():
+            print('${}: {}'.format(format_cents(denomination), stock[denomination]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
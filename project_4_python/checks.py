@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Scripted checks of saving paths that a single terminal never takes: two-phase commits
+aborted halfway (held debits must be refunded), recovery of transactions left by a crash
+(see ShardedPersistence) and conflicts between processes in concurrent mode (balances,
+limits and cassettes rechecked by SQL, and batch.py replaying a conflicting chunk).
+
+Usage: python3 checks.py [NAME ...]
+Each check runs in a temporary directory (removed at the end), all of them by default.
+Results are written to stdout, one line per check. Exit status is 1 if any check fails.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from atm import ConcurrencyError, Persistence, User
+from batch import apply_operations
+from sharding import CATALOG, STALE_TRANSACTION_S, ShardedPersistence
+
+PASSWORD = User.HASHER.hash('check') # users are authorized instead, see User.authorize
+
+
+
+class CheckFailed(Exception):
+    """ Raised by a check when something isn't as expected. """
+
+
+
+def expect(condition, message, *args):
+    """ Raises: CheckFailed: With formatted message, if condition is false. """
+    if not condition:
+        raise CheckFailed(message.format(*args))
+
+
+
+def balance_of(d_manager, agency, account):
+    """ Returns: int: Saved balance of an user, read straight from its database. """
+    rows = d_manager.query('SELECT balance FROM users WHERE agency=? AND account=?;',
+                           (agency, account))
+    return rows[0][0]
+
+
+
+def refunds_of(d_manager, agency, account):
+    """ Returns: list: Amounts of REFUND history rows of an user, oldest first. """
+    rows = d_manager.query('''
+    SELECT history.amount FROM history JOIN users ON users.id=history.owner
+    WHERE users.agency=? AND users.account=? AND history.action='REFUND'
+    ORDER BY history.id;
+    ''', (agency, account))
+    return [row[0] for row in rows]
+
+
+
+def log_transaction(directory, state, names, created_at=None):
+    """ Log a transaction in the catalog, as a coordinator that crashes right after would.
+
+    Returns:
+        int: Its id, to prepare it in the databases taking part.
+    """
+    conn = sqlite3.connect(os.path.join(directory, CATALOG))
+    try:
+        with conn:
+            cursor = conn.execute('''
+            INSERT INTO transactions (state, shards, created_at) VALUES (?, ?, ?);
+            ''', (state, '[' + ', '.join('"{}"'.format(name) for name in names) + ']',
+                  int(time.time()) if created_at is None else created_at))
+            return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+
+def open_transactions(directory):
+    """ Returns: list: (id, state) of transactions still logged in the catalog. """
+    conn = sqlite3.connect(os.path.join(directory, CATALOG))
+    try:
+        return conn.execute('SELECT id, state FROM transactions ORDER BY id;').fetchall()
+    finally:
+        conn.close()
+
+
+
+def expect_reconciled(d_manager):
+    """ Raises: CheckFailed: If any balance doesn't agree with its history. """
+    mismatches = d_manager.reconcile()['mismatches']
+    expect(not mismatches, 'balances disagree with history: {}', mismatches)
+
+
+
+def check_cross_shard_abort(directory):
+    """ A transfer between agencies is aborted when another shard can't prepare: the held
+    debit is refunded, with a REFUND register, usage of its limit is given back, and
+    nothing is left in the middle. """
+    with ShardedPersistence(directory, concurrent=True) as d_manager, \
+            ShardedPersistence(directory, concurrent=True) as other:
+        d_manager.set_limit('A1', '10000-1', 'TRANSFERING', Persistence.DAY, 5000)
+        payer = d_manager.add_user('A1', '10000-1', PASSWORD, 10000)
+        payee = d_manager.add_user('A2', '20000-2', PASSWORD, 0)
+        drained = d_manager.add_user('A2', '30000-3', PASSWORD, 5000)
+
+        payer.authorize()
+        expect(payer.transfer_to(3000, payee), 'transfer refused')
+        drained.authorize()
+        expect(drained.withdraw_cash(0, 1, 0), 'withdraw refused')
+
+        # another process withdraws it first, so shard A2 fails to prepare after A1 did
+        rival = other.find_user('A2', '30000-3')
+        rival.authorize()
+        expect(rival.withdraw_cash(0, 1, 0), 'rival withdraw refused')
+        other.update_users()
+
+        try:
+            d_manager.update_users()
+            raise CheckFailed('conflicting transaction has been committed')
+        except ConcurrencyError:
+            pass
+
+        shard_a1, shard_a2 = other.get_shard('A1'), other.get_shard('A2')
+        expect(balance_of(shard_a1, 'A1', '10000-1') == 10000, 'debit not refunded')
+        expect(refunds_of(shard_a1, 'A1', '10000-1') == [3000], 'no REFUND register')
+        expect(balance_of(shard_a2, 'A2', '20000-2') == 0, 'credit of aborted transfer applied')
+        expect(balance_of(shard_a2, 'A2', '30000-3') == 0, 'rival withdraw lost')
+        expect(payer.get_balance() == 10000 and payee.get_balance() == 0,
+               'memory not reloaded: {} and {}', payer.get_balance(), payee.get_balance())
+        expect(not shard_a1.list_prepared() and not shard_a2.list_prepared(),
+               'prepared changes left')
+        expect(not open_transactions(directory), 'transaction left in the catalog')
+        remaining = other.get_remaining_limit(other.find_user('A1', '10000-1'), 'TRANSFERING')
+        expect(remaining == 5000, 'usage of aborted transfer kept, {} remaining', remaining)
+        expect_reconciled(other)
+
+
+
+def check_recovery(directory):
+    """ Transactions left by a crashed coordinator are finished on reopening: committed
+    ones are applied, stale preparing ones refunded, recent preparing ones left alone. """
+    def crash(state, amount, names, created_at=None):
+        """ Prepare a transfer from A1 to A2 in some databases and stop there. """
+        with ShardedPersistence(directory) as d_manager:
+            payer = d_manager.find_user('A1', '10000-1')
+            payer.authorize()
+            expect(payer.transfer_to(amount, d_manager.find_user('A2', '20000-2')),
+                   'transfer refused')
+            txn_id = log_transaction(directory, state, ['A1', 'A2'], created_at)
+            for name in names:
+                d_manager.get_shard(name).prepare(txn_id)
+            return txn_id
+
+    with ShardedPersistence(directory) as d_manager:
+        d_manager.add_user('A1', '10000-1', PASSWORD, 10000)
+        d_manager.add_user('A2', '20000-2', PASSWORD, 0)
+
+    crash('committed', 1000, ['A1', 'A2'])
+    with ShardedPersistence(directory) as d_manager:
+        shard_a1, shard_a2 = d_manager.get_shard('A1'), d_manager.get_shard('A2')
+        expect(balance_of(shard_a1, 'A1', '10000-1') == 9000, 'committed debit lost')
+        expect(balance_of(shard_a2, 'A2', '20000-2') == 1000, 'committed credit not applied')
+        expect(d_manager.find_user('A2', '20000-2').get_balance() == 1000,
+               'recovered credit not loaded')
+        expect(not shard_a1.list_prepared() and not shard_a2.list_prepared(),
+               'committed changes left prepared')
+        expect(not open_transactions(directory), 'committed transaction left in the catalog')
+
+    crash('preparing', 2000, ['A1'], int(time.time()) - STALE_TRANSACTION_S - 1)
+    with ShardedPersistence(directory) as d_manager:
+        shard_a1 = d_manager.get_shard('A1')
+        expect(balance_of(shard_a1, 'A1', '10000-1') == 9000, 'stale debit not refunded')
+        expect(refunds_of(shard_a1, 'A1', '10000-1') == [2000], 'no REFUND register')
+        expect(balance_of(d_manager.get_shard('A2'), 'A2', '20000-2') == 1000,
+               'credit of aborted transfer applied')
+        expect(not open_transactions(directory), 'stale transaction left in the catalog')
+
+    txn_id = crash('preparing', 500, ['A1'])
+    with ShardedPersistence(directory) as d_manager: # its coordinator may still be at it
+        shard_a1 = d_manager.get_shard('A1')
+        expect(balance_of(shard_a1, 'A1', '10000-1') == 8500, 'recent debit not held')
+        expect(shard_a1.list_prepared() == [txn_id], 'recent transaction finished')
+        expect(open_transactions(directory) == [(txn_id, 'preparing')],
+               'recent transaction decided')
+
+    conn = sqlite3.connect(os.path.join(directory, CATALOG)) # then it decides, and crashes
+    with conn:
+        conn.execute("UPDATE transactions SET state='aborted' WHERE id=?;", (txn_id,))
+    conn.close()
+    with ShardedPersistence(directory) as d_manager:
+        shard_a1 = d_manager.get_shard('A1')
+        expect(balance_of(shard_a1, 'A1', '10000-1') == 9000, 'aborted debit not refunded')
+        expect(refunds_of(shard_a1, 'A1', '10000-1') == [2000, 500], 'no REFUND register')
+        expect(not shard_a1.list_prepared(), 'aborted changes left prepared')
+        expect(not open_transactions(directory), 'aborted transaction left in the catalog')
+        expect_reconciled(d_manager)
+
+
+
+def withdraw(agency, account, *bills, atm_id=None):
+    """ Returns: function: Change withdrawing bills from an user (and from an ATM's
+    cassettes, if atm_id is given), True if it's been made in memory. """
+    def change(d_manager):
+        """ Withdraw from the user in this database. """
+        user = d_manager.find_user(agency, account)
+        user.authorize()
+        counter = d_manager.load_inventory(atm_id) if atm_id is not None else None
+        return user.withdraw_cash(*bills, counter=counter) and \
+            (counter is None or counter.take(bills))
+    return change
+
+
+
+def race(path, change):
+    """ Make the same change in two processes, each one within bounds alone, and save them
+    in turn: the second one must be refused, and its users reloaded. """
+    first, second = Persistence(path, concurrent=True), Persistence(path, concurrent=True)
+    try:
+        expect(change(first) and change(second), 'change refused in memory')
+        first.update_users()
+        try:
+            second.update_users()
+            raise CheckFailed('conflicting change has been saved')
+        except ConcurrencyError as error:
+            for user in error.users:
+                saved = balance_of(second, user.get_agency(), user.get_account())
+                expect(user.get_balance() == saved, 'memory not reloaded: {} instead of {}',
+                       user.get_balance(), saved)
+    finally:
+        first.close()
+        second.close()
+
+
+
+def check_conflicts(directory):
+    """ Two processes in concurrent mode change the same rows: the second one to save is
+    refused as a whole when a balance, a limit or a cassette would be exceeded, and
+    batch.py replays a refused chunk so only the conflicting operation fails. """
+    path = os.path.join(directory, 'users.db')
+    with Persistence(path, concurrent=True) as d_manager:
+        d_manager.add_user('A9', '10000-1', PASSWORD, 10000)
+        d_manager.add_user('A9', '20000-2', PASSWORD, 20000)
+        d_manager.add_user('A9', '30000-3', PASSWORD, 20000)
+        d_manager.set_limit('A9', '20000-2', 'WITHDRAWING', Persistence.DAY, 10000)
+        d_manager.set_cassette('ATM9', 2000, 3)
+
+    race(path, withdraw('A9', '10000-1', 0, 1, 1)) # 7000 twice, out of 10000
+    race(path, withdraw('A9', '20000-2', 0, 0, 3)) # 6000 twice, limit of 10000
+    race(path, withdraw('A9', '30000-3', 3, atm_id='ATM9')) # 3 bills twice, out of 3
+
+    with Persistence(path, concurrent=True) as d_manager:
+        expect(balance_of(d_manager, 'A9', '10000-1') == 3000, 'balance overdrawn')
+        expect(balance_of(d_manager, 'A9', '20000-2') == 14000, 'limit exceeded')
+        remaining = d_manager.get_remaining_limit(d_manager.find_user('A9', '20000-2'),
+                                                  'WITHDRAWING')
+        expect(remaining == 4000, 'usage of refused withdraw saved, {} remaining', remaining)
+        expect(balance_of(d_manager, 'A9', '30000-3') == 14000, 'cassette overdrawn')
+        stock = d_manager.load_inventory('ATM9').get_stock()
+        expect(stock == {2000: 0}, 'cassette overdrawn: {}', stock)
+        expect_reconciled(d_manager)
+
+    # a batch chunk withdrawing what another process has just taken is replayed
+    with Persistence(path, concurrent=True) as d_manager, \
+            Persistence(path, concurrent=True) as other:
+        expect(withdraw('A9', '10000-1', 0, 0, 1)(other), 'withdraw refused')
+        other.update_users()
+        operations = [
+            (1, {'operation': 'deposit', 'agency': 'A9', 'account': '30000-3',
+                 'amount': 500}, None),
+            (2, {'operation': 'withdraw', 'agency': 'A9', 'account': '10000-1',
+                 'amount': 2000}, None),
+        ]
+        errors = list(apply_operations(d_manager, operations))
+        expect([line_no for line_no, _ in errors] == [2], 'batch errors: {}', errors)
+        expect(balance_of(d_manager, 'A9', '30000-3') == 14500, 'deposit of the chunk lost')
+        expect(balance_of(d_manager, 'A9', '10000-1') == 1000, 'conflicting withdraw saved')
+        expect_reconciled(d_manager)
+
+
+
+CHECKS = {
+    'cross-shard-abort': check_cross_shard_abort,
+    'recovery': check_recovery,
+    'conflicts': check_conflicts,
+}
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if every check passed, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Check two-phase commits and conflicts.')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='checks to run: ' + ', '.join(sorted(CHECKS)) + ' (default: all)')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in CHECKS:
+            parser.error('unknown check ' + name)
+
+    failures = 0
+    for name in args.names or sorted(CHECKS):
+        with tempfile.TemporaryDirectory(prefix='atm-check-') as directory:
+            try:
+                CHECKS[name](directory)
+                print('ok {}'.format(name))
+            except CheckFailed as error:
+                failures += 1
+                print('FAILED {}: {}'.format(name, error))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
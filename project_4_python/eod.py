@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to run end of day jobs, in parallel: accounts are split in shards (by
+agency, or by ranges of ids) and each shard is processed by a pool of processes, each one
+with a connection of its own. Results of every shard are merged in a single report (JSON).
+
+Jobs, in this order for each shard:
+    interest   : posts daily interest (INTEREST) on positive balances, of --interest-bps a year.
+    fee        : charges --fee-cents (FEE) of accounts with enough balance.
+    statements : writes the day's statement of each account with activity, as
+                 DIR/YYYY-MM-DD/AGENCY/ACCOUNT.csv (see statement.py).
+    reconcile  : checks balances with history, see reconcile.py. It's run by agency, so
+                 with --shard-by id, it's run once for all agencies, after other jobs.
+Postings of a day are made once: each account gets a job's posting of a day at most once,
+whatever the sharding of each run (eg: a retry with other --shards), and days are posted
+in order (an account already posted for a later day is skipped). Postings are dated at
+the last second of the business day, so its statements include them.
+Writers still take turns on the database lock, but reading, computing and formatting of
+every shard run at the same time.
+
+Usage: python3 eod.py [--date YYYY-MM-DD] [--jobs interest,fee,statements,reconcile]
+                      [--interest-bps 0] [--fee-cents 0] [--statements-dir statements]
+                      [--shard-by agency|id] [--shards 32] [--workers N] [--db users.db]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import sys
+import time
+
+from atm import Persistence, User
+
+JOBS = ('interest', 'fee', 'statements', 'reconcile')
+MERGED_BY_MAX = ('history_id',) # results that aren't added when merging shards
+
+_d_manager = None # of this worker process, see worker_persistence
+
+
+
+def worker_persistence(db_path):
+    """ Returns: Persistence: The one of this process (opened once, users aren't loaded). """
+    global _d_manager # pylint: disable=global-statement
+    if _d_manager is None:
+        _d_manager = Persistence(db_path, concurrent=True, preload=False)
+    return _d_manager
+
+
+
+def shard_condition(shard):
+    """ Get SQL condition over users table selecting accounts of a shard.
+
+    Args:
+        shard (tuple): ('agency', agency) or ('ids', first id, last id).
+
+    Returns:
+        tuple: (SQL condition, its parameters).
+    """
+    if shard[0] == 'agency':
+        return 'users.agency=?', (shard[1],)
+    return 'users.id BETWEEN ? AND ?', (shard[1], shard[2])
+
+
+
+def shard_name(shard):
+    """ Returns: str: Identification of a shard, eg: 'agency:A1' or 'ids:1-1000'. """
+    if shard[0] == 'agency':
+        return 'agency:' + shard[1]
+    return 'ids:{}-{}'.format(shard[1], shard[2])
+
+
+
+def list_shards(d_manager, shard_by, shards):
+    """ Split accounts in shards.
+
+    Args:
+        d_manager (Persistence): Where accounts are.
+        shard_by         (str): 'agency' (one shard per agency) or 'id' (ranges of ids).
+        shards           (int): Quantity of shards, for ranges of ids.
+
+    Returns:
+        list: Shards, see shard_condition.
+    """
+    if shard_by == 'agency':
+        return [('agency', row[0]) for row in d_manager.query('''
+        SELECT DISTINCT agency FROM users ORDER BY agency;
+        ''')]
+
+    first, last = d_manager.query('SELECT MIN(id), MAX(id) FROM users;')[0]
+    if first is None:
+        return []
+    size = (last - first) // shards + 1
+    return [('ids', start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+
+
+
+def post(d_manager, day, job, shard, action, amount_sql, amount_params):
+    """ Post an amount computed from balance to every account of a shard (with history),
+    in a single transaction, once per day and account (see eod_posted table).
+
+    Args:
+        d_manager (Persistence): Where accounts are.
+        day              (str): Business day, YYYY-MM-DD.
+        job              (str): Name of the job, see JOBS.
+        shard          (tuple): See shard_condition.
+        action           (str): INTEREST (added) or FEE (subtracted).
+        amount_sql       (str): SQL expression of the amount in cents, over users columns
+                                (accounts where it isn't positive are skipped).
+        amount_params  (tuple): Its parameters.
+
+    Returns:
+        dict: 'accounts' and 'amount' (total in cents) posted, 'rerun' if this shard had
+              already run this job for that day (accounts already posted are skipped).
+    """
+    condition, params = shard_condition(shard)
+    sign = '+' if action in User.CREDIT_ACTIONS else '-'
+    posted_at = int(time.mktime((datetime.strptime(day, '%Y-%m-%d') +
+                                 timedelta(days=1)).timetuple())) - 1
+    with d_manager.transaction(immediate=True) as cursor:
+        cursor.execute('''
+        INSERT OR IGNORE INTO eod_runs (day, job, shard, created_at) VALUES (?, ?, ?, ?);
+        ''', (day, job, shard_name(shard), int(time.time())))
+        rerun = cursor.rowcount == 0
+
+        # amounts are computed once, from balances before posting (temp is by connection)
+        cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS postings (
+            owner  INTEGER NOT NULL PRIMARY KEY,
+            amount INTEGER NOT NULL
+        );
+        ''')
+        cursor.execute('DELETE FROM temp.postings;')
+        cursor.execute('''
+        INSERT INTO temp.postings (owner, amount)
+        SELECT users.id, {amount} FROM users
+        LEFT JOIN eod_posted ON eod_posted.owner=users.id AND eod_posted.job=?
+        WHERE {condition} AND {amount}>0 AND (eod_posted.day IS NULL OR eod_posted.day<?);
+        '''.format(amount=amount_sql, condition=condition),
+                       amount_params + (job,) + params + amount_params + (day,))
+
+        cursor.execute('''
+        INSERT OR REPLACE INTO eod_posted (owner, job, day) SELECT owner, ?, ? FROM temp.postings;
+        ''', (job, day))
+
+        cursor.execute('''
+        INSERT INTO history (owner, created_at, action, amount)
+        SELECT owner, ?, ?, amount FROM temp.postings;
+        ''', (posted_at, action))
+        accounts = cursor.rowcount
+
+        cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM temp.postings;')
+        amount = cursor.fetchone()[0]
+
+        cursor.execute('''
+        UPDATE users
+        SET balance=balance{}(SELECT amount FROM temp.postings WHERE owner=users.id),
+            version=version+1
+        WHERE id IN (SELECT owner FROM temp.postings);
+        '''.format(sign))
+
+    return {'accounts': accounts, 'amount': amount, 'rerun': rerun}
+
+
+
+def write_statements(d_manager, day, shard, directory):
+    """ Write the day's statement of each account of a shard with activity in that day.
+
+    Returns:
+        dict: 'accounts' (files written) and 'registers'.
+    """
+    since = datetime.strptime(day, '%Y-%m-%d')
+    until = since + timedelta(days=1)
+    condition, params = shard_condition(shard)
+    rows = d_manager.query('''
+    SELECT DISTINCT users.id, users.agency, users.account
+    FROM users
+    JOIN history ON history.owner=users.id AND history.created_at>=? AND history.created_at<?
+    WHERE {};
+    '''.format(condition), (int(time.mktime(since.timetuple())),
+                            int(time.mktime(until.timetuple()))) + params)
+
+    registers = 0
+    conn = d_manager.open_reader() # a single one for every statement of the shard
+    try:
+        for user_id, agency, account in rows:
+            user = User(agency, account, None, user_id=user_id)
+            folder = os.path.join(directory, day, agency)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, account + '.csv'), 'w', newline='') as out_file:
+                registers += d_manager.export_statement(user, out_file, 'csv', since, until,
+                                                        conn)
+    finally:
+        conn.close()
+
+    return {'accounts': len(rows), 'registers': registers}
+
+
+
+def run_shard(db_path, shard, options):
+    """ Run jobs of a shard, in a worker process.
+
+    Args:
+        db_path  (str): Database file path, None for default.
+        shard  (tuple): See shard_condition.
+        options (dict): day, jobs, interest_bps, fee_cents and statements_dir.
+
+    Returns:
+        dict: Job -> its result.
+    """
+    d_manager = worker_persistence(db_path)
+    day, jobs = options['day'], options['jobs']
+    results = {}
+
+    if 'interest' in jobs and options['interest_bps'] > 0:
+        results['interest'] = post(d_manager, day, 'interest', shard, 'INTEREST',
+                                   'users.balance*?/3650000', (options['interest_bps'],))
+    if 'fee' in jobs and options['fee_cents'] > 0:
+        results['fee'] = post(d_manager, day, 'fee', shard, 'FEE',
+                              'CASE WHEN users.balance>=? THEN ? ELSE 0 END',
+                              (options['fee_cents'], options['fee_cents']))
+    if 'statements' in jobs:
+        results['statements'] = write_statements(d_manager, day, shard,
+                                                 options['statements_dir'])
+    if 'reconcile' in jobs and shard[0] == 'agency':
+        results['reconcile'] = d_manager.reconcile(shard[1])
+
+    return results
+
+
+
+def merge(results):
+    """ Merge results of many shards (or of the same job of them).
+
+    Returns:
+        dict: Numbers are summed (but MERGED_BY_MAX ones), lists are concatenated, dicts
+              are merged recursively and anything else is taken from the last result.
+    """
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, dict):
+                merged[key] = merge([merged.get(key, {}), value])
+            elif key in MERGED_BY_MAX:
+                merged[key] = max(merged.get(key, value), value)
+            elif isinstance(value, bool) or not isinstance(value, (int, float, list)):
+                merged[key] = value
+            else:
+                merged[key] = merged.get(key, type(value)()) + value
+    return merged
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if done, 1 if there are reconciliation mismatches.
+    """
+    parser = argparse.ArgumentParser(description='Run ATM end of day jobs in parallel.')
+    parser.add_argument('--date', default=datetime.now().strftime('%Y-%m-%d'),
+                        help='business day, YYYY-MM-DD (default: today)')
+    parser.add_argument('--jobs', default=','.join(JOBS),
+                        help='comma separated, among {} (default: all)'.format(', '.join(JOBS)))
+    parser.add_argument('--interest-bps', type=int, default=0,
+                        help='yearly interest in basis points (default: 0, no posting)')
+    parser.add_argument('--fee-cents', type=int, default=0,
+                        help='fee charged of each account (default: 0, no charging)')
+    parser.add_argument('--statements-dir', default='statements')
+    parser.add_argument('--shard-by', choices=('agency', 'id'), default='agency')
+    parser.add_argument('--shards', type=int, default=32, help='for --shard-by id')
+    parser.add_argument('--workers', type=int, default=None, help='default: one per CPU')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    args = parser.parse_args(argv)
+
+    jobs = [job.strip() for job in args.jobs.split(',') if job.strip()]
+    for job in jobs:
+        if job not in JOBS:
+            parser.error('unknown job: ' + job)
+    datetime.strptime(args.date, '%Y-%m-%d') # validating it
+    options = {'day': args.date, 'jobs': jobs, 'interest_bps': args.interest_bps,
+               'fee_cents': args.fee_cents, 'statements_dir': args.statements_dir}
+
+    started = time.perf_counter()
+    with Persistence(args.db, preload=False) as d_manager: # installing or upgrading it once
+        shards = list_shards(d_manager, args.shard_by, args.shards)
+
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(run_shard, args.db, shard, options) for shard in shards]
+            report = merge(future.result() for future in futures)
+
+        if 'reconcile' in jobs and args.shard_by != 'agency':
+            report['reconcile'] = d_manager.reconcile()
+
+    report.update({'day': args.date, 'shards': len(shards),
+                   'elapsed_s': time.perf_counter() - started})
+    json.dump(report, sys.stdout, indent=2)
+    print('')
+    return 1 if report.get('reconcile', {}).get('mismatches') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
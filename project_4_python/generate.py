@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Generate a database of synthetic users and history, compatible with users.db,
+for load testing and capacity planning. Same seed (and end date), same data.
+
+Distributions try to look like a real bank: a few agencies have most accounts, balances
+are log-normal, a few users make most operations, operations happen mostly in business
+hours, and withdrawals are multiples of $10 up to User.MAX_WITHDRAW. A transfer is
+registered as TRANSFERING by its sender and RECEIVING by its receiver, like User does.
+Every user has the same password (hashing millions of them would take hours).
+
+Rows are bulk inserted in large transactions, without journal nor fsyncs (a failed
+generation is just run again), and indexes are built once, after all rows are in.
+
+Usage: python3 generate.py users.db [--users 1000000] [--agencies 500]
+                           [--history-per-user 5] [--days 365] [--end-date 2025-01-01]
+                           [--seed 0] [--password pass] [--force]
+"""
+
+from bisect import bisect
+from datetime import datetime
+import argparse
+import calendar
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from atm import Persistence, User
+
+LOAD_PRAGMAS = ( # only while loading, Persistence sets its own ones when it's opened
+    'PRAGMA journal_mode=OFF;',
+    'PRAGMA synchronous=OFF;',
+    'PRAGMA locking_mode=EXCLUSIVE;',
+    'PRAGMA temp_store=MEMORY;',
+    'PRAGMA cache_size=-262144;', # in KiB, ie, 256MB
+)
+
+BATCH_SIZE = 100000 # rows per executemany
+END_DATE = '2025-01-01' # history ends at its midnight (UTC), whatever day it's generated
+ACTIONS_WEIGHTS = (('RECEIVING', 45), ('WITHDRAWING', 35), ('TRANSFERING', 20))
+HOURS_WEIGHTS = (1, 1, 1, 1, 1, 2, 4, 8, 14, 16, 16, 16, 18, 16, 14, 14, 14, 16, 16, 12, 8, 5, 3, 2)
+
+
+
+class WeightedChoice(object):
+    """ Random choice of indexes by weight, in O(log n) (random.choices needs Python 3.6). """
+
+    __cumulative = ()
+    __rng = None
+
+
+
+    def __init__(self, rng, weights):
+        """ Constructor.
+
+        Args:
+            rng (Random): Random generator.
+            weights (seq): Weight of each index.
+        """
+        self.__rng = rng
+        self.__cumulative = list(itertools.accumulate(weights))
+
+
+
+    def __call__(self):
+        """ Returns: int: A random index. """
+        return bisect(self.__cumulative, self.__rng.random() * self.__cumulative[-1])
+
+
+
+def generate_users(rng, users, agencies, password):
+    """ Yield users rows: (id, agency, account, password, balance). """
+    agency_of = WeightedChoice(rng, [1 / (rank + 1) for rank in range(agencies)]) # Zipf
+    for user_id in range(1, users + 1):
+        agency = 'A{}'.format(agency_of() + 1)
+        account = '{:07d}-{}'.format(user_id, user_id % 10)
+        balance = int(rng.lognormvariate(math.log(150000), 1.5)) # median $1500
+        yield user_id, agency, account, password, balance
+
+
+
+def generate_history(rng, users, rows, days, end_date=END_DATE):
+    """ Yield history rows: (owner, created_at, action, amount, counterparty), in time order.
+
+    Args:
+        rng   (Random): Random generator.
+        users    (int): Quantity of users (ids from 1 to it).
+        rows     (int): Approximate quantity of rows.
+        days     (int): Rows are spread over these days, before end_date.
+        end_date (str): YYYY-MM-DD, history ends at its midnight (UTC).
+    """
+    owner_of = WeightedChoice(rng, [rng.paretovariate(1.5) for _ in range(users)])
+    action_of = WeightedChoice(rng, [weight for action, weight in ACTIONS_WEIGHTS])
+    hour_of = WeightedChoice(rng, HOURS_WEIGHTS)
+
+    end = calendar.timegm(datetime.strptime(end_date, '%Y-%m-%d').timetuple())
+    midnight = end - days * 86400
+    operations_per_day = rows / days / (1 + ACTIONS_WEIGHTS[2][1] / 100) # transfers are 2 rows
+    for day in range(days):
+        moments = sorted(midnight + day * 86400 + hour_of() * 3600 + rng.randrange(3600)
+                         for _ in range(int(rng.gauss(operations_per_day,
+                                                      operations_per_day ** 0.5) + 0.5)))
+        for created_at in moments:
+            owner = owner_of() + 1
+            action = ACTIONS_WEIGHTS[action_of()][0]
+            if action == 'WITHDRAWING':
+                amount = rng.randrange(1, User.MAX_WITHDRAW // 1000 + 1) * 1000
+            else:
+                amount = int(rng.lognormvariate(math.log(10000), 1.2)) + 1 # median $100
+
+            if action == 'TRANSFERING':
+                counterparty = owner_of() + 1
+                yield owner, created_at, action, amount, counterparty
+                yield counterparty, created_at, 'RECEIVING', amount, None
+            else:
+                yield owner, created_at, action, amount, None
+
+
+
+def insert_batches(cursor, sql, rows):
+    """ Bulk insert rows, BATCH_SIZE at a time. Returns: int: Quantity of rows. """
+    count = 0
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            return count
+        cursor.executemany(sql, batch)
+        count += len(batch)
+
+
+
+def generate(path, users, agencies=500, history_per_user=5, days=365, seed=0, password='pass',
+             end_date=END_DATE):
+    """ Create a new database with synthetic data.
+
+    Args:
+        path             (str): New database file path (it must not exist).
+        users            (int): Quantity of users.
+        agencies         (int): Quantity of agencies, named A1, A2, ...
+        history_per_user (int): Average quantity of history rows per user.
+        days             (int): History is spread over these days, before end_date.
+        seed             (int): For the random generator, same seed same data.
+        password         (str): Password of every user.
+        end_date         (str): YYYY-MM-DD, history ends at its midnight (UTC).
+
+    Returns:
+        dict: Quantity of rows of each table.
+    """
+    rng = random.Random(seed)
+    password_hash = User.HASHER.hash(password)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        for pragma in LOAD_PRAGMAS:
+            cursor.execute(pragma)
+
+        cursor.execute('BEGIN;')
+        Persistence.create_schema(cursor, indexes=False)
+        counts = {
+            'users': insert_batches(cursor, '''
+            INSERT INTO users (id, agency, account, password, balance)
+            VALUES (?, ?, ?, ?, ?);
+            ''', generate_users(rng, users, agencies, password_hash)),
+
+            'history': insert_batches(cursor, '''
+            INSERT INTO history (owner, created_at, action, amount, counterparty)
+            VALUES (?, ?, ?, ?, ?);
+            ''', generate_history(rng, users, users * history_per_user, days, end_date)),
+        }
+        Persistence.create_indexes(cursor)
+        Persistence.create_checkpoints(cursor) # synthetic balances don't come from history
+        cursor.execute('COMMIT;')
+
+        cursor.execute('ANALYZE;') # statistics for the query planner
+    finally:
+        conn.close()
+
+    return counts
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if generated, 1 if database already exists.
+    """
+    parser = argparse.ArgumentParser(description='Generate a synthetic ATM database.')
+    parser.add_argument('path', help='database file path')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--agencies', type=int, default=500)
+    parser.add_argument('--history-per-user', type=int, default=5)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--end-date', default=END_DATE,
+                        help='history ends at this day, YYYY-MM-DD (default: {})'.format(END_DATE))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--password', default='pass', help='of every user (default: pass)')
+    parser.add_argument('--force', action='store_true', help='replace an existent database')
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.path):
+        if not args.force:
+            print('Database already exists, use --force to replace it.', file=sys.stderr)
+            return 1
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.path + suffix):
+                os.remove(args.path + suffix)
+
+    started = time.perf_counter()
+    try:
+        datetime.strptime(args.end_date, '%Y-%m-%d')
+    except ValueError:
+        parser.error('invalid --end-date ' + args.end_date)
+
+    counts = generate(args.path, args.users, args.agencies, args.history_per_user,
+                      args.days, args.seed, args.password, args.end_date)
+    print('{} users and {} history rows in {:.1f}s.'.format(
+        counts['users'], counts['history'], time.perf_counter() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to check or change limits of withdraws and transfers (see
+Persistence.set_limit).
+
+Usage: python3 limits.py [--set AGENCY ACCOUNT ACTION WINDOW AMOUNT ...]
+                         [--remove AGENCY ACCOUNT ACTION WINDOW ...] [--db users.db]
+AGENCY and ACCOUNT may be * (any of them), and ACCOUNT may be '' (the agency as a whole).
+ACTION is WITHDRAWING or TRANSFERING. WINDOW is 'day' (the calendar day) or a rolling
+window in seconds, or with a unit (eg: 30m, 12h, 7d). AMOUNT is in $ (eg: 1500.00).
+Limits are always listed at the end.
+"""
+
+import argparse
+import sys
+
+from atm import Persistence, User, to_cents, format_cents
+
+WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+
+def parse_window(text):
+    """ Returns: int: Window in seconds, or Persistence.DAY, from 'day', '3600', '12h'... """
+    if text == 'day':
+        return Persistence.DAY
+
+    unit = WINDOW_UNITS.get(text[-1:], None)
+    try:
+        window = int(text[:-1]) * unit if unit is not None else int(text)
+    except ValueError:
+        raise ValueError('expected day or seconds, got ' + text)
+
+    if window <= 0:
+        raise ValueError('invalid window ' + text)
+    return window
+
+
+
+def format_window(window):
+    """ Returns: str: A window as parse_window reads it. """
+    if window == Persistence.DAY:
+        return 'day'
+    for unit in ('d', 'h', 'm'):
+        if window % WINDOW_UNITS[unit] == 0:
+            return '{}{}'.format(window // WINDOW_UNITS[unit], unit)
+    return str(window)
+
+
+
+def parse_limit(values, with_amount):
+    """ Returns: tuple: set_limit arguments from command line values. """
+    agency, account, action, window = values[:4]
+    if action not in User.LIMITED_ACTIONS:
+        raise ValueError('action must be one of ' + ', '.join(User.LIMITED_ACTIONS))
+
+    max_amount = to_cents(values[4]) if with_amount else None
+    if max_amount is not None and max_amount < 0:
+        raise ValueError('invalid amount ' + values[4])
+    return agency, account, action, parse_window(window), max_amount
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if done, 2 if a limit is invalid.
+    """
+    parser = argparse.ArgumentParser(description='Check or change ATM limits.')
+    parser.add_argument('--set', nargs=5, action='append', default=[],
+                        metavar=('AGENCY', 'ACCOUNT', 'ACTION', 'WINDOW', 'AMOUNT'))
+    parser.add_argument('--remove', nargs=4, action='append', default=[],
+                        metavar=('AGENCY', 'ACCOUNT', 'ACTION', 'WINDOW'))
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    args = parser.parse_args(argv)
+
+    try:
+        changes = [parse_limit(values, True) for values in args.set] + \
+            [parse_limit(values, False) for values in args.remove]
+    except ValueError as error:
+        parser.error(str(error))
+
+    with Persistence(args.db, preload=False) as d_manager:
+        for limit in changes:
+            d_manager.set_limit(*limit)
+
+        for agency, account, action, window, max_amount in d_manager.get_limits():
+            print('{} {} {} {}: ${}'.format(agency, account or "''", action,
+                                            format_window(window), format_cents(max_amount)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,160 +4,380 @@
 # pylint: disable=C0103
 # pylint: disable=C0325
 
-""" Main script to simulate some kind of ATM (Automatic Teller Machine). """
+""" Main script to simulate some kind of ATM (Automatic Teller Machine).
+Usage: python3 main.py [--connect HOST:PORT] [--atm-id ATM_ID] [--snapshot FILE] [--db FILE]
+                       [COMMAND ...]
+With --connect, it's a thin terminal of an ATM server (see server.py),
+otherwise it uses the local database by itself.
+With --atm-id, bills are dispensed from cassettes of that ATM (see cassettes.py).
+Withdraws and transfers beyond daily or rolling limits are refused (see limits.py).
+With --snapshot, users are loaded from that file when it's up to date (see AccountSnapshot),
+so starting takes milliseconds; it's written at exit otherwise.
+
+Without a command, it's an interactive terminal. Commands are for scripts and probes:
+    balance AGENCY ACCOUNT
+    deposit AGENCY ACCOUNT AMOUNT [--to AGENCY ACCOUNT]
+    transfer AGENCY ACCOUNT AMOUNT TO_AGENCY TO_ACCOUNT
+    withdraw-plan AGENCY ACCOUNT AMOUNT
+    statement AGENCY ACCOUNT [--limit 10] [--before CURSOR]
+The account's password is read from the first line of stdin (or asked, in a terminal).
+Only the accounts involved are loaded (or asked to the server). The answer is a JSON line,
+{"ok": true, "result": ...} or {"ok": false, "error": ...} (and exit status 1), like the
+server's ones. Amounts are given in $ and answered in int cents; deposit and transfer
+answer the new balance. """
 
 from getpass import getpass
-from atm import Persistence
+import argparse
+import json
+import sys
+
+from atm import Persistence, User, to_cents, format_cents
+from session import LocalSession, RemoteSession
+
+COMMANDS_CACHE_SIZE = 16 # users kept in memory by commands, they only touch a few ones
+
+
+
+def parse_args(argv=None):
+    """ Returns: Namespace: Parsed command line, its command is None for interactive use. """
+    parser = argparse.ArgumentParser(description='Automatic Teller Machine terminal.')
+    parser.add_argument('--connect', metavar='HOST:PORT', default=None,
+                        help='use an ATM server instead of the local database')
+    parser.add_argument('--atm-id', default=None,
+                        help='dispense bills from cassettes of this ATM')
+    parser.add_argument('--snapshot', metavar='FILE', default=None,
+                        help='load users from this snapshot file, if it is up to date')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    for name, help_text in (('balance', 'balance of an account'),
+                            ('deposit', 'deposit in an account, or from it in another one'),
+                            ('transfer', 'transfer from an account to another one'),
+                            ('withdraw-plan', 'options of bills to withdraw an amount'),
+                            ('statement', 'a page of history of an account')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('agency')
+        command.add_argument('account')
+        if name in ('deposit', 'transfer', 'withdraw-plan'):
+            command.add_argument('amount', type=parse_amount, help='in $, eg: 12.50')
+        if name == 'transfer':
+            command.add_argument('to_agency')
+            command.add_argument('to_account')
+        if name == 'deposit':
+            command.add_argument('--to', nargs=2, metavar=('AGENCY', 'ACCOUNT'), default=None,
+                                 help='deposit in this account instead')
+        if name == 'statement':
+            command.add_argument('--limit', type=parse_limit, default=10)
+            command.add_argument('--before', type=parse_cursor, default=None,
+                                 help='cursor answered with previous page, to get next one')
+
+    return parser.parse_args(argv)
+
+
+
+def parse_amount(text):
+    """ Returns: int: A positive amount in cents, from $ (like batch.py checks them). """
+    try:
+        amount = to_cents(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid amount ' + text)
+
+    if not amount > 0:
+        raise argparse.ArgumentTypeError('amount must be positive, got ' + text)
+    return amount
+
+
+
+def parse_limit(text):
+    """ Returns: int: A positive quantity of registers per page. """
+    try:
+        limit = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid limit ' + text)
+
+    if not Persistence.is_count(limit):
+        raise argparse.ArgumentTypeError('limit must be positive, got ' + text)
+    return limit
+
+
+
+def parse_cursor(text):
+    """ Returns: list: A cursor of history pages, [created_at, id], from JSON. """
+    try:
+        cursor = json.loads(text)
+    except ValueError:
+        cursor = None
+
+    if not Persistence.is_cursor(cursor):
+        raise argparse.ArgumentTypeError('expected a cursor like [1700000000, 42], got ' + text)
+    return cursor
+
+
+
+def open_session(args):
+    """ Returns: LocalSession or RemoteSession: Session of this terminal. """
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        return RemoteSession(host, int(port))
+    if args.command is not None: # users on demand, see Persistence cache_size
+        return LocalSession(Persistence(args.db, concurrent=True,
+                                        cache_size=COMMANDS_CACHE_SIZE))
+    return LocalSession(Persistence(args.db, concurrent=True, # other terminals may share it
+                                    snapshot_path=args.snapshot))
+
+
+
+def read_password():
+    """ Returns: str: Password, from the first line of stdin (asked if it's a terminal). """
+    if sys.stdin.isatty():
+        return getpass('Password: ')
+    return sys.stdin.readline().rstrip('\n')
+
+
+
+def run_command(session, args):
+    """ Run a command in a session, logging in first.
+
+    Returns:
+        Result of the command.
+
+    Raises:
+        ValueError: If it can't be done, with the reason as message.
+    """
+    if args.atm_id and not session.use_atm(args.atm_id):
+        raise ValueError('ATM has no cassettes.')
+
+    is_logged_in = session.log_in(args.agency, args.account, read_password())
+    if is_logged_in is None:
+        raise ValueError('User not found.')
+    if not is_logged_in:
+        raise ValueError('Wrong password.')
+
+    if args.command == 'balance':
+        return session.get_balance()
+    if args.command == 'statement':
+        registers, before = session.get_history(limit=args.limit, before=args.before)
+        return {'registers': registers, 'before': before}
+    if args.command == 'withdraw-plan':
+        return {'denominations': list(session.get_denominations()),
+                'options': session.options_to_withdraw(args.amount) or []}
 
-d_manager = Persistence()
-logged_user = None
+    if args.command == 'deposit':
+        if args.to and not session.exists(*args.to):
+            raise ValueError('User not found.')
+        if not session.deposit(args.amount, *(args.to or ())):
+            raise ValueError('Balance can\'t hold this amount.')
+    elif not session.exists(args.to_agency, args.to_account):
+        raise ValueError('User not found.')
+    elif not session.transfer_to(args.amount, args.to_agency, args.to_account):
+        raise ValueError('Insufficient balance.')
 
-print('AUTOMATIC TELLER MACHINE')
-print('Hi, hi, Puffy AmiYumi!!!')
+    if not session.save():
+        raise ValueError('Balance has been changed by another terminal. Nothing was saved.')
+    return session.get_balance()
 
-print('')
 
-print('Users built-in...')
-print('-> Agency A1:')
-print('Account: 00000-0 | Password: pass0')
-print('Account: 11111-1 | Password: pass1')
-print('-> Agency A2')
-print('Account: 22222-2 | Password: pass2')
-print('Account: 44444-4 | Password: pass4')
-print('-> Agency A3')
-print('Account: 33333-3 | Password: pass3')
 
-print('')
+def ask_amount():
+    """ Returns: int: An amount in cents, asked again while it's invalid (like parse_amount
+    for commands, except that being positive is left to each operation). """
+    while True:
+        try:
+            return to_cents(input('Amount: $'))
+        except ValueError as error:
+            print(str(error) + '. Try again.')
+
+
+
+def interactive(args):
+    """ Interactive terminal, asking for an account and operations on it.
+
+    Returns:
+        int: Exit status.
+    """
+    session = open_session(args)
+    if args.atm_id and not session.use_atm(args.atm_id):
+        print('ATM ' + args.atm_id + ' has no cassettes, dispensing any bills.')
+    is_logged_in = False
+
+    print('AUTOMATIC TELLER MACHINE')
+    print('Hi, hi, Puffy AmiYumi!!!')
 
-print('Access now.')
-for i in range(0, 3):
     print('')
-    agency = input('Agency: ')
-    account = input('Account: ')
-    password = getpass('Password: ')
 
-    trying_user = d_manager.find_user(agency=agency, account=account)
+    print('Users built-in...')
+    print('-> Agency A1:')
+    print('Account: 00000-0 | Password: pass0')
+    print('Account: 11111-1 | Password: pass1')
+    print('-> Agency A2')
+    print('Account: 22222-2 | Password: pass2')
+    print('Account: 44444-4 | Password: pass4')
+    print('-> Agency A3')
+    print('Account: 33333-3 | Password: pass3')
+
+    print('')
+
+    print('Access now.')
+    for i in range(0, 3):
+        print('')
+        agency = input('Agency: ')
+        account = input('Account: ')
+        password = getpass('Password: ')
+
+        is_logged_in = session.log_in(agency, account, password)
 
-    if trying_user is not None:
-        if trying_user.log_in(password):
-            logged_user = trying_user
-            print('Authorized user.')
-            break
+        if is_logged_in is not None:
+            if is_logged_in:
+                print('Authorized user.')
+                break
+            else:
+                print('Wrong password.')
         else:
-            print('Wrong password.')
-    else:
-        print('User not found.')
+            print('User not found.')
 
-if logged_user is None:
-    print('\nAttempts exhausted! Goodbye!')
-    exit(666)
-else:
-    print('\nWelcome...')
+    if not is_logged_in:
+        print('\nAttempts exhausted! Goodbye!')
+        session.close()
+        return 666
+    else:
+        print('\nWelcome...')
 
-while True:
-    print('''
+    while True:
+        print('''
 Choose an option
 1 - Balance       4 - Withdraw
 2 - Extract       5 - Transfer
 3 - Deposit      6 - Exit
     ''')
-    op = input(': ')
-    print('')
-    #print(150 * '\n') # to clear the terminal
+        op = input(': ')
+        print('')
+        session.refresh() # in case it's been changed by another terminal
+        #print(150 * '\n') # to clear the terminal
+
+        if op[0] == '1': # balance
+            print('BALANCE:\n$' + format_cents(session.get_balance()))
 
-    if op[0] == '1': # balance
-        print('BALANCE:\n$' + str(logged_user.get_balance()))
+        elif op[0] == '2': # history
+            print('EXTRACT:')
+            registers, page = session.get_history(limit=10)
+            while True:
+                for register in registers:
+                    print(register)
+                if page is None or input('More? (y/n): ')[:1] not in ('y', 'Y'):
+                    break
+                registers, page = session.get_history(limit=10, before=page)
 
-    elif op[0] == '2': # history
-        print('EXTRACT:')
-        for register in logged_user.get_history():
-            print(register[0])
+        elif op[0] == '3': # deposit
+            print('DEPOSIT.')
+            amount = ask_amount()
 
-    elif op[0] == '3': # deposit
-        print('DEPOSIT.')
-        amount = float(input('Amount: $').replace(',', '.'))
+            to_another_user = input('In your own account? (y/n): ')[0]
+            to_another_user = not((to_another_user == 'y') or (to_another_user == 'Y'))
+
+            if to_another_user:
+                print('Other user data...')
+                another_user_agency = input('Agency: ')
+                another_user_account = input('Account: ')
+                if session.deposit(amount, another_user_agency, another_user_account):
+                    print('Deposit successfully in the account provided above')
+                else:
+                    print('User not found.')
+            elif session.deposit(amount):
+                print('Deposit successfully in your account.')
+            else:
+                print('Amount must be positive, and your balance must hold it.')
 
-        to_another_user = input('In your own account? (y/n): ')[0]
-        to_another_user = not((to_another_user == 'y') or (to_another_user == 'Y'))
 
-        if to_another_user:
+        elif op[0] == '4': # withdraw
+            print('WITHDRAW.')
+            denominations = session.get_denominations()
+            print('OBS: Only ' + ', '.join('$' + format_cents(value) for value in denominations)
+                  + ' bills are available.')
+            print('OBS2: The maximum value you can withdraw is $' +
+                  format_cents(User.MAX_WITHDRAW) + '.')
+            amount = ask_amount()
+
+            print('Trying to get bills options to withdraw.')
+            options = session.options_to_withdraw(amount)
+            if options is None:
+                print("This withdraw couldn't be held.")
+                print('Verify you balance and the withdraw ways available.')
+            else:
+                for i in range(0, len(options)):
+                    option = options[i]
+                    print('Option ' + str(i+1) + ':')
+                    for quantity, value in zip(option, denominations):
+                        if quantity > 0:
+                            print('\t' + str(quantity) + 'x $' + format_cents(value))
+
+                option = options[int(input('Your option: ')) - 1]
+                print('Trying to withdraw...')
+
+                if session.withdraw_cash(*option):
+                    print('Provided ' + ', '.join('{}x ${}'.format(quantity, format_cents(value))
+                                                  for quantity, value in zip(option, denominations)
+                                                  if quantity > 0) + '.')
+                    print('Withdraw successfully.')
+                else:
+                    print("An error occurred and the withdraw couldn't be held.")
+
+        elif op[0] == '5': # transfer
+            print('TRANSFER.')
             print('Other user data...')
             another_user_agency = input('Agency: ')
             another_user_account = input('Account: ')
-            another_user = d_manager.find_user(another_user_agency, another_user_account)
-            if another_user is not None:
-                logged_user.deposit(amount, another_user)
-                print('Deposit successfully in the account provided above')
+            if session.exists(another_user_agency, another_user_account):
+                amount = ask_amount()
+
+                if session.transfer_to(amount, another_user_agency, another_user_account):
+                    print('Transfer successfully.')
+                else:
+                    print('Transfer failed. Isufficient balance?')
             else:
                 print('User not found.')
-        else:
-            logged_user.deposit(amount)
-            print('Deposit successfully in your account.')
 
+        elif op[0] == '6': # logout
+            print('EXIT')
+            session.log_out()
+            print('Section closed. Exiting...')
+            print('Bye Bye!')
+            session.close()
+            return 0
 
-    elif op[0] == '4': # withdraw
-        print('WITHDRAW.')
-        print('OBS: Only $100, $50 and $20 bills are available.')
-        print('OBS2: The maximum value you can withdraw is $1000,00.')
-        amount = float(input('Amount: $').replace(',', '.'))
+        else:
+            print('Invalid option.')
 
-        print('Trying to get bills options to withdraw.')
-        options = logged_user.options_to_withdraw(amount)
-        if options is None:
-            print("This withdraw couldn't be held.")
-            print('Verify you balance and the withdraw ways available.')
+        print('')
+        input('Press Enter to save the changes and go back...')
+        if session.save():
+            print('Ok! Returning now.')
         else:
-            for i in range(0, len(options)):
-                option = options[i]
-                qtt_100s, qtt_50s, qtt_20s = (option[0], option[1], option[2])
-                print('Option ' + str(i+1) + ':')
-                if qtt_100s > 0:
-                    print('\t' + str(qtt_100s) + 'x $100')
-                if qtt_50s > 0:
-                    print('\t' + str(qtt_50s) + 'x $50')
-                if qtt_20s > 0:
-                    print('\t' + str(qtt_20s) + 'x $20')
-                i += 1
-
-            option = options[int(input('Your option: ')) - 1]
-            print('Trying to withdraw...')
-            qtt_100s, qtt_50s, qtt_20s = (option[0], option[1], option[2])
-
-            if logged_user.withdraw_cash(qtt_100s, qtt_50s, qtt_20s):
-                print('Provided {}x $100, {}x $50 e {}x $20.'
-                      .format(qtt_100s, qtt_50s, qtt_20s))
-                print('Withdraw successfully.')
-            else:
-                print("An error occurred and the withdraw couldn't be held.")
+            print('Sorry, balance has been changed by another terminal. Nothing was saved.')
 
-    elif op[0] == '5': # transfer
-        print('TRANSFER.')
-        print('Other user data...')
-        another_user_agency = input('Agency: ')
-        another_user_account = input('Account: ')
-        another_user = d_manager.find_user(another_user_agency, another_user_account)
 
-        if another_user is not None:
-            amount = float(input('Amount: $').replace(',', '.'))
 
-            if logged_user.transfer_to(amount, another_user):
-                print('Transfer successfully.')
-            else:
-                print('Transfer failed. Isufficient balance?')
-        else:
-            print('User not found.')
+def main(argv=None):
+    """ Command line entry point.
 
-    elif op[0] == '6': # logout
-        print('EXIT')
-        logged_user.log_out()
-        print('Section closed. Exiting...')
-        print('Bye Bye!')
-        exit(0)
+    Returns:
+        int: Exit status.
+    """
+    args = parse_args(argv)
+    if args.command is None:
+        return interactive(args)
 
-    else:
-        print('Invalid option.')
+    session = open_session(args)
+    try:
+        result = run_command(session, args)
+    except (ValueError, RuntimeError) as error: # RuntimeError: answered by the server
+        print(json.dumps({'ok': False, 'error': str(error)}))
+        return 1
+    finally:
+        session.close()
 
-    print('')
-    input('Press Enter to save the changes and go back...')
-    d_manager.update_users()
-    print('Ok! Returning now.')
+    print(json.dumps({'ok': True, 'result': result}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
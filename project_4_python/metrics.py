@@ -0,0 +1,364 @@
+""" Instrumentation of Persistence, User and PasswordHasher: call counts, latency histograms
+and rows read/written by each method, and by each SQL statement, plus an optional log of
+slow statements. Exported as JSON or as Prometheus text (eg: for node_exporter textfile
+collector).
+
+Nothing is changed while it's disabled, so it costs nothing: enabling it replaces
+instrumented methods by timing wrappers (and cursors by tracing ones), disabling puts
+originals back. Only one Metrics instance can be enabled at a time.
+
+    metrics = Metrics(slow_query_ms=50)
+    metrics.enable()
+    ...
+    metrics.export('atm.prom', 'prometheus')
+"""
+
+from contextlib import contextmanager
+import functools
+import inspect
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from atm import PasswordHasher, Persistence, User
+
+USER_METHODS = ('log_in', 'deposit', 'transfer_to', 'withdraw_cash', 'options_to_withdraw',
+                'register_operation')
+HASHER_METHODS = ('hash', 'verify')
+PERSISTENCE_SKIPPED = ('transaction',) # a context manager, its block would be timed apart
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0) # in seconds
+SLOW_QUERIES_KEPT = 100
+
+
+
+class Metrics(object):
+    """ Collector of calls and statements measures, see module documentation. """
+
+    __enabled = None # Metrics instance currently enabled, if any
+    __lock = None
+    __local = None # per thread: stack of names being timed, to attribute rows to them
+    __calls = None # name -> measures, see __new_measures
+    __queries = None # normalized SQL -> measures
+    __slow_queries = None # last slow statements, newest at the end
+    __slow_query_s = None
+    __slow_query_log = None # file to append slow statements to, as JSON lines
+    __originals = None # (owner class, attribute name, original function)
+
+
+
+    def __init__(self, slow_query_ms=None, slow_query_log=None):
+        """ Constructor.
+
+        Args:
+            slow_query_ms (num): Statements taking at least this long (in ms) are kept in
+                                 slow_queries, None to keep none.
+            slow_query_log (str): File path to append slow statements to, as JSON lines.
+        """
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__slow_query_s = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self.__slow_query_log = slow_query_log
+        self.__originals = []
+        self.reset()
+
+
+
+    def reset(self):
+        """ Forget every measure. """
+        with self.__lock:
+            self.__calls = {}
+            self.__queries = {}
+            self.__slow_queries = []
+
+
+
+    def is_enabled(self):
+        """ Returns: bool: True if it's collecting measures. """
+        return Metrics.__enabled is self
+
+
+
+    def enable(self):
+        """ Start collecting measures.
+
+        Raises:
+            RuntimeError: If another instance is already enabled.
+        """
+        if Metrics.__enabled is not None:
+            if Metrics.__enabled is self:
+                return
+            raise RuntimeError('Another Metrics instance is already enabled.')
+        Metrics.__enabled = self
+
+        for name, function in list(vars(Persistence).items()):
+            if inspect.isfunction(function) and not name.startswith('_') \
+                    and name not in PERSISTENCE_SKIPPED:
+                self.__wrap(Persistence, name)
+        for name in USER_METHODS:
+            self.__wrap(User, name)
+        for name in HASHER_METHODS:
+            self.__wrap(PasswordHasher, name)
+
+        self.__originals.append((Persistence, 'CURSOR_FACTORY', Persistence.CURSOR_FACTORY))
+        Persistence.CURSOR_FACTORY = self.__cursor_class()
+
+
+
+    def disable(self):
+        """ Stop collecting measures, keeping the collected ones. """
+        if Metrics.__enabled is not self:
+            return
+
+        while self.__originals:
+            owner, name, original = self.__originals.pop()
+            setattr(owner, name, original)
+        Metrics.__enabled = None
+
+
+
+    def __wrap(self, owner, name):
+        """ Replace a method of a class by a timing wrapper. """
+        original = vars(owner)[name]
+        label = owner.__name__ + '.' + name
+
+        if inspect.isgeneratorfunction(original): # timing the whole iteration
+            @functools.wraps(original)
+            def wrapper(*args, **kwargs):
+                with self.__timing(label):
+                    yield from original(*args, **kwargs)
+        else:
+            @functools.wraps(original)
+            def wrapper(*args, **kwargs):
+                with self.__timing(label):
+                    return original(*args, **kwargs)
+
+        self.__originals.append((owner, name, original))
+        setattr(owner, name, wrapper)
+
+
+
+    @contextmanager
+    def __timing(self, label):
+        """ Time a block as a call of label. """
+        stack = self.__stack()
+        stack.append(label)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            with self.__lock:
+                self.__observe(self.__calls, label, elapsed)
+
+
+
+    def __stack(self):
+        """ Returns: list: Names being timed by current thread, outermost first. """
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+
+
+    @staticmethod
+    def __new_measures():
+        """ Returns: dict: Empty measures of a call or statement. """
+        return {'count': 0, 'sum_s': 0.0, 'max_s': 0.0, 'buckets': [0] * (len(BUCKETS) + 1),
+                'rows_read': 0, 'rows_written': 0}
+
+
+
+    def __observe(self, measures_by_name, name, elapsed):
+        """ Add a duration to measures of a name. Must be called with the lock. """
+        measures = measures_by_name.get(name)
+        if measures is None:
+            measures = measures_by_name[name] = self.__new_measures()
+
+        measures['count'] += 1
+        measures['sum_s'] += elapsed
+        measures['max_s'] = max(measures['max_s'], elapsed)
+        index = 0
+        while index < len(BUCKETS) and elapsed > BUCKETS[index]:
+            index += 1
+        measures['buckets'][index] += 1
+
+
+
+    def _statement(self, sql, elapsed, rows_written, params_count):
+        """ Record an executed statement (called by tracing cursors). """
+        sql = ' '.join(sql.split())
+        with self.__lock:
+            self.__observe(self.__queries, sql, elapsed)
+            if rows_written > 0:
+                self.__add_rows(sql, 0, rows_written)
+
+            if self.__slow_query_s is None or elapsed < self.__slow_query_s:
+                return
+            entry = {'at': time.time(), 'ms': elapsed * 1000, 'sql': sql,
+                     'params': params_count, 'caller': list(self.__stack())}
+            self.__slow_queries.append(entry)
+            del self.__slow_queries[:-SLOW_QUERIES_KEPT]
+            if self.__slow_query_log is not None:
+                with open(self.__slow_query_log, 'a') as log_file:
+                    log_file.write(json.dumps(entry) + '\n')
+
+
+
+    def _rows_read(self, sql, rows):
+        """ Record rows fetched by a statement (called by tracing cursors). """
+        if rows > 0:
+            with self.__lock:
+                self.__add_rows(' '.join(sql.split()), rows, 0)
+
+
+
+    def __add_rows(self, sql, read, written):
+        """ Add rows to a statement and to every call being timed (with the lock). """
+        measures = self.__queries.setdefault(sql, self.__new_measures())
+        measures['rows_read'] += read
+        measures['rows_written'] += written
+
+        for label in set(self.__stack()):
+            measures = self.__calls.setdefault(label, self.__new_measures())
+            measures['rows_read'] += read
+            measures['rows_written'] += written
+
+
+
+    def __cursor_class(self):
+        """ Returns: class: sqlite3.Cursor that reports its statements to this instance. """
+        metrics = self
+
+        class TracingCursor(sqlite3.Cursor):
+            """ Cursor timing statements and counting rows. """
+
+            __sql = ''
+
+            def execute(self, sql, params=()):
+                started = time.perf_counter()
+                result = super(TracingCursor, self).execute(sql, params)
+                self.__sql = sql
+                metrics._statement(sql, time.perf_counter() - started,
+                                   max(self.rowcount, 0), 1)
+                return result
+
+            def executemany(self, sql, seq_of_params):
+                counted = [0]
+                def counting():
+                    """ Parameters, counting them without copying. """
+                    for params in seq_of_params:
+                        counted[0] += 1
+                        yield params
+
+                started = time.perf_counter()
+                result = super(TracingCursor, self).executemany(sql, counting())
+                self.__sql = sql
+                metrics._statement(sql, time.perf_counter() - started,
+                                   max(self.rowcount, 0), counted[0])
+                return result
+
+            def fetchone(self):
+                row = super(TracingCursor, self).fetchone()
+                metrics._rows_read(self.__sql, 0 if row is None else 1)
+                return row
+
+            def fetchmany(self, size=None):
+                rows = super(TracingCursor, self).fetchmany(size or self.arraysize)
+                metrics._rows_read(self.__sql, len(rows))
+                return rows
+
+            def fetchall(self):
+                rows = super(TracingCursor, self).fetchall()
+                metrics._rows_read(self.__sql, len(rows))
+                return rows
+
+            def __next__(self):
+                row = super(TracingCursor, self).__next__()
+                metrics._rows_read(self.__sql, 1)
+                return row
+
+        return TracingCursor
+
+
+
+    def snapshot(self):
+        """ Get collected measures.
+
+        Returns:
+            dict: {'calls': {name: measures}, 'queries': {sql: measures}, 'slow_queries':
+                  [...], 'buckets': BUCKETS}, where measures are count, sum_s, max_s,
+                  buckets (count of durations up to each bucket bound, the last one for
+                  longer durations), rows_read and rows_written.
+        """
+        with self.__lock:
+            return json.loads(json.dumps({ # deep copy
+                'buckets': BUCKETS,
+                'calls': self.__calls,
+                'queries': self.__queries,
+                'slow_queries': self.__slow_queries,
+            }))
+
+
+
+    def to_prometheus(self):
+        """ Returns: str: Collected measures in Prometheus text exposition format. """
+        snapshot = self.snapshot()
+        lines = []
+        for kind, label in (('calls', 'method'), ('queries', 'sql')):
+            metric = 'atm_{}'.format('call' if kind == 'calls' else 'query')
+            lines.append('# TYPE {}_duration_seconds histogram'.format(metric))
+            for name, measures in sorted(snapshot[kind].items()):
+                labels = '{}="{}"'.format(label, self.__escape(name))
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), measures['buckets']):
+                    cumulative += count
+                    lines.append('{}_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        metric, labels, bound, cumulative))
+                lines.append('{}_duration_seconds_sum{{{}}} {}'.format(
+                    metric, labels, measures['sum_s']))
+                lines.append('{}_duration_seconds_count{{{}}} {}'.format(
+                    metric, labels, measures['count']))
+
+            for rows in ('rows_read', 'rows_written'):
+                lines.append('# TYPE {}_{}_total counter'.format(metric, rows))
+                for name, measures in sorted(snapshot[kind].items()):
+                    lines.append('{}_{}_total{{{}="{}"}} {}'.format(
+                        metric, rows, label, self.__escape(name), measures[rows]))
+
+        return '\n'.join(lines) + '\n'
+
+
+
+    @staticmethod
+    def __escape(value):
+        """ Returns: str: A label value escaped for Prometheus text format. """
+        return re.sub(r'(["\\])', r'\\\1', value).replace('\n', '\\n')
+
+
+
+    def export(self, path, file_format='json'):
+        """ Write collected measures to a file, atomically (readers never see half a file).
+
+        Args:
+            path        (str): File path.
+            file_format (str): 'json' (see snapshot) or 'prometheus' (see to_prometheus).
+
+        Raises:
+            ValueError: For an unknown format.
+        """
+        if file_format == 'json':
+            content = json.dumps(self.snapshot(), indent=2)
+        elif file_format == 'prometheus':
+            content = self.to_prometheus()
+        else:
+            raise ValueError('Unknown metrics format: {!r}'.format(file_format))
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as out_file:
+            out_file.write(content)
+        os.replace(temp_path, path)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to reconcile balances with history, since last reconciliation
+(see Persistence.reconcile), eg: nightly. It takes as long as the day's activity does.
+
+Usage: python3 reconcile.py [--db users.db]
+Mismatches are written to stdout as JSON lines (amounts in cents), a summary to stderr.
+"""
+
+import argparse
+import json
+import sys
+
+from atm import Persistence
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if every balance agrees with history, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Reconcile ATM balances with history.')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    args = parser.parse_args(argv)
+
+    with Persistence(args.db, preload=False) as d_manager: # reconciling is pure SQL
+        report = d_manager.reconcile()
+
+    for mismatch in report['mismatches']:
+        print(json.dumps(mismatch))
+
+    print('{} account(s) and {} history row(s) checked, up to row {}: {} mismatch(es), '
+          '{} new checkpoint(s).'.format(report['accounts'], report['history_rows'],
+                                         report['history_id'], len(report['mismatches']),
+                                         report['new_checkpoints']), file=sys.stderr)
+    return 1 if report['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
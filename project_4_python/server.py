@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" ATM server: one warm process serving many terminals (see main.py --connect) through TCP.
+
+Protocol: each request is a JSON line {"action": ..., [params]}, answered by a JSON line
+{"ok": true, "result": ...} or {"ok": false, "error": ...}. Actions are LocalSession methods:
+login, exists, atm, denominations, refresh, balance, extract, deposit, withdraw_options, withdraw,
+transfer, save and logout. Changes are saved right after each one of them. Amounts are int cents.
+
+Sessions are served by an asyncio event loop, while users and database are handled by
+a single worker thread, so the loop never blocks and there's no need of locks.
+Changes of every session are saved together in group commits (see GroupCommit), and a
+change is answered only once it's durable (fsynced).
+Passwords are verified by a pool of hashing threads, so logins use every core and
+the database thread never waits for the (deliberately slow) hashing.
+
+With --shards, accounts are in a directory of databases, one per agency (or per hash range
+with --shard-buckets), see sharding.py: saving changes of different agencies doesn't
+contend on a single database lock.
+
+With --metrics, calls and statements are measured (see metrics.py) and written to a file
+every --metrics-interval seconds, eg: for Prometheus node_exporter textfile collector.
+
+Usage: python3 server.py [--host 127.0.0.1] [--port 7000] [--db users.db]
+                         [--shards DIR] [--shard-buckets N] [--cache-size N]
+                         [--snapshot FILE]
+                         [--hash-workers N] [--group-commit-ms 2] [--group-commit-size 64]
+                         [--metrics FILE] [--metrics-format prometheus]
+                         [--metrics-interval 15] [--slow-query-ms MS]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import functools
+import json
+import os
+import signal
+
+from atm import MAX_CENTS, ConcurrencyError, Persistence, User
+from metrics import Metrics
+from session import LocalSession
+from sharding import ShardedPersistence
+
+
+
+MUTATIONS = ('deposit', 'withdraw', 'transfer')
+TEXT_PARAMS = ('agency', 'account', 'password', 'atm_id')
+
+
+
+def validate(request):
+    """ Check types and bounds of a request's params, before anything uses them.
+
+    Raises:
+        ValueError: If it isn't a JSON object or any param is invalid.
+    """
+    if not isinstance(request, dict):
+        raise ValueError('Request must be a JSON object.')
+
+    if 'amount' in request and (not isinstance(request['amount'], int) or
+                                isinstance(request['amount'], bool) or
+                                not 0 < request['amount'] <= MAX_CENTS):
+        raise ValueError('Amount must be a positive int of cents.')
+    if 'limit' in request and not Persistence.is_count(request['limit']):
+        raise ValueError('Limit must be a positive int.')
+    if request.get('before') is not None and not Persistence.is_cursor(request['before']):
+        raise ValueError('Before must be a cursor answered with a previous page.')
+    for name in TEXT_PARAMS:
+        if request.get(name) is not None and not isinstance(request[name], str):
+            raise ValueError('{} must be a string.'.format(name.capitalize()))
+
+
+
+def dispatch(session, request, save=True):
+    """ Execute a request in a session. Must run in database worker thread.
+
+    Args:
+        session (LocalSession): Session of the requesting connection.
+        request        (dict): Decoded request line.
+        save           (bool): False to leave saving of MUTATIONS (and 'save' action)
+                               to the caller, eg: to a GroupCommit.
+
+    Returns:
+        Result of requested action.
+
+    Raises:
+        ValueError: For unknown actions, invalid params (amounts, history pages...) or for
+                    actions that require a logged user.
+    """
+    validate(request)
+    action = request.get('action')
+
+    if action == 'login':
+        return session.log_in(request['agency'], request['account'], request['password'])
+    if action == 'exists':
+        return session.exists(request['agency'], request['account'])
+    if action == 'atm':
+        return session.use_atm(request['atm_id'])
+    if action == 'denominations':
+        return session.get_denominations()
+
+    if session.get_user() is None:
+        raise ValueError('Not logged in.')
+
+    if action == 'refresh':
+        return session.refresh()
+    if action == 'balance':
+        return session.get_balance()
+    if action == 'extract':
+        return session.get_history(request.get('limit', 10), request.get('before'))
+    if action == 'withdraw_options':
+        return session.options_to_withdraw(request['amount'])
+    if action == 'save':
+        return session.save() if save else True
+    if action == 'logout':
+        return session.log_out()
+
+    if action == 'deposit':
+        done = session.deposit(request['amount'], request.get('agency'), request.get('account'))
+    elif action == 'withdraw':
+        done = session.withdraw_cash(*request['bills'])
+    elif action == 'transfer':
+        done = session.transfer_to(request['amount'], request['agency'], request['account'])
+    else:
+        raise ValueError('Unknown action.')
+
+    return done and (session.save() if save else True)
+
+
+
+class GroupCommit(object):
+    """ Journal of changes waiting to be saved, so changes made by many sessions at about
+    the same time are saved by a single commit (and a single fsync).
+
+    A batch is saved when it has max_size changes, or max_latency seconds after its first
+    one, whatever happens first, but never while another batch is being saved (changes
+    keep joining the next batch meanwhile, so under load batches grow by themselves).
+    Callers are answered only once their batch is saved.
+
+    Users are the ones of the data manager, so a batch is whatever changed in them since
+    last saving: changes made right before joining are saved by current batch or an
+    earlier one, never by a later one. If saving a batch fails due to a concurrent change
+    (see Persistence.update_users), every change is discarded, so each caller's change is
+    made again (by its redo function) and saved by itself: only conflicting ones fail.
+    Changes are made through make_change, so those discarded by a batch they didn't join
+    (made right before it) are known, and made again by the next one. """
+
+    __d_manager = None
+    __run = None # coroutine function running a function in database worker thread
+    __max_size = 64
+    __max_latency = 0.002 # in seconds
+    __waiting = None # (future, token, redo) of changes in current batch, see commit
+    __saves = 0 # batches saved so far (or being saved)
+    __last_discard = 0 # number of the last batch whose changes were discarded
+    __timer = None # flushing of current batch, when it's scheduled
+    __is_flushing = False
+
+
+
+    def __init__(self, d_manager, run, max_size=64, max_latency=0.002):
+        """ Constructor.
+
+        Args:
+            d_manager (Persistence): Data manager of changed users.
+            run (coroutine function): Runs a function (and its arguments) in the only thread
+                                      that touches users and database, returning its result.
+            max_size           (int): Changes per batch.
+            max_latency        (num): Seconds a change may wait for its batch to be saved.
+        """
+        self.__d_manager = d_manager
+        self.__run = run
+        self.__max_size = max_size
+        self.__max_latency = max_latency
+        self.__waiting = []
+
+
+
+    def make_change(self, function, *args):
+        """ Make a change to be committed. Must run in database worker thread.
+
+        Args:
+            function (function): Makes the change, with these args.
+
+        Returns:
+            tuple: (function result, token to be given to commit).
+        """
+        return function(*args), self.__saves
+
+
+
+    async def commit(self, token, redo=None):
+        """ Wait until changes already made are saved.
+
+        Args:
+            token      (int): Given by make_change along with the change.
+            redo (function): Makes the change again (in database worker thread) if it's
+                             been discarded due to someone else's conflict, returning
+                             True if it's been made. None if there's nothing to make again.
+
+        Returns:
+            bool: True if saved, False if they've been discarded due to a concurrent change.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.__waiting.append((future, token, redo))
+
+        if self.__is_flushing:
+            pass # it's scheduled again after current one
+        elif len(self.__waiting) >= self.__max_size:
+            self.__flush_soon(loop, 0)
+        elif self.__timer is None:
+            self.__flush_soon(loop, self.__max_latency)
+
+        return await future
+
+
+
+    def __flush_soon(self, loop, delay):
+        """ (Re)schedule flushing of current batch. """
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = loop.call_later(delay, lambda: asyncio.ensure_future(self.__flush()))
+
+
+
+    async def __flush(self):
+        """ Save current batch and answer its callers. """
+        self.__timer = None
+        batch, self.__waiting = self.__waiting, []
+        self.__is_flushing = True
+        try:
+            saved = await self.__run(self.__save, batch)
+        except Exception as error: # pylint: disable=broad-except
+            for future, _, _ in batch:
+                future.set_exception(error)
+        else:
+            for (future, _, _), result in zip(batch, saved):
+                future.set_result(result)
+        finally:
+            self.__is_flushing = False
+
+        if self.__waiting: # joined while saving
+            loop = asyncio.get_event_loop()
+            self.__flush_soon(loop, 0 if len(self.__waiting) >= self.__max_size
+                              else self.__max_latency)
+
+
+
+    def __save(self, batch):
+        """ Save all changes, or each caller's one by itself if they conflict. Must run in
+        database worker thread.
+
+        Returns:
+            list: For each change of batch, True if saved, False if it's been discarded.
+        """
+        self.__saves += 1
+        saved = [True] * len(batch)
+        for index, (_, token, redo) in enumerate(batch):
+            if token < self.__last_discard: # discarded by a batch it didn't join
+                saved[index] = self.__redo(redo)
+
+        try:
+            self.__d_manager.update_users()
+            return saved
+        except ConcurrencyError: # every change has been discarded
+            self.__last_discard = self.__saves
+
+        for index, (_, _, redo) in enumerate(batch):
+            if saved[index]:
+                saved[index] = self.__redo(redo) and self.__save_alone()
+        return saved
+
+
+
+    @staticmethod
+    def __redo(redo):
+        """ Returns: bool: True if a discarded change has been made again. """
+        try:
+            return redo is None or redo() is True
+        except (ValueError, KeyError, TypeError):
+            return False
+
+
+
+    def __save_alone(self):
+        """ Returns: bool: True if the only change in memory has been saved. """
+        try:
+            self.__d_manager.update_users()
+            return True
+        except ConcurrencyError:
+            return False
+
+
+
+class AtmServer(object):
+    """ Asyncio server of terminal sessions, sharing a single Persistence instance. """
+
+    __d_manager = None
+    __db_worker = None # the only thread touching users and database
+    __hash_workers = None # threads verifying passwords
+    __logins = None # shared by sessions, see LocalSession
+    __metrics_export = None # (Metrics, file path, format, interval in seconds)
+    __group_commit = None # GroupCommit, or None to save every change by itself
+
+
+
+    def __init__(self, d_manager, hash_workers=None, group_commit=(64, 0.002)):
+        """ Constructor.
+
+        Args:
+            d_manager (Persistence): Data manager of bank accounts.
+            hash_workers     (int): Threads verifying passwords, None for one per CPU.
+            group_commit   (tuple): Maximum size and latency (in seconds) of batches of
+                                    changes (see GroupCommit), None to save every change
+                                    by itself.
+        """
+        self.__d_manager = d_manager
+        self.__db_worker = ThreadPoolExecutor(max_workers=1)
+        self.__hash_workers = ThreadPoolExecutor(max_workers=hash_workers or os.cpu_count() or 1)
+        self.__logins = {}
+        if group_commit is not None:
+            self.__group_commit = GroupCommit(d_manager, self.__run, *group_commit)
+
+
+
+    def export_metrics(self, metrics, path, file_format='prometheus', interval=15):
+        """ Write measures to a file every interval seconds while serving, and at the end.
+
+        Args:
+            metrics (Metrics): An enabled instance.
+            path        (str): File path.
+            file_format (str): See Metrics.export.
+            interval    (num): In seconds.
+        """
+        self.__metrics_export = (metrics, path, file_format, interval)
+
+
+
+    def __schedule_metrics(self, loop):
+        """ Export measures (out of the loop thread) and schedule next exporting. """
+        metrics, path, file_format, interval = self.__metrics_export
+        loop.run_in_executor(None, metrics.export, path, file_format)
+        loop.call_later(interval, self.__schedule_metrics, loop)
+
+
+
+    async def __run(self, function, *args):
+        """ Run a function in database worker thread, without blocking the loop. """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.__db_worker, function, *args)
+
+
+
+    async def __log_in(self, session, request):
+        """ Serve a login request, verifying its password in a hashing thread. """
+        agency, account, password = request['agency'], request['account'], request['password']
+        encoded = await self.__run(session.get_password_hash, agency, account)
+
+        verified = None
+        if encoded is not None:
+            loop = asyncio.get_event_loop()
+            verified = await loop.run_in_executor(self.__hash_workers,
+                                                  User.HASHER.verify_and_update,
+                                                  password, encoded)
+
+        return await self.__run(session.log_in, agency, account, password, verified)
+
+
+
+    async def handle(self, reader, writer):
+        """ Serve a terminal connection, until it's closed. """
+        session = LocalSession(self.__d_manager, self.__logins)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    validate(request)
+                    if request.get('action') == 'login':
+                        result = await self.__log_in(session, request)
+                    elif self.__group_commit is None:
+                        result = await self.__run(dispatch, session, request)
+                    else:
+                        result, token = await self.__run(self.__group_commit.make_change,
+                                                         dispatch, session, request, False)
+                        if result is True and request['action'] in MUTATIONS:
+                            result = await self.__group_commit.commit(
+                                token, functools.partial(dispatch, session, request, False))
+                        elif result is True and request['action'] == 'save':
+                            result = await self.__group_commit.commit(token)
+                    response = {'ok': True, 'result': result}
+                except (ValueError, KeyError, TypeError) as error:
+                    response = {'ok': False, 'error': str(error) or 'Bad request.'}
+
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            await self.__run(session.log_out)
+            writer.close()
+
+
+
+    def serve_forever(self, host, port):
+        """ Listen to terminals until it's interrupted (eg: Ctrl+C) or terminated. """
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        print('ATM server listening on {}:{}'.format(host, port))
+
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        except NotImplementedError: # eg: Windows
+            pass
+
+        if self.__metrics_export is not None:
+            loop.call_later(self.__metrics_export[3], self.__schedule_metrics, loop)
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.__db_worker.submit(self.__d_manager.close).result()
+            self.__db_worker.shutdown()
+            self.__hash_workers.shutdown()
+            if self.__metrics_export is not None:
+                self.__metrics_export[0].export(*self.__metrics_export[1:3])
+
+
+
+def main(argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(description='Serve ATM terminals through TCP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    parser.add_argument('--shards', default=None, metavar='DIR',
+                        help='use a directory of shards instead of a database file')
+    parser.add_argument('--shard-buckets', type=int, default=None,
+                        help='spread agencies over N shards by hash (default: one per agency)')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='load users on demand, keeping at most N in memory '
+                             '(default: load every user at start)')
+    parser.add_argument('--snapshot', metavar='FILE', default=None,
+                        help='load users from this snapshot file if it is up to date '
+                             '(see AccountSnapshot), writing it at exit otherwise')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='threads verifying passwords (default: one per CPU)')
+    parser.add_argument('--group-commit-ms', type=float, default=2,
+                        help='most a change waits for its batch to be saved (default: 2)')
+    parser.add_argument('--group-commit-size', type=int, default=64,
+                        help='changes per batch (default: 64), 1 to save each one by itself')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='measure calls and statements, writing them to this file')
+    parser.add_argument('--metrics-format', choices=('prometheus', 'json'), default='prometheus')
+    parser.add_argument('--metrics-interval', type=float, default=15,
+                        help='seconds between writings of metrics file (default: 15)')
+    parser.add_argument('--slow-query-ms', type=float, default=None,
+                        help='log statements taking this long to FILE.slow (needs --metrics)')
+    args = parser.parse_args(argv)
+
+    metrics = None
+    if args.metrics is not None:
+        metrics = Metrics(args.slow_query_ms, args.metrics + '.slow')
+        metrics.enable() # before loading, so it's measured too
+
+    group_commit = None
+    if args.group_commit_size > 1:
+        group_commit = (args.group_commit_size, args.group_commit_ms / 1000)
+
+    if args.shards is not None:
+        d_manager = ShardedPersistence(args.shards, args.shard_buckets, concurrent=True,
+                                       durable=True, cache_size=args.cache_size)
+    else:
+        d_manager = Persistence(args.db, concurrent=True, durable=True,
+                                cache_size=args.cache_size, snapshot_path=args.snapshot)
+    server = AtmServer(d_manager, args.hash_workers, group_commit)
+    if metrics is not None:
+        server.export_metrics(metrics, args.metrics, args.metrics_format, args.metrics_interval)
+    server.serve_forever(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+""" Terminal sessions: what an ATM terminal can do once an user is accessing it.
+Both classes here have the same methods, so a terminal doesn't care whether it's using
+the database directly (LocalSession) or through an ATM server (RemoteSession).
+"""
+
+import json
+import socket
+
+from atm import CassetteInventory, ConcurrencyError, PaperMoneyCounter
+
+
+
+class LocalSession(object):
+    """ Session of a terminal using a Persistence instance of its own process. """
+
+    __d_manager = None
+    __user = None # logged user
+    __logins = None # users id -> quantity of sessions logged in it
+    __counter = None # bills of this machine
+
+
+
+    def __init__(self, d_manager, logins=None, counter=None):
+        """ Constructor.
+
+        Args:
+            d_manager (Persistence): Data manager of bank accounts.
+            logins           (dict): Shared by sessions of the same data manager (eg: in a
+                                     server), since they share User instances too. So a
+                                     session logging out (or typing a wrong password)
+                                     doesn't log out others. None if it's the only session.
+            counter (PaperMoneyCounter): Bills available in this machine, None for default ones.
+        """
+        self.__d_manager = d_manager
+        self.__logins = logins if logins is not None else {}
+        self.__counter = counter or PaperMoneyCounter()
+
+
+
+    def log_in(self, agency, account, password, verified=None):
+        """ Access a bank account.
+
+        Args:
+            agency   (str): Agency identification code.
+            account  (str): Account identification code.
+            password (str): A password in natural language.
+            verified (tuple): Password already verified elsewhere, see User.log_in.
+
+        Returns:
+            bool: True if authorized, False for wrong password, None if user doesn't exist.
+        """
+        user = self.__d_manager.find_user(agency, account)
+        if user is None:
+            return None
+
+        if user.log_in(password, verified):
+            if user is not self.__user: # logging in again keeps the same login
+                self.log_out()
+                self.__user = user
+                self.__logins[user.get_id()] = self.__logins.get(user.get_id(), 0) + 1
+            return True
+
+        if self.__logins.get(user.get_id()):
+            user.authorize() # still logged in by other sessions
+
+        return False
+
+
+
+    def get_password_hash(self, agency, account):
+        """ Returns: str: Password hash of an user (eg: to verify it in another thread),
+        None if there's no user with these agency and account. """
+        user = self.__d_manager.find_user(agency, account)
+        return user.get_password() if user is not None else None
+
+
+
+    def get_user(self):
+        """ Returns: User: The logged user, or None. """
+        return self.__user
+
+
+
+    def exists(self, agency, account):
+        """ Returns: bool: True if there's an user with these agency and account. """
+        return self.__d_manager.find_user(agency, account) is not None
+
+
+
+    def refresh(self):
+        """ Reload logged user balance, in case it's been changed by another terminal. """
+        self.__d_manager.refresh(self.__user)
+
+
+
+    def get_balance(self):
+        """ Returns: int: Balance of logged user in cents. """
+        return self.__user.get_balance()
+
+
+
+    def get_history(self, limit=10, before=None):
+        """ Read a page of logged user history, see Persistence.get_history. """
+        return self.__d_manager.get_history(self.__user, limit=limit, before=before)
+
+
+
+    def deposit(self, amount, agency=None, account=None):
+        """ Deposit cash in logged user account, or in another one if it's given.
+
+        Returns:
+            bool: True if deposited, False if another user doesn't exist or amount isn't
+                  accepted (see User.deposit).
+        """
+        another_user = None
+        if agency is not None or account is not None:
+            another_user = self.__d_manager.find_user(agency, account)
+            if another_user is None:
+                return False
+
+        return self.__user.deposit(amount, another_user)
+
+
+
+    def get_denominations(self):
+        """ Returns: tuple: Values of bills in this machine, in cents, decreasing order. """
+        return self.__counter.get_denominations()
+
+
+
+    def use_atm(self, atm_id):
+        """ Dispense bills from cassettes of an ATM (see Persistence.load_inventory),
+        instead of unlimited bills.
+
+        Returns:
+            bool: True if it's been set, False if that ATM has no cassettes.
+        """
+        inventory = self.__d_manager.load_inventory(atm_id)
+        if inventory is None:
+            return False
+
+        self.__counter = inventory
+        return True
+
+
+
+    def options_to_withdraw(self, amount):
+        """ See User.options_to_withdraw. """
+        return self.__user.options_to_withdraw(amount, self.__counter)
+
+
+
+    def withdraw_cash(self, *bills):
+        """ See User.withdraw_cash. Bills are taken from cassettes, if there are. """
+        if not self.__user.withdraw_cash(*bills, counter=self.__counter):
+            return False
+
+        if isinstance(self.__counter, CassetteInventory):
+            self.__counter.take(bills)
+        return True
+
+
+
+    def transfer_to(self, amount, agency, account):
+        """ Transfer from logged user to another one.
+
+        Returns:
+            bool: True if transfered, False otherwise (eg: another user doesn't exist).
+        """
+        another_user = self.__d_manager.find_user(agency, account)
+        if another_user is None:
+            return False
+
+        return self.__user.transfer_to(amount, another_user)
+
+
+
+    def save(self):
+        """ Save changes.
+
+        Returns:
+            bool: True if saved, False if they've been discarded due to a concurrent change.
+        """
+        try:
+            self.__d_manager.update_users()
+            return True
+        except ConcurrencyError:
+            return False
+
+
+
+    def log_out(self):
+        """ Exit logged user account. """
+        if self.__user is None:
+            return
+
+        user_id = self.__user.get_id()
+        self.__logins[user_id] -= 1
+        if self.__logins[user_id] == 0:
+            del self.__logins[user_id]
+            self.__user.log_out()
+        self.__user = None
+
+
+
+    def close(self):
+        """ Release data manager. """
+        self.__d_manager.close()
+
+
+# ..............................................................
+
+
+class RemoteSession(object):
+    """ Session of a terminal using an ATM server (see server.py), through TCP.
+    Each method sends a JSON line {"action": ..., [params]} and reads a JSON line back,
+    {"ok": true, "result": ...} or {"ok": false, "error": ...}. """
+
+    __sock = None
+    __stream = None
+
+
+
+    def __init__(self, host, port):
+        """ Constructor, connects to the server.
+
+        Args:
+            host (str): Server address.
+            port (int): Server port.
+        """
+        self.__sock = socket.create_connection((host, port))
+        self.__stream = self.__sock.makefile('rw', encoding='utf-8', newline='\n')
+
+
+
+    def request(self, action, **params):
+        """ Send a request and wait for its response.
+
+        Returns:
+            Result of that action in server.
+
+        Raises:
+            RuntimeError: If server answered with an error (or didn't answer).
+        """
+        params['action'] = action
+        self.__stream.write(json.dumps(params) + '\n')
+        self.__stream.flush()
+
+        line = self.__stream.readline()
+        if not line:
+            raise RuntimeError('Connection closed by server.')
+
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+
+
+    def log_in(self, agency, account, password):
+        """ See LocalSession.log_in, the password is verified by the server. """
+        return self.request('login', agency=agency, account=account, password=password)
+
+
+
+    def exists(self, agency, account):
+        """ See LocalSession.exists. """
+        return self.request('exists', agency=agency, account=account)
+
+
+
+    def refresh(self):
+        """ See LocalSession.refresh. """
+        self.request('refresh')
+
+
+
+    def get_balance(self):
+        """ See LocalSession.get_balance. """
+        return self.request('balance')
+
+
+
+    def get_history(self, limit=10, before=None):
+        """ See LocalSession.get_history. """
+        registers, cursor = self.request('extract', limit=limit, before=before)
+        return registers, cursor
+
+
+
+    def deposit(self, amount, agency=None, account=None):
+        """ See LocalSession.deposit, it's saved by the server. """
+        return self.request('deposit', amount=amount, agency=agency, account=account)
+
+
+
+    def get_denominations(self):
+        """ See LocalSession.get_denominations. """
+        return tuple(self.request('denominations'))
+
+
+
+    def use_atm(self, atm_id):
+        """ See LocalSession.use_atm. """
+        return self.request('atm', atm_id=atm_id)
+
+
+
+    def options_to_withdraw(self, amount):
+        """ See LocalSession.options_to_withdraw. """
+        return self.request('withdraw_options', amount=amount)
+
+
+
+    def withdraw_cash(self, *bills):
+        """ See LocalSession.withdraw_cash, it's saved by the server. """
+        return self.request('withdraw', bills=bills)
+
+
+
+    def transfer_to(self, amount, agency, account):
+        """ See LocalSession.transfer_to, it's saved by the server. """
+        return self.request('transfer', amount=amount, agency=agency, account=account)
+
+
+
+    def save(self):
+        """ See LocalSession.save, changes are already saved by the server. """
+        return self.request('save')
+
+
+
+    def log_out(self):
+        """ See LocalSession.log_out. """
+        self.request('logout')
+
+
+
+    def close(self):
+        """ Disconnect from server. """
+        self.__stream.close()
+        self.__sock.close()
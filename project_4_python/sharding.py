@@ -0,0 +1,491 @@
+""" Storage backend spreading bank accounts over many SQLite files, one per agency (or per
+hash range of agencies), behind the same methods as Persistence, so sessions, the server
+and scripts don't care which one they use.
+
+Each shard is a database of its own (same schema as users.db), so writers of different
+agencies don't wait for each other, and each file and its indexes stay small. Users ids
+don't collide: shard number n gives ids from n * ID_SPACE + 1 on, so an id tells its shard.
+
+A catalog database, in the same directory, maps agencies to shards, keeps ATM cassettes
+and is the coordinator of two-phase commits: changes of a single shard (most of them)
+are saved by its own transaction, while changes spanning many databases (eg: a transfer
+between agencies, or a withdraw taking bills from cassettes) are saved like this:
+    1. the transaction is logged in the catalog, as preparing.
+    2. each database prepares its changes (see Persistence.prepare): debits are saved
+       right away (held), credits are kept aside. Any failure aborts the transaction.
+    3. the catalog logs it as committed: this is the point of no return.
+    4. each database applies its credits (or, if aborted, refunds held debits).
+Every step is fsynced. Transactions left in the middle by a crash are finished when the
+directory is opened again: committed ones are applied, the others are aborted.
+
+    d_manager = ShardedPersistence('shards/') # or buckets=64, for hash ranges
+    user = d_manager.find_user('A1', '00000-0')
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+
+from atm import ConcurrencyError, Persistence
+
+ID_SPACE = 2 ** 40 # users ids of shard number n are above n * ID_SPACE
+CATALOG = 'catalog.db'
+CATALOG_NAME = '' # of the catalog, among databases taking part in a transaction
+STALE_TRANSACTION_S = 60 # preparing for longer, its coordinator is taken as crashed
+
+
+
+class Shard(Persistence):
+    """ Persistence of a shard: installed empty (no default users), with its own range
+    of users ids. """
+
+    __first_id = 1
+
+
+
+    def __init__(self, db_path, first_id, **kwargs):
+        """ Constructor.
+
+        Args:
+            db_path  (str): Database file path.
+            first_id (int): Id of its first user.
+            **kwargs: Other Persistence arguments.
+        """
+        self.__first_id = first_id
+        super(Shard, self).__init__(db_path, **kwargs)
+
+
+
+    def install(self):
+        """ Initialize database, create tables without any row. """
+        with self.transaction() as cursor:
+            self.create_schema(cursor)
+            cursor.execute('''
+            INSERT INTO sqlite_sequence (name, seq) VALUES ('users', ?);
+            ''', (self.__first_id - 1,))
+            self.create_checkpoints(cursor)
+
+        self.load_users()
+
+
+
+class ShardedPersistence(object):
+    """ Data manager for ATM bank accounts, in a directory of shards. See module
+    documentation. It should be closed when it's not needed anymore. """
+
+    __directory = None
+    __buckets = None # quantity of hash ranges, None for a shard per agency
+    __options = None # Persistence arguments for every shard
+    __catalog = None
+    __shards = None # shard name -> Shard, those opened so far
+    __names = None # shard number -> name
+    __lock = None
+
+
+
+    def __init__(self, directory, buckets=None, concurrent=False, durable=False, preload=True,
+                 cache_size=None):
+        """ Open a directory of shards, creating it if needed, and finish any transaction
+        left in the middle.
+
+        Args:
+            directory   (str): Where databases are.
+            buckets     (int): Spread agencies over this quantity of shards, by hash,
+                               None for a shard per agency. It can't be changed later.
+            concurrent, durable, preload, cache_size: See Persistence. Shards are opened
+                               (and their users loaded) the first time they're needed,
+                               cache_size is for each one of them.
+
+        Raises:
+            ValueError: If directory was made with another buckets.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__buckets = buckets
+        self.__options = {'concurrent': concurrent, 'durable': durable, 'preload': preload,
+                          'cache_size': cache_size}
+        self.__shards = {}
+        self.__names = {}
+        self.__lock = threading.RLock()
+
+        # coordinator decisions must survive anything, so catalog is always durable
+        self.__catalog = Shard(os.path.join(directory, CATALOG), 1, concurrent=concurrent,
+                               durable=True, preload=False)
+        with self.__catalog.transaction(immediate=True) as cursor:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                name  TEXT NOT NULL PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                name   TEXT NOT NULL PRIMARY KEY,
+                number INTEGER NOT NULL UNIQUE
+            );
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transactions (
+                id         INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                state      TEXT NOT NULL, -- preparing, committed or aborted
+                shards     TEXT NOT NULL, -- JSON list of databases names taking part
+                created_at INTEGER NOT NULL
+            );
+            ''')
+            cursor.execute('''
+            INSERT OR IGNORE INTO settings (name, value) VALUES ('buckets', ?);
+            ''', (str(buckets or 0),))
+            cursor.execute("SELECT value FROM settings WHERE name='buckets';")
+            made_with = int(cursor.fetchone()[0])
+
+        if made_with != (buckets or 0):
+            self.__catalog.close()
+            raise ValueError('Shards directory was made with {} buckets, not {}.'.format(
+                made_with or None, buckets))
+
+        self.__recover()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+    def close(self):
+        """ Close every database connection. They're reopened if this instance is used again. """
+        with self.__lock:
+            for shard in self.__shards.values():
+                shard.close()
+            self.__catalog.close()
+
+
+
+    def shard_name(self, agency):
+        """ Returns: str: Name of the shard of an agency (whether it exists or not). """
+        if self.__buckets is None:
+            return agency
+        return 'h{}'.format(zlib.crc32(agency.encode('utf-8')) % self.__buckets)
+
+
+
+    def get_shard(self, agency, create=False):
+        """ Get the Persistence of an agency's shard, eg: for back office jobs.
+
+        Args:
+            agency  (str): Agency identification code.
+            create (bool): True to create its shard if it doesn't exist yet.
+
+        Returns:
+            Shard: Its database, or None if it doesn't exist.
+        """
+        return self.__shard(self.shard_name(agency), create)
+
+
+
+    def get_shards(self):
+        """ Returns: list: Names of every shard, see shard_name. """
+        return [row[0] for row in self.__catalog.query('SELECT name FROM shards ORDER BY name;')]
+
+
+
+    def __shard(self, name, create=False):
+        """ Get a shard by name, opening it the first time. """
+        with self.__lock:
+            shard = self.__shards.get(name)
+            if shard is not None:
+                return shard
+
+            rows = self.__catalog.query('SELECT number FROM shards WHERE name=?;', (name,))
+            created = not rows
+            if created:
+                if not create:
+                    return None
+                with self.__catalog.transaction(immediate=True) as cursor:
+                    cursor.execute('''
+                    INSERT INTO shards (name, number)
+                    SELECT ?, COALESCE(MAX(number), 0) + 1 FROM shards;
+                    ''', (name,))
+                    cursor.execute('SELECT number FROM shards WHERE name=?;', (name,))
+                    rows = cursor.fetchall()
+
+            number = rows[0][0]
+            shard = Shard(os.path.join(self.__directory, 'shard-{}.db'.format(number)),
+                          number * ID_SPACE + 1, **self.__options)
+            shard.set_foreign_users(self.__find_keys)
+            if created: # it gets limits of any agency, see set_limit
+                for limit in self.__catalog.get_limits():
+                    shard.set_limit(*limit)
+            self.__shards[name] = shard
+            self.__names[number] = name
+            return shard
+
+
+
+    def __database(self, name):
+        """ Returns: Persistence: A database taking part in transactions, by name. """
+        if name == CATALOG_NAME:
+            return self.__catalog
+        return self.__shard(name, create=True)
+
+
+
+    def __find_keys(self, user_id):
+        """ Returns: tuple: (account, agency) of an user of any shard, or None. """
+        number = (user_id - 1) // ID_SPACE
+        name = self.__names.get(number)
+        if name is None:
+            rows = self.__catalog.query('SELECT name FROM shards WHERE number=?;', (number,))
+            if not rows:
+                return None
+            name = rows[0][0]
+
+        rows = self.__shard(name).query('''
+        SELECT account, agency FROM users WHERE id=?;
+        ''', (user_id,))
+        return tuple(rows[0]) if rows else None
+
+
+
+    def find_user(self, agency=None, account=None):
+        """ Search for a registered user, in its agency's shard. See Persistence.find_user. """
+        if agency is None or account is None:
+            return None
+
+        shard = self.get_shard(agency)
+        return shard.find_user(agency, account) if shard is not None else None
+
+
+
+    def add_user(self, agency, account, password, balance=0):
+        """ Register a new user in its agency's shard. See Persistence.add_user. """
+        return self.get_shard(agency, create=True).add_user(agency, account, password, balance)
+
+
+
+    def has_changes(self):
+        """ Returns: bool: True if there's anything to save, see update_users. """
+        with self.__lock:
+            return self.__catalog.has_changes() or \
+                any(shard.has_changes() for shard in self.__shards.values())
+
+
+
+    def discard_changes(self):
+        """ Forget every unsaved change, see Persistence.discard_changes. """
+        with self.__lock:
+            self.__catalog.discard_changes()
+            for shard in self.__shards.values():
+                shard.discard_changes()
+
+
+
+    def update_users(self):
+        """ Save every change, as a whole: by a single transaction if they're all in the
+        same database, by a two-phase commit otherwise (see module documentation).
+
+        Raises:
+            ConcurrencyError: If any balance or cassette would become negative. Nothing is
+                              saved and every unsaved change is discarded.
+        """
+        with self.__lock:
+            databases = [(CATALOG_NAME, self.__catalog)] + sorted(self.__shards.items())
+            participants = [(name, database) for name, database in databases
+                            if database.has_changes()]
+            if not participants:
+                return
+            if len(participants) == 1:
+                participants[0][1].update_users()
+                return
+
+            with self.__catalog.transaction() as cursor:
+                cursor.execute('''
+                INSERT INTO transactions (state, shards, created_at)
+                VALUES ('preparing', ?, ?);
+                ''', (json.dumps([name for name, _ in participants]), int(time.time())))
+                txn_id = cursor.lastrowid
+
+            prepared = []
+            try:
+                for _, database in participants:
+                    database.prepare(txn_id)
+                    prepared.append(database)
+                if not self.__decide(txn_id, 'committed'):
+                    raise ConcurrencyError([]) # taken as crashed and aborted by someone else
+            except BaseException:
+                self.__decide(txn_id, 'aborted')
+                for _, database in participants: # refunding, or just forgetting changes
+                    if database in prepared:
+                        database.abort_prepared(txn_id)
+                    else:
+                        database.discard_changes()
+                self.__forget(txn_id)
+                raise
+
+            for _, database in participants:
+                database.commit_prepared(txn_id)
+            self.__forget(txn_id)
+
+
+
+    def __decide(self, txn_id, state):
+        """ Log the decision about a preparing transaction.
+
+        Returns:
+            bool: True if it's been decided now, False if it had already been decided.
+        """
+        with self.__catalog.transaction(immediate=True) as cursor:
+            cursor.execute('''
+            UPDATE transactions SET state=? WHERE id=? AND state='preparing';
+            ''', (state, txn_id))
+            return cursor.rowcount == 1
+
+
+
+    def __forget(self, txn_id):
+        """ Remove a transaction from the log, once every database has finished it. """
+        with self.__catalog.transaction() as cursor:
+            cursor.execute('DELETE FROM transactions WHERE id=?;', (txn_id,))
+
+
+
+    def __recover(self):
+        """ Finish transactions left in the middle (eg: by a crash): committed ones are
+        committed everywhere, others are aborted (unless they may still be preparing). """
+        rows = self.__catalog.query('''
+        SELECT id, state, shards, created_at FROM transactions ORDER BY id;
+        ''')
+        touched = set()
+        for txn_id, state, names, created_at in rows:
+            if state == 'preparing':
+                if created_at > time.time() - STALE_TRANSACTION_S:
+                    continue
+                if not self.__decide(txn_id, 'aborted'):
+                    continue # just decided by its coordinator, it'll finish it
+                state = 'aborted'
+
+            for name in json.loads(names):
+                database = self.__database(name)
+                if state == 'committed':
+                    database.commit_prepared(txn_id)
+                else:
+                    database.abort_prepared(txn_id)
+                touched.add(database)
+            self.__forget(txn_id)
+
+        if self.__options['preload']: # they were loaded (or cached) before being recovered
+            for database in touched:
+                database.load_users()
+
+
+
+    def refresh(self, user):
+        """ Reload balance of an user, see Persistence.refresh. """
+        return self.get_shard(user.get_agency()).refresh(user)
+
+
+
+    def get_history(self, user, limit=20, before=None, since=None, until=None):
+        """ Read a page of saved history of an user, see Persistence.get_history. """
+        return self.get_shard(user.get_agency()).get_history(user, limit, before, since, until)
+
+
+
+    def get_daily_totals(self, user, since=None, until=None):
+        """ Sum amounts of an user's history by day, see Persistence.get_daily_totals. """
+        return self.get_shard(user.get_agency()).get_daily_totals(user, since, until)
+
+
+
+    def iter_statement(self, user, since=None, until=None, chunk_size=1000):
+        """ Stream saved history of an user, see Persistence.iter_statement. """
+        return self.get_shard(user.get_agency()).iter_statement(user, since, until, chunk_size)
+
+
+
+    def export_statement(self, user, out_file, file_format='csv', since=None, until=None):
+        """ Write saved history of an user in a file, see Persistence.export_statement. """
+        return self.get_shard(user.get_agency()).export_statement(user, out_file, file_format,
+                                                                  since, until)
+
+
+
+    def load_inventory(self, atm_id, limit=None):
+        """ Load bills inside an ATM (they're in the catalog), see Persistence.load_inventory. """
+        return self.__catalog.load_inventory(atm_id, limit)
+
+
+
+    def set_cassette(self, atm_id, denomination, quantity):
+        """ Set the quantity of bills of a cassette, see Persistence.set_cassette. """
+        self.__catalog.set_cassette(atm_id, denomination, quantity)
+
+
+
+    def set_limit(self, agency, account, action, window, max_amount):
+        """ Set (or remove) a limit, see Persistence.set_limit. Limits are kept by shards:
+        those of an agency by its shard, those of ANY agency by every shard (and by the
+        catalog, for shards made later).
+
+        Raises:
+            ValueError: See Persistence.set_limit.
+        """
+        with self.__lock:
+            if agency != Persistence.ANY:
+                self.get_shard(agency, create=True).set_limit(agency, account, action, window,
+                                                              max_amount)
+                return
+
+            self.__catalog.set_limit(agency, account, action, window, max_amount)
+            for name in self.get_shards():
+                self.__shard(name).set_limit(agency, account, action, window, max_amount)
+
+
+
+    def get_limits(self):
+        """ Returns: list: Every limit of every shard, see Persistence.get_limits. """
+        with self.__lock:
+            limits = set(self.__catalog.get_limits())
+            for name in self.get_shards():
+                limits.update(self.__shard(name).get_limits())
+            return sorted(limits)
+
+
+
+    def get_remaining_limit(self, user, action):
+        """ Get how much an user may still move, see Persistence.get_remaining_limit. """
+        return self.get_shard(user.get_agency()).get_remaining_limit(user, action)
+
+
+
+    def reconcile(self, agency=None):
+        """ Check that balances agree with history, shard by shard, see Persistence.reconcile.
+
+        Args:
+            agency (str): Only accounts of this agency, None for every shard.
+
+        Returns:
+            dict: Like Persistence.reconcile, with accounts, history_rows, new_checkpoints
+                  and mismatches of every shard, but history_id is a dict of shard name ->
+                  last history row checked in it (ids are by shard).
+        """
+        if agency is not None:
+            names = [self.shard_name(agency)] if self.get_shard(agency) is not None else []
+        else:
+            names = self.get_shards()
+
+        report = {'history_id': {}, 'accounts': 0, 'history_rows': 0, 'new_checkpoints': 0,
+                  'mismatches': []}
+        for name in names:
+            result = self.__shard(name).reconcile(agency)
+            report['history_id'][name] = result['history_id']
+            for key in ('accounts', 'history_rows', 'new_checkpoints', 'mismatches'):
+                report[key] += result[key]
+        return report
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# RUNTIME: Python 3.5.2
+
+""" Back office script to export the statement of an account, streaming it from database,
+so even multi-year statements of high-volume accounts don't need much memory.
+
+Usage: python3 statement.py AGENCY ACCOUNT [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+                            [--format csv|jsonl] [--output FILE] [--db users.db]
+Dates are local, 'until' is exclusive. Amounts are in cents.
+"""
+
+from datetime import datetime
+import argparse
+import sys
+
+from atm import Persistence
+
+
+
+def parse_date(text):
+    """ Returns: datetime: Parsed from 'YYYY-MM-DD' text. """
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+
+def main(argv=None):
+    """ Command line entry point.
+
+    Returns:
+        int: Exit status, 0 if exported, 1 if account doesn't exist.
+    """
+    parser = argparse.ArgumentParser(description='Export the statement of an ATM account.')
+    parser.add_argument('agency')
+    parser.add_argument('account')
+    parser.add_argument('--since', type=parse_date, default=None, help='YYYY-MM-DD')
+    parser.add_argument('--until', type=parse_date, default=None, help='YYYY-MM-DD, exclusive')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--output', default=None, help='file path (default: stdout)')
+    parser.add_argument('--db', default=None, help='database file (default: users.db)')
+    args = parser.parse_args(argv)
+
+    with Persistence(args.db, cache_size=1) as d_manager: # only the wanted user
+        user = d_manager.find_user(args.agency, args.account)
+        if user is None:
+            print('User not found.', file=sys.stderr)
+            return 1
+
+        if args.output is None:
+            count = d_manager.export_statement(user, sys.stdout, args.format,
+                                               args.since, args.until)
+        else:
+            with open(args.output, 'w', newline='') as out_file:
+                count = d_manager.export_statement(user, out_file, args.format,
+                                                   args.since, args.until)
+
+    print('{} register(s) exported.'.format(count), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())